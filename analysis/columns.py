@@ -0,0 +1,164 @@
+"""apthunt table items as typed columns.
+
+Known attributes of table items (see parser/posting.py) have arrow types. Low-level DynamoDB items of a scan page
+are decoded straight into NumPy buffers of their columns: numbers never become `Decimal`. Attributes not in the
+schema or with values not fitting the column type are kept as JSON object in `extra` column, so export loses
+nothing but DERIVED attributes.
+"""
+import json
+
+import numpy as np
+import pyarrow as pa
+from boto3.dynamodb import types
+
+PREFIX = "parsed_"
+
+STRINGS = ("postingtitletext", "price_text", "housing", "titletextonly", "district", "map_address", "map_link",
+           "postingbody", "type")
+INTS = ("nthumbs",)
+FLOATS = ("price", "data_latitude", "data_longitude", "bedrooms", "area")
+BOOLS = ("catsok", "dogsok", "garagea", "garaged", "furnished", "laundryb", "laundrys", "wd")
+LISTS = ("thumbs", "attrs", "notices")
+
+SCHEMA = pa.schema(
+    [("intid", pa.string()), ("PostUrl", pa.string()), ("added", pa.timestamp("ms"))]
+    + [(PREFIX + name, pa.string()) for name in STRINGS]
+    + [(PREFIX + name, pa.int64()) for name in INTS]
+    + [(PREFIX + name, pa.float64()) for name in FLOATS]
+    + [(PREFIX + name, pa.bool_()) for name in BOOLS]
+    + [(PREFIX + name, pa.list_(pa.string())) for name in LISTS]
+    + [("extra", pa.string())]
+)
+EXTRA = "extra"
+REQUIRED = ("intid", "added")  # snapshot merge needs them
+DERIVED = frozenset({"added_day"})  # attributes computed from columns, not exported: `added_day` is date of `added`
+
+_DESERIALIZER = types.TypeDeserializer()
+
+
+def select(names=None):
+    """schema of `names` columns with required and extra ones. Whole schema if names are not given"""
+    if not names:
+        return SCHEMA
+    names = set(names) | set(REQUIRED) | {EXTRA}
+    unknown = names - set(SCHEMA.names)
+    if unknown:
+        raise ValueError(f"unknown columns {sorted(unknown)}")
+    return pa.schema([field for field in SCHEMA if field.name in names])
+
+
+def attributes(schema):
+    """table attributes of schema columns"""
+    return [name for name in schema.names if name != EXTRA]
+
+
+class MaskedColumn:
+    """NumPy buffer of values with validity mask"""
+
+    def __init__(self, size, arrow_type, dtype):
+        self.arrow_type = arrow_type
+        self.values = np.zeros(size, dtype=dtype)
+        self.valid = np.zeros(size, dtype=bool)
+
+    def array(self):
+        return pa.array(self.values, type=self.arrow_type, mask=~self.valid)
+
+
+class NumberColumn(MaskedColumn):
+    """numbers: float64 or int64 (ints and timestamps)"""
+
+    def __init__(self, size, arrow_type):
+        self.parse = float if pa.types.is_floating(arrow_type) else int
+        super().__init__(size, arrow_type, np.float64 if self.parse is float else np.int64)
+
+    def set(self, row, value):
+        """decode AttributeValue into row. return False if it does not fit"""
+        number = value.get("N")
+        if number is None:
+            return "NULL" in value
+        try:
+            self.values[row] = self.parse(number)
+        except (ValueError, OverflowError):
+            return False
+        self.valid[row] = True
+        return True
+
+
+class BoolColumn(MaskedColumn):
+    """booleans"""
+
+    def __init__(self, size, arrow_type):
+        super().__init__(size, arrow_type, bool)
+
+    def set(self, row, value):
+        flag = value.get("BOOL")
+        if flag is None:
+            return "NULL" in value
+        self.values[row] = flag
+        self.valid[row] = True
+        return True
+
+
+class StringColumn:
+    """strings, None for missing"""
+
+    def __init__(self, size, arrow_type):
+        self.arrow_type = arrow_type
+        self.values = [None] * size
+
+    def set(self, row, value):
+        text = value.get("S")
+        if text is None:
+            return "NULL" in value
+        self.values[row] = text
+        return True
+
+    def array(self):
+        return pa.array(self.values, type=self.arrow_type)
+
+
+class StringListColumn(StringColumn):
+    """lists of strings, None for missing"""
+
+    def set(self, row, value):
+        values = value.get("L")
+        if values is None:
+            return "NULL" in value
+        try:
+            self.values[row] = [v["S"] for v in values]
+        except KeyError:
+            return False
+        return True
+
+
+def column(size, arrow_type):
+    """column buffer of `size` rows for arrow type"""
+    if pa.types.is_boolean(arrow_type):
+        return BoolColumn(size, arrow_type)
+    if pa.types.is_string(arrow_type):
+        return StringColumn(size, arrow_type)
+    if pa.types.is_list(arrow_type):
+        return StringListColumn(size, arrow_type)
+    return NumberColumn(size, arrow_type)
+
+
+def decode(items, schema=SCHEMA):
+    """arrow table of low-level DynamoDB items with schema columns"""
+    size = len(items)
+    buffers = {name: column(size, schema.field(name).type) for name in attributes(schema)}
+    extra = [None] * size
+    for row, item in enumerate(items):
+        rest = None
+        for name, value in item.items():
+            buffer = buffers.get(name)
+            if buffer is None and name in DERIVED:
+                continue
+            if buffer is None or not buffer.set(row, value):
+                rest = rest or {}
+                rest[name] = _DESERIALIZER.deserialize(value)
+        if rest:
+            extra[row] = json.dumps(rest, default=str, sort_keys=True)
+
+    arrays = [buffers[name].array() if name != EXTRA else pa.array(extra, type=pa.string())
+              for name in schema.names]
+    return pa.Table.from_arrays(arrays, schema=schema)
@@ -0,0 +1,224 @@
+"""local snapshot store for analytics queries.
+
+Snapshot downloaded by retrieve.py is converted once into a store directory: one uncompressed Arrow IPC file
+sorted by `added`, memory-mapped on open, and persistent NumPy indexes, memory-mapped as well:
+
+- rows of every value of district, bedrooms and type (rows of a value are sorted),
+- rows ordered by price, for price ranges,
+- `added` of rows: data is sorted by it, date range is a slice of rows.
+
+Queries combine indexed row sets and read only matching rows of requested columns, the table is never loaded:
+
+    store = open_store(retrieve.refresh("apthunt"))
+    query = store.query().where(parsed_district="mission district", parsed_bedrooms=2).last(days=30)
+    query.median("parsed_price"), query.count()
+"""
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import retrieve
+
+DATA = "data.arrow"
+META = "meta.json"
+CATEGORIES = ("parsed_district", "parsed_bedrooms", "parsed_type")
+RANGES = ("parsed_price",)
+ADDED = "added"
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+def column_values(array):
+    """numpy values of arrow array, nulls as None or NaN"""
+    return array.to_numpy(zero_copy_only=False)
+
+
+def build(snapshot, path):
+    """build store in path from snapshot directory. Store is replaced atomically"""
+    table = retrieve.load(snapshot).sort_by(ADDED).combine_chunks()
+    tmp = path + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    with pa.OSFile(os.path.join(tmp, DATA), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    meta = {"snapshot": os.path.abspath(snapshot), "rows": table.num_rows, "built": time.time(),
+            "categories": {}, "ranges": []}
+
+    added = table[ADDED].cast(pa.int64()).fill_null(np.iinfo(np.int64).max)  # nulls are sorted last
+    np.save(os.path.join(tmp, ADDED + ".npy"), column_values(added))
+
+    for name in CATEGORIES:
+        if name not in table.column_names:
+            continue
+        values = column_values(table[name])
+        rows = np.flatnonzero(pc.is_valid(table[name]).to_numpy(zero_copy_only=False))
+        order = np.argsort(values[rows], kind="stable")  # stable: rows of a value stay sorted
+        keys, starts = np.unique(values[rows][order], return_index=True)
+        np.save(os.path.join(tmp, name + ".rows.npy"), rows[order])
+        meta["categories"][name] = {"values": keys.tolist(), "offsets": starts.tolist() + [len(rows)]}
+
+    for name in RANGES:
+        if name not in table.column_names:
+            continue
+        values = column_values(table[name])
+        rows = np.flatnonzero(pc.is_valid(table[name]).to_numpy(zero_copy_only=False))
+        order = np.argsort(values[rows], kind="stable")
+        np.save(os.path.join(tmp, name + ".sorted.npy"), values[rows][order].astype(np.float64))
+        np.save(os.path.join(tmp, name + ".rows.npy"), rows[order])
+        meta["ranges"].append(name)
+
+    with open(os.path.join(tmp, META), "w") as f:
+        json.dump(meta, f, indent=2)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+    print(f"built store {path}: {table.num_rows} rows")
+    return path
+
+
+def intersect(small, big):
+    """values of sorted `small` found in sorted `big`. Reads only log(len(big)) values of big per value"""
+    found = np.searchsorted(big, small)
+    inside = found < len(big)
+    small, found = small[inside], found[inside]
+    return small[big[found] == small]
+
+
+class Store:
+    """memory-mapped store. See `Query`"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META)) as f:
+            self.meta = json.load(f)
+        self.source = pa.memory_map(os.path.join(path, DATA))
+        self.table = pa.ipc.open_file(self.source).read_all()  # zero copy over the mapping
+        self.added = np.load(os.path.join(path, ADDED + ".npy"), mmap_mode="r")
+        self.categories = {}  # column -> ({value: (start, stop)}, rows)
+        for name, index in self.meta["categories"].items():
+            offsets = index["offsets"]
+            bounds = {value: (offsets[i], offsets[i + 1]) for i, value in enumerate(index["values"])}
+            self.categories[name] = (bounds, np.load(os.path.join(path, name + ".rows.npy"), mmap_mode="r"))
+        self.ranges = {  # column -> (sorted values, rows)
+            name: (np.load(os.path.join(path, name + ".sorted.npy"), mmap_mode="r"),
+                   np.load(os.path.join(path, name + ".rows.npy"), mmap_mode="r"))
+            for name in self.meta["ranges"]
+        }
+
+    def __len__(self):
+        return self.table.num_rows
+
+    def category_rows(self, name, value):
+        """sorted rows with the value of indexed column"""
+        bounds, rows = self.categories[name]
+        start, stop = bounds.get(value, (0, 0))
+        return rows[start:stop]
+
+    def query(self):
+        return Query(self)
+
+    def close(self):
+        self.table = None
+        self.source.close()
+
+
+class Query:
+    """filters combined with AND. Methods return the query, so they can be chained"""
+
+    def __init__(self, store):
+        self.store = store
+        self.start, self.stop = 0, len(store)  # rows of `added` range
+        self.sets = []  # sorted row arrays
+
+    def where(self, **equals):
+        """rows with values of indexed columns, see CATEGORIES. Value may be a list of values"""
+        for name, value in equals.items():
+            if name not in self.store.categories:
+                raise ValueError(f"{name} is not indexed, indexed are {sorted(self.store.categories)}")
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            rows = [self.store.category_rows(name, v) for v in values]
+            self.sets.append(rows[0] if len(rows) == 1 else np.sort(np.concatenate(rows)))
+        return self
+
+    def between(self, name, low=None, high=None):
+        """rows with `low <= value <= high` of range indexed column or `added` (unixtime in ms)"""
+        if name == ADDED:
+            added = self.store.added
+            if low is not None:
+                self.start = max(self.start, int(np.searchsorted(added, low, side="left")))
+            if high is not None:
+                self.stop = min(self.stop, int(np.searchsorted(added, high, side="right")))
+            return self
+        if name not in self.store.ranges:
+            raise ValueError(f"{name} is not range indexed, indexed are {sorted(self.store.ranges)} and {ADDED}")
+        values, rows = self.store.ranges[name]
+        start = 0 if low is None else np.searchsorted(values, low, side="left")
+        stop = len(values) if high is None else np.searchsorted(values, high, side="right")
+        self.sets.append(np.sort(rows[start:stop]))
+        return self
+
+    def last(self, days, now=None):
+        """rows added within `days` before now (unixtime in ms)"""
+        now = now if now is not None else time.time() * 1000
+        return self.between(ADDED, low=now - days * DAY_MS)
+
+    def rows(self):
+        """sorted matching rows"""
+        if not self.sets:
+            return np.arange(self.start, self.stop)
+        sets = sorted(self.sets, key=len)
+        rows = np.asarray(sets[0])
+        rows = rows[(rows >= self.start) & (rows < self.stop)]
+        for other in sets[1:]:
+            rows = intersect(rows, other)
+        return rows
+
+    def count(self):
+        return len(self.rows())
+
+    def values(self, name, rows=None):
+        """numpy values of column in matching rows, nulls as NaN or None"""
+        rows = self.rows() if rows is None else rows
+        return column_values(self.store.table[name].take(pa.array(rows, type=pa.int64())))
+
+    def table(self, names=None):
+        """arrow table of matching rows, only `names` columns if given"""
+        table = self.store.table.select(names) if names else self.store.table
+        return table.take(pa.array(self.rows(), type=pa.int64()))
+
+    def percentile(self, name, q, rows=None):
+        """q-th percentile (0..100) of not null numeric column values, NaN if there are none"""
+        values = self.values(name, rows).astype(np.float64)
+        values = values[~np.isnan(values)]
+        return float(np.percentile(values, q)) if len(values) else float("nan")
+
+    def median(self, name):
+        return self.percentile(name, 50)
+
+    def group_by(self, key, name, q=50):
+        """count and q-th percentile of column per value of indexed `key` column within matching rows"""
+        if key not in self.store.categories:
+            raise ValueError(f"{key} is not indexed, indexed are {sorted(self.store.categories)}")
+        rows = self.rows()
+        groups = {}
+        for value in self.store.categories[key][0]:
+            group = intersect(rows, self.store.category_rows(key, value))
+            if len(group):
+                groups[value] = {"count": len(group), "percentile": self.percentile(name, q, group)}
+        return groups
+
+
+def open_store(snapshot, path=None):
+    """open store of snapshot directory, building it if missing or older than the snapshot manifest"""
+    path = path or snapshot.rstrip(os.sep) + ".store"
+    manifest = os.path.join(snapshot, retrieve.MANIFEST)
+    meta = os.path.join(path, META)
+    if not os.path.exists(meta) or os.path.getmtime(meta) < os.path.getmtime(manifest):
+        build(snapshot, path)
+    return Store(path)
@@ -1,94 +1,476 @@
 import concurrent
+import json
+import math
 import os
-import pickle
-import sys
+import shutil
+import time
+from concurrent.futures import FIRST_COMPLETED
 from concurrent.futures.process import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
 
 import boto3
-from boto3.dynamodb import types
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
+import columns
 
-def dynamo2python(deserializer, items):
-    python_data = [
-        {k: deserializer.deserialize(v) for k, v in it.items()}
-        for it in items
-    ]
-    return python_data
+FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+ROWS_PER_FILE = 250000
+MANIFEST = "manifest.json"
+# items are written a bit later than their `added` time. Refresh scan takes items added this much before the
+# watermark, rows seen twice are deduplicated by intid
+OVERLAP_MS = 60 * 60 * 1000
 
+# parallel scan
+SEGMENT_BYTES = 256 * 1024 * 1024  # table size per scan segment
+MIN_SEGMENTS = 4  # small tables are scanned in parallel as well
+MAX_SEGMENTS = 64
+SEGMENT_ATTEMPTS = 5  # failed segment is resumed from its last evaluated key
+THROTTLE_ERRORS = ("ProvisionedThroughputExceededException", "ThrottlingException", "RequestLimitExceeded")
+THROTTLE_RETRIES = 10  # throttled requests in a row before segment attempt fails
 
-def data_retrieve(table, segment=0, total_segments=1, page_size=1000):
-    """download data from table"""
-    client = boto3.client('dynamodb')
-    paginator = client.get_paginator('scan')
-    deserializer = types.TypeDeserializer()
+# table index with `added_day` (UTC date of `added`, written by parser) hash key and `added` range key, all
+# attributes projected. Refresh queries it for new items instead of scanning the table, see `refresh`. The index
+# is created once parser writing `added_day` is deployed, items written before are not in it
+ADDED_INDEX = "added_day-added-index"
 
-    counter = 0
-    items = []
-    for page in paginator.paginate(TableName=table,
-                                   TotalSegments=total_segments,
-                                   Segment=segment,
-                                   PaginationConfig={
-                                       "PageSize": page_size,
-                                   }):
 
-        deserealized = dynamo2python(deserializer, page["Items"])
-        items.extend(deserealized)
+def open_writer(path, fmt, schema=columns.SCHEMA):
+    """parquet or arrow file writer"""
+    if fmt == "parquet":
+        return pq.ParquetWriter(path, schema, compression="zstd")
+    return pa.ipc.new_file(path, schema)
 
-        counter += 1
-        if counter % 100 == 0:
-            print(f"s{segment}. pages: {counter}, items {len(items)}. size {sys.getsizeof(items)}")
 
-    return items
+def read_file(path, names=None):
+    """read parquet or arrow snapshot file, only `names` columns if given"""
+    if path.endswith(FORMATS["parquet"]):
+        return pq.read_table(path, columns=names)
+    with pa.memory_map(path) as source:
+        arrow_table = pa.ipc.open_file(source).read_all()
+    return arrow_table.select(names) if names else arrow_table
 
 
-def parallel_data_retrieve(table, max_workers=4):
-    segments = [i for i in range(max_workers)]
-    items = []
+def read_schema(path):
+    """schema of parquet or arrow snapshot file"""
+    if path.endswith(FORMATS["parquet"]):
+        return pq.read_schema(path)
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).schema
+
+
+def newest_added(table):
+    """max `added` of table rows as unixtime in ms, None for empty table"""
+    return pc.max(table["added"].cast(pa.int64())).as_py()
+
+
+def latest(values):
+    """max of not None values, None if there are none"""
+    values = [v for v in values if v is not None]
+    return max(values) if values else None
+
+
+class SegmentWriter:
+    """writes pages of one scan segment into files of up to `rows_per_file` rows. Every page is a row group"""
+
+    def __init__(self, directory, segment, fmt="parquet", rows_per_file=ROWS_PER_FILE, prefix="", first_file=0,
+                 schema=columns.SCHEMA):
+        self.directory = directory
+        self.segment = segment
+        self.fmt = fmt
+        self.rows_per_file = rows_per_file
+        self.prefix = prefix
+        self.first_file = first_file  # number of the first file, resumed segment continues numbering
+        self.files = []  # manifest entries: {"path": ..., "segment": ..., "rows": ..., "added_max": ...}
+        self.schema = schema
+        self.writer = None
+
+    def open(self):
+        number = self.first_file + len(self.files)
+        name = f"{self.prefix}segment-{self.segment:03d}-{number:05d}{FORMATS[self.fmt]}"
+        self.writer = open_writer(os.path.join(self.directory, name), self.fmt, self.schema)
+        self.files.append({"path": name, "segment": self.segment, "rows": 0, "added_max": None})
+
+    def write(self, table):
+        if self.writer is None or self.files[-1]["rows"] >= self.rows_per_file:
+            self.close()
+            self.open()
+        self.writer.write_table(table)
+        entry = self.files[-1]
+        entry["rows"] += table.num_rows
+        entry["added_max"] = latest([entry["added_max"], newest_added(table)])
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        return self.files
+
+
+class Throttle:
+    """delay between scan requests of a segment. Grows on throttling, shrinks on success"""
+
+    def __init__(self, base=0.1, cap=30.0):
+        self.base = base
+        self.cap = cap
+        self.delay = 0.0
+        self.in_row = 0  # throttled requests in a row
+
+    def wait(self):
+        if self.delay:
+            time.sleep(self.delay)
+
+    def success(self):
+        self.in_row = 0
+        self.delay = self.delay / 2 if self.delay > self.base else 0.0
+
+    def throttled(self):
+        self.in_row += 1
+        self.delay = min(self.cap, max(self.base, self.delay * 2))
+
+
+def segment_count(table):
+    """scan segments for the table: one per SEGMENT_BYTES, but at least MIN_SEGMENTS and one per core"""
+    size = boto3.client('dynamodb').describe_table(TableName=table)["Table"].get("TableSizeBytes", 0)
+    return min(MAX_SEGMENTS, max(MIN_SEGMENTS, os.cpu_count() or 1, math.ceil(size / SEGMENT_BYTES)))
+
+
+def projection_args(schema):
+    """request arguments reading only attributes of the `schema` columns"""
+    attributes = columns.attributes(schema)
+    return {
+        "ProjectionExpression": ", ".join(f"#c{i}" for i in range(len(attributes))),
+        "ExpressionAttributeNames": {f"#c{i}": name for i, name in enumerate(attributes)},
+    }
+
+
+def read_pages(request, args, result, throttle, label):
+    """yield pages of paginated `request` (client scan or query) with `args`, starting after `result["last_key"]`.
+
+    Throttled requests are repeated with growing delay. Stats and last key of a page are added to `result` once
+    the page is consumed, so a page failed to write is read again on resume"""
+    while True:
+        if result["last_key"] is not None:
+            args["ExclusiveStartKey"] = result["last_key"]
+        throttle.wait()
+        try:
+            page = request(**args)
+        except ClientError as exc:
+            if exc.response["Error"]["Code"] not in THROTTLE_ERRORS or throttle.in_row >= THROTTLE_RETRIES:
+                raise
+            throttle.throttled()
+            result["throttled"] += 1
+            continue
+        throttle.success()
+
+        yield page
+        result["items"] += len(page["Items"])
+        result["pages"] += 1
+        result["consumed"] += page.get("ConsumedCapacity", {}).get("CapacityUnits", 0.0)
+        result["last_key"] = page.get("LastEvaluatedKey")
+
+        if result["pages"] % 100 == 0:
+            print(f"{label}. pages: {result['pages']}, items {result['items']}")
+        if result["last_key"] is None:
+            return
+
+
+def data_retrieve(table, directory, segment=0, total_segments=1, page_size=1000, fmt="parquet", since=None,
+                  prefix="", start_key=None, first_file=0, names=None):
+    """download scan segment of table into files in directory, after `start_key` if given.
+
+    only `names` columns (see `columns.select`) and items `added` at or after `since` (unixtime in ms) if given.
+    Throttled requests are repeated with growing delay. Errors are not raised: result has written files,
+    `last_key` to resume from, `done` flag, `error` and stats of the segment"""
+    # throttling is handled here, other errors by resuming the segment
+    client = boto3.client('dynamodb', config=Config(retries={"mode": "standard", "total_max_attempts": 1}))
+    schema = columns.select(names)
+    writer = SegmentWriter(directory, segment, fmt, prefix=prefix, first_file=first_file, schema=schema)
+
+    scan_args = {
+        "TableName": table,
+        "TotalSegments": total_segments,
+        "Segment": segment,
+        "Limit": page_size,
+        "ReturnConsumedCapacity": "TOTAL",
+    }
+    if names:
+        # only attributes of the columns are read and transferred
+        scan_args.update(projection_args(schema))
+    if since is not None:
+        scan_args["FilterExpression"] = "added >= :since"
+        scan_args["ExpressionAttributeValues"] = {":since": {"N": str(since)}}
+
+    result = {"segment": segment, "files": [], "last_key": start_key, "done": False, "error": None,
+              "items": 0, "pages": 0, "consumed": 0.0, "throttled": 0, "seconds": 0.0}
+    start = time.perf_counter()
+    try:
+        for page in read_pages(client.scan, scan_args, result, Throttle(), f"s{segment}"):
+            if page["Items"]:
+                writer.write(columns.decode(page["Items"], schema))
+        result["done"] = True
+    except Exception as exc:
+        result["error"] = repr(exc)
+    finally:
+        result["files"] = writer.close()
+        result["seconds"] = time.perf_counter() - start
+
+    return result
+
+
+def has_added_index(table):
+    """check if table has ADDED_INDEX active and projecting all attributes"""
+    indexes = boto3.client('dynamodb').describe_table(TableName=table)["Table"].get("GlobalSecondaryIndexes", [])
+    return any(index["IndexName"] == ADDED_INDEX and index["IndexStatus"] == "ACTIVE"
+               and index["Projection"]["ProjectionType"] == "ALL" for index in indexes)
+
+
+def added_days(since, until):
+    """`added_day` partitions of ADDED_INDEX holding items added from `since` to `until`, unixtime in ms"""
+    day = datetime.fromtimestamp(since / 1000, timezone.utc).date()
+    last = datetime.fromtimestamp(until / 1000, timezone.utc).date()
+    days = []
+    while day <= last:
+        days.append(day.isoformat())
+        day += timedelta(days=1)
+    return days
+
+
+def index_retrieve(table, directory, since, page_size=1000, fmt="parquet", prefix="", names=None, until=None):
+    """download items `added` at or after `since` (unixtime in ms) from ADDED_INDEX of table into files in directory.
+
+    Every `added_day` partition since then is queried with `added >= since` key condition, so only new items are
+    read and charged. return manifest entries of written files. Errors are raised: nothing is merged, the next
+    refresh reads the same days again"""
+    client = boto3.client('dynamodb', config=Config(retries={"mode": "standard", "total_max_attempts": 1}))
+    schema = columns.select(names)
+    writer = SegmentWriter(directory, 0, fmt, prefix=prefix, schema=schema)
+    throttle = Throttle()
+    result = {"items": 0, "pages": 0, "consumed": 0.0, "throttled": 0}
+    until = until if until is not None else int(time.time() * 1000)
+    start = time.perf_counter()
+    try:
+        for day in added_days(since, until):
+            query_args = {
+                "TableName": table,
+                "IndexName": ADDED_INDEX,
+                "KeyConditionExpression": "added_day = :day AND added >= :since",
+                "ExpressionAttributeValues": {":day": {"S": day}, ":since": {"N": str(since)}},
+                "Limit": page_size,
+                "ReturnConsumedCapacity": "TOTAL",
+            }
+            if names:
+                query_args.update(projection_args(schema))
+            result["last_key"] = None
+            for page in read_pages(client.query, query_args, result, throttle, day):
+                if page["Items"]:
+                    writer.write(columns.decode(page["Items"], schema))
+    finally:
+        files = writer.close()
+    print_scan_report(table, {0: result}, time.perf_counter() - start)
+    return files
+
+
+def print_scan_report(table, states, seconds):
+    items = sum(state["items"] for state in states.values())
+    consumed = sum(state["consumed"] for state in states.values())
+    throttled = sum(state["throttled"] for state in states.values())
+    print(f"scanned {table}: {items} items in {seconds:.1f} s, {items / seconds if seconds else 0:.0f} items/s, "
+          f"{consumed / seconds if seconds else 0:.0f} RCU/s, throttled {throttled} times")
+
+
+def parallel_data_retrieve(table, directory, max_workers=None, fmt="parquet", since=None, prefix="",
+                           total_segments=None, attempts=SEGMENT_ATTEMPTS, names=None):
+    """download table segments in parallel into directory. return manifest entries of written files.
+
+    Segment count is chosen by table size (see `segment_count`), processes by available cores. Failed segment is
+    resumed from its last evaluated key up to `attempts` times. raise RuntimeError if some segment is not done"""
+    total_segments = total_segments or segment_count(table)
+    max_workers = min(total_segments, max_workers or os.cpu_count() or 1)
+    print(f"scanning {table} in {total_segments} segments with {max_workers} processes")
+    states = {sgmt: {"files": [], "last_key": None, "attempts": 0, "items": 0, "consumed": 0.0, "throttled": 0}
+              for sgmt in range(total_segments)}
+    failed = []
+    start = time.perf_counter()
 
     with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        def submit(sgmt):
+            state = states[sgmt]
+            state["attempts"] += 1
+            return executor.submit(data_retrieve, table, directory, segment=sgmt, total_segments=total_segments,
+                                   fmt=fmt, since=since, prefix=prefix, start_key=state["last_key"],
+                                   first_file=len(state["files"]), names=names)
+
         # start the load operation and mark each future with segment number
-        future_to_segment = {
-            executor.submit(data_retrieve, table, segment=sgmt, total_segments=max_workers): sgmt
-            for sgmt in segments
-        }
-
-        for future in concurrent.futures.as_completed(future_to_segment):
-            segment = future_to_segment[future]
-            try:
-                print(f"segment {segment}/{max_workers} completed")
-                records = future.result()
-                items.extend(records)
-            except Exception as exc:
-                fexc = future.exception()
-                print('%r generated an exception: %s. %s' % (segment, exc, fexc))
-
-    return items
-
-
-def maybe_pickle(records, filename, force=False):
-    if os.path.exists(filename) and not force:
-        # You may override by setting force=True.
-        print('%s already present - Skipping pickling.' % filename)
-    else:
-        print('Pickling %s.' % filename)
-        try:
-            with open(filename, 'wb') as f:
-                pickle.dump(records, f, pickle.HIGHEST_PROTOCOL)
-        except Exception as e:
-            print('Unable to save data to', filename, ':', e)
+        future_to_segment = {submit(sgmt): sgmt for sgmt in states}
+
+        while future_to_segment:
+            done, _ = concurrent.futures.wait(future_to_segment, return_when=FIRST_COMPLETED)
+            for future in done:
+                segment = future_to_segment.pop(future)
+                state = states[segment]
+                try:
+                    result = future.result()
+                except Exception as exc:
+                    # worker is lost with its progress, resume from the last known key
+                    result = {"done": False, "error": repr(exc)}
+                else:
+                    state["files"].extend(result["files"])
+                    state["last_key"] = result["last_key"]
+                    for key in ("items", "consumed", "throttled"):
+                        state[key] += result[key]
+
+                if result["done"]:
+                    print(f"segment {segment}/{total_segments} completed: {state['items']} items")
+                elif state["attempts"] < attempts:
+                    print(f"segment {segment}/{total_segments} failed: {result['error']}. Resuming")
+                    future_to_segment[submit(segment)] = segment
+                else:
+                    print(f"segment {segment}/{total_segments} failed {attempts} times: {result['error']}")
+                    failed.append(segment)
+
+    print_scan_report(table, states, time.perf_counter() - start)
+    if failed:
+        raise RuntimeError(f"segments {sorted(failed)} of {table} are not downloaded")
+    return sorted((entry for state in states.values() for entry in state["files"]), key=lambda f: f["path"])
+
+
+def read_manifest(snapshot):
+    with open(os.path.join(snapshot, MANIFEST)) as f:
+        return json.load(f)
+
+
+def write_manifest(snapshot, manifest):
+    """replace manifest atomically"""
+    path = os.path.join(snapshot, MANIFEST)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def snapshot_files(snapshot):
+    """paths of snapshot files from its manifest"""
+    return [os.path.join(snapshot, entry["path"]) for entry in read_manifest(snapshot)["files"]]
 
 
-def maybe_download(table, force=False):
-    storage_file = table + ".pkl"
-    if force or not os.path.exists(storage_file):
-        # records = data_retrieve(table)
-        records = parallel_data_retrieve(table)
-        maybe_pickle(records, storage_file, force)
-    return storage_file
+def load(snapshot, names=None):
+    """load snapshot as arrow table, only `names` columns if given. Use `.to_pandas()` to get data frame"""
+    tables = [read_file(path, names) for path in snapshot_files(snapshot)]
+    if not tables:
+        return columns_schema(names).empty_table()
+    return pa.concat_tables(tables)
+
+
+def columns_schema(names=None):
+    """schema of `names` columns, whole schema if not given"""
+    if not names:
+        return columns.SCHEMA
+    return pa.schema([columns.SCHEMA.field(name) for name in names])
+
+
+def maybe_download(table, force=False, fmt="parquet", names=None):
+    """download table into snapshot directory `<table>.<fmt>` if it does not exist. return the directory.
+
+    only `names` columns are downloaded if given, see `columns.select`. Segments are written into a temporary
+    directory, which replaces the snapshot when all are done. Manifest `indexed` flag tells ADDED_INDEX was active
+    before the scan, so items added after the snapshot are in the index"""
+    snapshot = table + FORMATS[fmt]
+    if force or not os.path.exists(snapshot):
+        tmp = snapshot + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        indexed = has_added_index(table)
+        files = parallel_data_retrieve(table, tmp, fmt=fmt, names=names)
+        write_manifest(tmp, {"table": table, "format": fmt, "columns": sorted(names) if names else None,
+                             "files": files, "indexed": indexed,
+                             "watermark": latest(f["added_max"] for f in files)})
+        shutil.rmtree(snapshot, ignore_errors=True)
+        os.replace(tmp, snapshot)
+    return snapshot
+
+
+def drop_rows(snapshot, entry, intids, name, fmt):
+    """rewrite snapshot file of manifest entry without rows with `intids` into file `name`.
+
+    return new manifest entry or None if no rows left"""
+    arrow_table = read_file(os.path.join(snapshot, entry["path"]))
+    arrow_table = arrow_table.filter(pc.invert(pc.is_in(arrow_table["intid"], value_set=intids)))
+    if arrow_table.num_rows == 0:
+        return None
+    writer = open_writer(os.path.join(snapshot, name), fmt, arrow_table.schema)
+    writer.write_table(arrow_table)
+    writer.close()
+    return dict(entry, path=name, rows=arrow_table.num_rows, added_max=newest_added(arrow_table))
+
+
+def merge(snapshot, manifest, new_files, prefix):
+    """add new files to snapshot. Rows of older files with intids found in new files are dropped.
+
+    Changed files are rewritten under new names, manifest is replaced atomically, then replaced files removed"""
+    if not new_files:
+        print("no new rows")
+        return
+    intids = pa.concat_arrays([
+        chunk for entry in new_files
+        for chunk in read_file(os.path.join(snapshot, entry["path"]), ["intid"])["intid"].chunks
+    ])
+
+    files, replaced = [], []
+    for number, entry in enumerate(manifest["files"]):
+        path = os.path.join(snapshot, entry["path"])
+        if not pc.any(pc.is_in(read_file(path, ["intid"])["intid"], value_set=intids)).as_py():
+            files.append(entry)
+            continue
+        fmt = manifest["format"]
+        merged = drop_rows(snapshot, entry, intids, f"{prefix}merged-{number:05d}{FORMATS[fmt]}", fmt)
+        if merged is not None:
+            files.append(merged)
+        replaced.append(path)
+
+    files.extend(new_files)
+    watermark = latest([manifest.get("watermark")] + [f["added_max"] for f in new_files])
+    write_manifest(snapshot, dict(manifest, files=files, watermark=watermark))
+    for path in replaced:
+        os.remove(path)
+    print(f"merged {sum(f['rows'] for f in new_files)} rows, rewrote {len(replaced)} files")
+
+
+def refresh(table, fmt="parquet", names=None):
+    """download items added since the snapshot watermark and merge them into the snapshot.
+
+    New items are queried from ADDED_INDEX day by day, read capacity is proportional to new items only. The index
+    is used if the snapshot is `indexed` (see `maybe_download`) and the index is still active. Otherwise the whole
+    table is scanned with a FilterExpression: DynamoDB reads and charges RCU for every item, only newer items are
+    transferred, decoded and written. Snapshot is downloaded fully if it does not exist or has other columns or
+    column types. return the snapshot directory"""
+    snapshot = table + FORMATS[fmt]
+    if not os.path.exists(os.path.join(snapshot, MANIFEST)):
+        return maybe_download(table, force=True, fmt=fmt, names=names)
+
+    manifest = read_manifest(snapshot)
+    if manifest.get("watermark") is None or manifest.get("columns") != (sorted(names) if names else None):
+        return maybe_download(table, force=True, fmt=fmt, names=names)
+    files = snapshot_files(snapshot)
+    if files and not read_schema(files[0]).equals(columns.select(names)):
+        print(f"{snapshot} has outdated column types, downloading again")
+        return maybe_download(table, force=True, fmt=fmt, names=names)
+    since = manifest["watermark"] - OVERLAP_MS
+    prefix = datetime.utcnow().strftime("inc-%Y%m%dT%H%M%S%f-")
+    if manifest.get("indexed") and has_added_index(table):
+        print(f"querying {ADDED_INDEX} of {table} for items added since {since}")
+        new_files = index_retrieve(table, snapshot, since, fmt=fmt, prefix=prefix, names=names)
+    else:
+        print(f"scanning whole {table} for items added since {since}")
+        new_files = parallel_data_retrieve(table, snapshot, fmt=fmt, since=since, prefix=prefix, names=names)
+    merge(snapshot, manifest, new_files, prefix)
+    return snapshot
 
 
 if __name__ == "__main__":
-    data_file = maybe_download("apthunt", force=True)
+    data_file = refresh("apthunt")
     print("loading back")
-    data = pickle.load(open(data_file, 'rb'))
-    print(len(data))
+    data = load(data_file)
+    print(data.num_rows)
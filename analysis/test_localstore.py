@@ -0,0 +1,91 @@
+import os
+import tempfile
+import time
+import unittest
+
+try:
+    import numpy as np
+
+    import localstore
+    from test_retrieve import DAY_MS, item, write_snapshot
+except ImportError:  # pyarrow is not installed
+    localstore = None
+
+NOW = 10 * 24 * 60 * 60 * 1000
+
+
+def postings():
+    """items added one a day: even ones in mission district, 2br from the 6th, price growing by 100"""
+    return [item(n, added=n * DAY_MS, price=1000 + 100 * n, district="mission district" if n % 2 == 0 else "soma",
+                 bedrooms=1 if n < 5 else 2, kind="loft" if n == 9 else "apartment")
+            for n in range(10)]
+
+
+@unittest.skipUnless(localstore, "pyarrow is not installed")
+class TestLocalStore(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.snapshot = os.path.join(tmp.name, "apthunt.parquet")
+        # pages are written in reverse: store sorts rows by added
+        items = postings()[::-1]
+        write_snapshot(self.snapshot, [items[:5], items[5:]], rows_per_file=5)
+        self.path = os.path.join(tmp.name, "apthunt.store")
+        self.store = localstore.open_store(self.snapshot, self.path)
+        self.addCleanup(self.store.close)
+
+    def test_built(self):
+        for name in ("data.arrow", "meta.json", "added.npy", "parsed_district.rows.npy", "parsed_bedrooms.rows.npy",
+                     "parsed_type.rows.npy", "parsed_price.sorted.npy", "parsed_price.rows.npy"):
+            self.assertTrue(os.path.exists(os.path.join(self.path, name)), name)
+        self.assertEqual(len(self.store), 10)
+        self.assertIsInstance(self.store.added, np.memmap)
+        self.assertEqual(list(self.store.added), [n * DAY_MS for n in range(10)])
+
+    def check_queries(self, store):
+        query = store.query().where(parsed_district="mission district", parsed_bedrooms=2)
+        self.assertEqual(query.count(), 2)
+        self.assertEqual(query.median("parsed_price"), 1700)
+        self.assertEqual(store.query().where(parsed_type=["loft", "apartment"]).count(), 10)
+        self.assertEqual(store.query().where(parsed_district="unknown").count(), 0)
+        self.assertEqual(store.query().between("parsed_price", 1200, 1500).count(), 4)
+        self.assertEqual(list(store.query().last(days=3, now=NOW).values("intid")), ["id7", "id8", "id9"])
+        recent_lofts = store.query().where(parsed_type="loft").last(days=3, now=NOW)
+        self.assertEqual(recent_lofts.table(["intid", "parsed_price"]).to_pylist(),
+                         [{"intid": "id9", "parsed_price": 1900.0}])
+        self.assertEqual(store.query().where(parsed_bedrooms=1).percentile("parsed_price", 100), 1400)
+        self.assertEqual(store.query().where(parsed_bedrooms=1).group_by("parsed_district", "parsed_price"), {
+            "mission district": {"count": 3, "percentile": 1200.0},
+            "soma": {"count": 2, "percentile": 1200.0},
+        })
+
+    def test_queries(self):
+        self.check_queries(self.store)
+
+    def test_reopen(self):
+        store = localstore.Store(self.path)
+        self.addCleanup(store.close)
+        self.check_queries(store)
+
+    def test_not_indexed(self):
+        with self.assertRaises(ValueError):
+            self.store.query().where(PostUrl="https://sfbay.craigslist.org/apa/d/1.html")
+        with self.assertRaises(ValueError):
+            self.store.query().between("parsed_area", 100, 200)
+
+    def test_rebuilt_after_refresh(self):
+        built = self.store.meta["built"]
+        store = localstore.open_store(self.snapshot, self.path)
+        self.addCleanup(store.close)
+        self.assertEqual(store.meta["built"], built)
+
+        # snapshot is refreshed after the store was built
+        earlier = time.time() - 60
+        os.utime(os.path.join(self.path, "meta.json"), (earlier, earlier))
+        store = localstore.open_store(self.snapshot, self.path)
+        self.addCleanup(store.close)
+        self.assertGreater(store.meta["built"], built)
+
+
+if __name__ == '__main__':
+    unittest.main()
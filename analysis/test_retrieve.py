@@ -0,0 +1,359 @@
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from unittest import mock
+
+from botocore.exceptions import ClientError
+
+try:
+    import pyarrow as pa
+
+    import columns
+    import retrieve
+except ImportError:  # pyarrow is not installed
+    pa = None
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+def item(number, added, price=3000, district="mission district", bedrooms=2, kind="apartment"):
+    """low-level DynamoDB item of a posting"""
+    return {
+        "intid": {"S": f"id{number}"},
+        "PostUrl": {"S": f"https://sfbay.craigslist.org/apa/d/{number}.html"},
+        "added": {"N": str(added)},
+        "added_day": {"S": datetime.fromtimestamp(added / 1000, timezone.utc).date().isoformat()},
+        "parsed_price": {"N": str(price)},
+        "parsed_district": {"S": district},
+        "parsed_bedrooms": {"N": str(bedrooms)},
+        "parsed_type": {"S": kind},
+    }
+
+
+def write_snapshot(snapshot, pages, fmt="parquet", rows_per_file=None):
+    """write pages of items as segment 0 of snapshot with manifest. return manifest"""
+    os.makedirs(snapshot, exist_ok=True)
+    writer = retrieve.SegmentWriter(snapshot, 0, fmt, rows_per_file=rows_per_file or retrieve.ROWS_PER_FILE)
+    for page in pages:
+        writer.write(columns.decode(page))
+    files = writer.close()
+    manifest = {"table": "apthunt", "format": fmt, "columns": None, "files": files,
+                "watermark": retrieve.latest(f["added_max"] for f in files)}
+    retrieve.write_manifest(snapshot, manifest)
+    return manifest
+
+
+def client_error(code):
+    return ClientError({"Error": {"Code": code, "Message": code}}, "Scan")
+
+
+class FakeDynamo:
+    """DynamoDB client stub scanning `items` by `Limit`, at most `page_size` (1 MB limit), and querying them by
+    `added_day` and `added` if `indexed`. Scan and query calls with numbers in `errors` raise the error"""
+
+    def __init__(self, items, errors=None, size=0, page_size=3, indexed=False):
+        self.items = items
+        self.page_size = page_size
+        self.errors = errors or {}  # call number -> error code
+        self.size = size
+        self.indexed = indexed
+        self.calls = []
+
+    def describe_table(self, TableName):  # pylint: disable=invalid-name
+        table = {"TableName": TableName, "TableSizeBytes": self.size}
+        if self.indexed:
+            table["GlobalSecondaryIndexes"] = [{"IndexName": retrieve.ADDED_INDEX, "IndexStatus": "ACTIVE",
+                                                "Projection": {"ProjectionType": "ALL"}}]
+        return {"Table": table}
+
+    def page(self, items, kwargs):
+        self.calls.append(kwargs)
+        if len(self.calls) in self.errors:
+            raise client_error(self.errors[len(self.calls)])
+        start = 0
+        if "ExclusiveStartKey" in kwargs:
+            keys = [i["intid"] for i in items]
+            start = keys.index(kwargs["ExclusiveStartKey"]["intid"]) + 1
+        limit = min(kwargs["Limit"], self.page_size)
+        page = items[start:start + limit]
+        resp = {"Items": page, "Count": len(page), "ConsumedCapacity": {"CapacityUnits": 0.5 * len(page)}}
+        if start + limit < len(items):
+            resp["LastEvaluatedKey"] = {"intid": page[-1]["intid"]}
+        return resp
+
+    def scan(self, **kwargs):
+        return self.page(self.items, kwargs)
+
+    def query(self, **kwargs):
+        assert self.indexed and kwargs["IndexName"] == retrieve.ADDED_INDEX
+        values = kwargs["ExpressionAttributeValues"]
+        found = [i for i in self.items
+                 if i["added_day"] == values[":day"] and int(i["added"]["N"]) >= int(values[":since"]["N"])]
+        return self.page(sorted(found, key=lambda i: int(i["added"]["N"])), kwargs)
+
+
+@unittest.skipUnless(pa, "pyarrow is not installed")
+class TestSegmentWriter(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = tmp.name
+
+    def test_round_trip(self):
+        pages = [[item(page * 3 + i, added=(page * 3 + i) * DAY_MS) for i in range(3)] for page in range(3)]
+        for fmt in retrieve.FORMATS:
+            with self.subTest(fmt=fmt):
+                snapshot = os.path.join(self.directory, "apthunt" + retrieve.FORMATS[fmt])
+                manifest = write_snapshot(snapshot, pages, fmt, rows_per_file=4)
+
+                # a page is never split: the first file gets 2 pages
+                self.assertEqual([(f["path"], f["rows"]) for f in manifest["files"]], [
+                    ("segment-000-00000" + retrieve.FORMATS[fmt], 6),
+                    ("segment-000-00001" + retrieve.FORMATS[fmt], 3),
+                ])
+                self.assertEqual([f["added_max"] for f in manifest["files"]], [5 * DAY_MS, 8 * DAY_MS])
+                self.assertEqual(manifest["watermark"], 8 * DAY_MS)
+
+                table = retrieve.load(snapshot)
+                self.assertEqual(table.schema, columns.SCHEMA)
+                self.assertEqual(table["intid"].to_pylist(), [f"id{n}" for n in range(9)])
+                self.assertEqual(table["parsed_district"].to_pylist(), ["mission district"] * 9)
+                self.assertEqual(retrieve.load(snapshot, ["intid", "parsed_price"]).column_names,
+                                 ["intid", "parsed_price"])
+
+    def test_resumed_numbering(self):
+        writer = retrieve.SegmentWriter(self.directory, 7, "arrow", prefix="inc-", first_file=2)
+        writer.write(columns.decode([item(1, added=DAY_MS)]))
+        files = writer.close()
+        self.assertEqual(files, [{"path": "inc-segment-007-00002.arrow", "segment": 7, "rows": 1,
+                                  "added_max": DAY_MS}])
+        self.assertEqual(retrieve.read_file(os.path.join(self.directory, files[0]["path"])).num_rows, 1)
+
+    def test_empty(self):
+        snapshot = os.path.join(self.directory, "apthunt.parquet")
+        write_snapshot(snapshot, [])
+        self.assertEqual(retrieve.load(snapshot).num_rows, 0)
+        self.assertEqual(retrieve.load(snapshot, ["intid"]).column_names, ["intid"])
+
+
+@unittest.skipUnless(pa, "pyarrow is not installed")
+class TestMerge(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.snapshot = os.path.join(tmp.name, "apthunt.parquet")
+        pages = [[item(0, added=0), item(1, added=DAY_MS)], [item(2, added=2 * DAY_MS), item(3, added=3 * DAY_MS)]]
+        self.manifest = write_snapshot(self.snapshot, pages, rows_per_file=2)
+
+    def new_files(self, items, prefix="inc-1-"):
+        writer = retrieve.SegmentWriter(self.snapshot, 0, "parquet", prefix=prefix)
+        writer.write(columns.decode(items))
+        return writer.close()
+
+    def test_dedup_newest_wins(self):
+        # overlap reads id1 again, the snapshot copy is dropped for the new one
+        new_files = self.new_files([item(1, added=DAY_MS, price=2500), item(4, added=4 * DAY_MS)])
+        retrieve.merge(self.snapshot, self.manifest, new_files, "inc-1-")
+
+        manifest = retrieve.read_manifest(self.snapshot)
+        self.assertEqual([f["path"] for f in manifest["files"]],
+                         ["inc-1-merged-00000.parquet", "segment-000-00001.parquet", "inc-1-segment-000-00000.parquet"])
+        self.assertEqual(manifest["watermark"], 4 * DAY_MS)
+        self.assertFalse(os.path.exists(os.path.join(self.snapshot, "segment-000-00000.parquet")))
+
+        table = retrieve.load(self.snapshot).sort_by("intid")
+        self.assertEqual(table["intid"].to_pylist(), ["id0", "id1", "id2", "id3", "id4"])
+        self.assertEqual(table["parsed_price"].to_pylist(), [3000, 2500, 3000, 3000, 3000])
+
+    def test_file_emptied(self):
+        new_files = self.new_files([item(0, added=0), item(1, added=DAY_MS)])
+        retrieve.merge(self.snapshot, self.manifest, new_files, "inc-1-")
+        manifest = retrieve.read_manifest(self.snapshot)
+        self.assertEqual([f["path"] for f in manifest["files"]],
+                         ["segment-000-00001.parquet", "inc-1-segment-000-00000.parquet"])
+        self.assertEqual(retrieve.load(self.snapshot).num_rows, 4)
+
+    def test_no_new_rows(self):
+        retrieve.merge(self.snapshot, self.manifest, [], "inc-1-")
+        self.assertEqual(retrieve.read_manifest(self.snapshot), self.manifest)
+
+
+@unittest.skipUnless(pa, "pyarrow is not installed")
+class TestScan(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = tmp.name
+        self.items = [item(n, added=n * DAY_MS) for n in range(10)]
+        sleep = mock.patch("time.sleep")
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def scan(self, client, **kwargs):
+        with mock.patch("retrieve.boto3.client", return_value=client):
+            return retrieve.data_retrieve("apthunt", self.directory, **kwargs)
+
+    def intids(self, files):
+        return sorted(intid for f in files
+                      for intid in retrieve.read_file(os.path.join(self.directory, f["path"]))["intid"].to_pylist())
+
+    def test_segment_count(self):
+        cases = [(0, 2, 4), (0, 8, 8), (10 * retrieve.SEGMENT_BYTES, 2, 10), (1000 * retrieve.SEGMENT_BYTES, 8, 64)]
+        for size, cores, expected in cases:
+            with self.subTest(size=size, cores=cores), mock.patch("os.cpu_count", return_value=cores), \
+                    mock.patch("retrieve.boto3.client", return_value=FakeDynamo([], size=size)):
+                self.assertEqual(retrieve.segment_count("apthunt"), expected)
+
+    def test_throttle(self):
+        throttle = retrieve.Throttle(base=0.1, cap=0.5)
+        delays = []
+        for _ in range(4):
+            throttle.throttled()
+            delays.append(throttle.delay)
+        self.assertEqual(delays, [0.1, 0.2, 0.4, 0.5])
+        self.assertEqual(throttle.in_row, 4)
+        throttle.success()
+        self.assertEqual((throttle.delay, throttle.in_row), (0.25, 0))
+        throttle.success()
+        throttle.success()
+        self.assertEqual(throttle.delay, 0.0625)
+        throttle.success()  # below base
+        self.assertEqual(throttle.delay, 0.0)
+
+    def test_throttled_retried(self):
+        client = FakeDynamo(self.items, errors={2: "ProvisionedThroughputExceededException", 3: "ThrottlingException"})
+        result = self.scan(client)
+        self.assertTrue(result["done"], result["error"])
+        self.assertEqual((result["items"], result["pages"], result["throttled"]), (10, 4, 2))
+        self.assertEqual(self.intids(result["files"]), sorted(f"id{n}" for n in range(10)))
+        self.assertEqual([c.args[0] for c in self.sleep.call_args_list], [0.1, 0.2, 0.1])
+
+    def test_too_many_throttled(self):
+        errors = {n: "ThrottlingException" for n in range(2, 3 + retrieve.THROTTLE_RETRIES)}
+        result = self.scan(FakeDynamo(self.items, errors=errors))
+        self.assertFalse(result["done"])
+        self.assertIn("ThrottlingException", result["error"])
+
+    def test_resume(self):
+        result = self.scan(FakeDynamo(self.items, errors={3: "InternalServerError"}))
+        self.assertFalse(result["done"])
+        self.assertIn("InternalServerError", result["error"])
+        self.assertEqual(result["last_key"], {"intid": {"S": "id5"}})
+        self.assertEqual(result["items"], 6)
+
+        client = FakeDynamo(self.items)
+        resumed = self.scan(client, start_key=result["last_key"], first_file=len(result["files"]))
+        self.assertTrue(resumed["done"])
+        self.assertEqual(client.calls[0]["ExclusiveStartKey"], {"intid": {"S": "id5"}})
+        self.assertEqual(resumed["files"][0]["path"], "segment-000-00001.parquet")
+        self.assertEqual(self.intids(result["files"] + resumed["files"]), sorted(f"id{n}" for n in range(10)))
+
+    def test_parallel_resume(self):
+        client = FakeDynamo(self.items, errors={2: "InternalServerError", 4: "InternalServerError"})
+        with mock.patch("retrieve.ProcessPoolExecutor", ThreadPoolExecutor), \
+                mock.patch("retrieve.boto3.client", return_value=client):
+            files = retrieve.parallel_data_retrieve("apthunt", self.directory, total_segments=1)
+        self.assertEqual(self.intids(files), sorted(f"id{n}" for n in range(10)))
+        self.assertEqual(len(files), 3)  # a file per attempt
+
+    def test_projection(self):
+        client = FakeDynamo(self.items)
+        result = self.scan(client, names=["parsed_price"])
+        self.assertTrue(result["done"])
+        scan_args = client.calls[0]
+        names = scan_args["ExpressionAttributeNames"]
+        projected = [names[name] for name in scan_args["ProjectionExpression"].split(", ")]
+        self.assertEqual(sorted(projected), ["added", "intid", "parsed_price"])
+        table = retrieve.read_file(os.path.join(self.directory, result["files"][0]["path"]))
+        self.assertEqual(table.column_names, ["intid", "added", "parsed_price", "extra"])
+        self.assertEqual(table.schema.field("parsed_price").type, pa.float64())
+
+    def test_refresh_outdated_types(self):
+        snapshot = os.path.join(self.directory, "apthunt.parquet")
+        old = columns.decode([item(0, added=0)])
+        old = old.cast(old.schema.set(old.schema.get_field_index("parsed_price"), pa.field("parsed_price", pa.int64())))
+        os.makedirs(snapshot)
+        writer = retrieve.open_writer(os.path.join(snapshot, "segment-000-00000.parquet"), "parquet", old.schema)
+        writer.write_table(old)
+        writer.close()
+        retrieve.write_manifest(snapshot, {"table": "apthunt", "format": "parquet", "columns": None, "watermark": 0,
+                                           "files": [{"path": "segment-000-00000.parquet", "segment": 0, "rows": 1,
+                                                      "added_max": 0}]})
+
+        client = FakeDynamo(self.items)
+        with mock.patch("retrieve.ProcessPoolExecutor", ThreadPoolExecutor), \
+                mock.patch("retrieve.boto3.client", return_value=client), mock.patch("os.cpu_count", return_value=1):
+            cwd = os.getcwd()
+            os.chdir(self.directory)
+            try:
+                retrieve.refresh("apthunt")
+            finally:
+                os.chdir(cwd)
+        # downloaded again, not refreshed with a filtered scan
+        self.assertNotIn("FilterExpression", client.calls[0])
+        table = retrieve.load(snapshot)
+        self.assertEqual(table.schema.field("parsed_price").type, pa.float64())
+
+    def test_added_days(self):
+        self.assertEqual(retrieve.added_days(DAY_MS - 1, 2 * DAY_MS), ["1970-01-01", "1970-01-02", "1970-01-03"])
+        self.assertEqual(retrieve.added_days(DAY_MS, DAY_MS), ["1970-01-02"])
+
+    def test_index_retrieve(self):
+        client = FakeDynamo(self.items + [item(10, added=8 * DAY_MS + 1)], indexed=True, page_size=1)
+        with mock.patch("retrieve.boto3.client", return_value=client):
+            files = retrieve.index_retrieve("apthunt", self.directory, since=7 * DAY_MS, until=9 * DAY_MS + 5)
+        self.assertEqual(self.intids(files), ["id10", "id7", "id8", "id9"])
+        # queries of every day, the second day has two pages. Only new items are read
+        self.assertEqual([c["ExpressionAttributeValues"][":day"]["S"] for c in client.calls],
+                         ["1970-01-08", "1970-01-09", "1970-01-09", "1970-01-10"])
+        self.assertEqual(client.calls[2]["ExclusiveStartKey"], {"intid": {"S": "id8"}})
+        self.assertNotIn("ExclusiveStartKey", client.calls[3])
+        table = retrieve.read_file(os.path.join(self.directory, files[0]["path"]))
+        self.assertEqual(table["extra"].to_pylist(), [None] * 4)  # added_day is not exported
+
+    def refresh(self, client, now):
+        with mock.patch("retrieve.ProcessPoolExecutor", ThreadPoolExecutor), \
+                mock.patch("retrieve.boto3.client", return_value=client), \
+                mock.patch("retrieve.segment_count", return_value=1), \
+                mock.patch("retrieve.time.time", return_value=now / 1000):
+            cwd = os.getcwd()
+            os.chdir(self.directory)
+            try:
+                return retrieve.refresh("apthunt")
+            finally:
+                os.chdir(cwd)
+
+    def test_refresh_queries_index(self):
+        client = FakeDynamo(self.items[:6], indexed=True)
+        snapshot = os.path.join(self.directory, self.refresh(client, now=6 * DAY_MS))
+        self.assertTrue(retrieve.read_manifest(snapshot)["indexed"])
+
+        client = FakeDynamo(self.items, indexed=True)
+        self.refresh(client, now=10 * DAY_MS)
+        self.assertEqual({c.get("IndexName") for c in client.calls}, {retrieve.ADDED_INDEX})
+        self.assertEqual(sorted(retrieve.load(snapshot)["intid"].to_pylist()), sorted(f"id{n}" for n in range(10)))
+        self.assertEqual(retrieve.read_manifest(snapshot)["watermark"], 9 * DAY_MS)
+
+    def test_refresh_scans_without_index(self):
+        # snapshot downloaded before the index was created: older items may be missing from the index
+        snapshot = os.path.join(self.directory, self.refresh(FakeDynamo(self.items[:6]), now=6 * DAY_MS))
+        self.assertFalse(retrieve.read_manifest(snapshot)["indexed"])
+
+        client = FakeDynamo(self.items, indexed=True)
+        self.refresh(client, now=10 * DAY_MS)
+        self.assertNotIn("IndexName", client.calls[0])
+        self.assertEqual(client.calls[0]["FilterExpression"], "added >= :since")
+        self.assertEqual(sorted(retrieve.load(snapshot)["intid"].to_pylist()), sorted(f"id{n}" for n in range(10)))
+
+    def test_parallel_failed(self):
+        errors = {n: "InternalServerError" for n in range(1, 100)}
+        with mock.patch("retrieve.ProcessPoolExecutor", ThreadPoolExecutor), \
+                mock.patch("retrieve.boto3.client", return_value=FakeDynamo(self.items, errors=errors)), \
+                self.assertRaisesRegex(RuntimeError, r"segments \[0\]"):
+            retrieve.parallel_data_retrieve("apthunt", self.directory, total_segments=1, attempts=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
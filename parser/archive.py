@@ -0,0 +1,176 @@
+"""content-addressed archive of raw pages.
+
+Pages are stored gzip-compressed under `pages/<url hash>/<content hash>.html.gz`, next to
+`pages/<url hash>/<content hash>.json` with the url and fetch time. Same content of the same url is stored once.
+Archive location is set by PAGE_ARCHIVE environment variable:
+
+* `file:///path/to/dir` or `/path/to/dir` - local directory.
+* `s3://bucket/prefix` - S3 bucket. PAGE_ARCHIVE_ENDPOINT sets endpoint for S3 compatible storage.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Dict, Iterator, NamedTuple, Optional
+from urllib.parse import urlparse
+
+LOGGER = logging.getLogger(__name__)
+
+PAGES_PREFIX = "pages/"
+
+
+class ArchiveEntry(NamedTuple):
+    """archived page version"""
+    url: str
+    content_hash: str
+    fetched: int  # unixtime in ms
+
+
+class LocalBackend:
+    """archive storage in local directory"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def put(self, key, data: bytes):
+        """store data under the key"""
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as out:
+            out.write(data)
+        os.replace(tmp_path, path)  # readers never see partial files
+
+    def get(self, key) -> bytes:
+        """return data stored under the key"""
+        with open(os.path.join(self.root, key), "rb") as data:
+            return data.read()
+
+    def exists(self, key) -> bool:
+        """check if key exists"""
+        return os.path.exists(os.path.join(self.root, key))
+
+    def keys(self, prefix="") -> Iterator[str]:
+        """iterate over all keys starting with prefix"""
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                key = os.path.relpath(os.path.join(dirpath, filename), self.root).replace(os.sep, "/")
+                if key.startswith(prefix) and not key.endswith(".tmp"):
+                    yield key
+
+
+class S3Backend:
+    """archive storage in S3 (or S3 compatible) bucket"""
+
+    def __init__(self, bucket, prefix="", client=None, endpoint_url=None):
+        if client is None:
+            import boto3  # pylint: disable=import-outside-toplevel
+            client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+
+    def put(self, key, data: bytes):
+        """store data under the key"""
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data)
+
+    def get(self, key) -> bytes:
+        """return data stored under the key"""
+        return self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)["Body"].read()
+
+    def exists(self, key) -> bool:
+        """check if key exists"""
+        resp = self.client.list_objects_v2(Bucket=self.bucket, Prefix=self.prefix + key, MaxKeys=1)
+        return any(obj["Key"] == self.prefix + key for obj in resp.get("Contents", []))
+
+    def keys(self, prefix="") -> Iterator[str]:
+        """iterate over all keys starting with prefix"""
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + prefix):
+            for obj in page.get("Contents", []):
+                yield obj["Key"][len(self.prefix):]
+
+
+def url_hash(url) -> str:
+    """hash of the page url"""
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+def content_hash(content: bytes) -> str:
+    """hash of the page content"""
+    return hashlib.sha256(content).hexdigest()
+
+
+class PageArchive:
+    """content-addressed archive of raw pages"""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @staticmethod
+    def page_key(url, chash) -> str:
+        """key of the page content"""
+        return "{}{}/{}.html.gz".format(PAGES_PREFIX, url_hash(url), chash)
+
+    @staticmethod
+    def meta_key(url, chash) -> str:
+        """key of the page metadata"""
+        return "{}{}/{}.json".format(PAGES_PREFIX, url_hash(url), chash)
+
+    def store(self, url, content: bytes, fetched=None) -> str:
+        """store page content. return content hash. Does nothing if same content of the url already stored"""
+        chash = content_hash(content)
+        meta_key = self.meta_key(url, chash)
+        if self.backend.exists(meta_key):
+            return chash
+
+        fetched = fetched if fetched is not None else int(time.time() * 1000)
+        self.backend.put(self.page_key(url, chash), gzip.compress(content))
+        # metadata is written last: entry is listed only when content is stored
+        meta = {"url": url, "content_hash": chash, "fetched": fetched}
+        self.backend.put(meta_key, json.dumps(meta).encode("utf-8"))
+        return chash
+
+    def safe_store(self, url, content: bytes) -> Optional[str]:
+        """store page content. Log and ignore errors: archive must not break parsing"""
+        try:
+            return self.store(url, content)
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.warning("failed to archive page %s", url, exc_info=True)
+            return None
+
+    def entries(self) -> Iterator[ArchiveEntry]:
+        """iterate over all archived page versions"""
+        for key in self.backend.keys(PAGES_PREFIX):
+            if key.endswith(".json"):
+                meta = json.loads(self.backend.get(key))
+                yield ArchiveEntry(meta["url"], meta["content_hash"], meta["fetched"])
+
+    def load(self, entry: ArchiveEntry) -> bytes:
+        """return raw content of archived page"""
+        return gzip.decompress(self.backend.get(self.page_key(entry.url, entry.content_hash)))
+
+
+def open_archive(location) -> PageArchive:
+    """open archive by location. See module docstring for supported locations"""
+    parsed = urlparse(location)
+    if parsed.scheme == "s3":
+        return PageArchive(S3Backend(parsed.netloc, parsed.path, endpoint_url=os.getenv("PAGE_ARCHIVE_ENDPOINT")))
+    if parsed.scheme in ("", "file"):
+        return PageArchive(LocalBackend(parsed.path))
+    raise ValueError("unsupported archive location '{}'".format(location))
+
+
+_ARCHIVES: Dict[str, PageArchive] = {}
+
+
+def get_archive() -> Optional[PageArchive]:
+    """return archive configured by PAGE_ARCHIVE or None if archiving disabled"""
+    location = os.getenv("PAGE_ARCHIVE")
+    if not location:
+        return None
+    if location not in _ARCHIVES:
+        _ARCHIVES[location] = open_archive(location)
+    return _ARCHIVES[location]
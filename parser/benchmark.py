@@ -0,0 +1,258 @@
+"""offline parser benchmark.
+
+Runs saved pages (see testpages/) through `clparser.parse_page` with `get_page` stubbed, so no network is used.
+Reports per page and per field extraction time, peak memory and throughput.
+With `--intid` compares `handler.generate_id` with the legacy deepcopy + `get_md5` id on items of the pages.
+
+    pipenv run python benchmark.py [--engine lxml] [--repeat 20] [--max-page-ms 50] [page.html ...]
+    pipenv run python benchmark.py --intid [--repeat 20]
+"""
+import argparse
+import copy
+import functools
+import glob
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Dict, List, NamedTuple
+from unittest import mock
+
+from aws_xray_sdk import global_sdk_config  # type: ignore
+
+import clparser
+
+TESTPAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "testpages")
+
+# selector chains used to extract each field, starting from the posting `.body` element.
+# the last element of the chain holds the field value.
+FIELDS = {
+    "postingtitletext": (".postingtitle", ".postingtitletext"),
+    "price": (".postingtitle", ".postingtitletext", ".price"),
+    "housing": (".postingtitle", ".postingtitletext", ".housing"),
+    "titletextonly": (".postingtitle", ".postingtitletext", "#titletextonly"),
+    "district": (".postingtitle", ".postingtitletext", "small"),
+    "thumbs": (".userbody", "#thumbs", "a"),
+    "map": (".userbody", ".mapAndAttrs", "#map"),
+    "map_address": (".userbody", ".mapAndAttrs", ".mapaddress"),
+    "map_link": (".userbody", ".mapAndAttrs", "p.mapaddress", "a"),
+    "attrs": (".userbody", ".mapAndAttrs", "p.attrgroup"),
+    "postingbody": (".userbody", "section#postingbody"),
+    "notices": (".userbody", "ul.notices"),
+}
+
+
+class PageStats(NamedTuple):
+    """timings for one page, seconds"""
+    name: str
+    mean: float
+    best: float
+    removed: bool
+
+
+class Report(NamedTuple):
+    """benchmark results for one engine"""
+    engine: str
+    pages: List[PageStats]
+    fields: Dict[str, float]  # mean field extraction time over pages, seconds
+    peak_memory: int  # bytes
+    throughput: float  # pages per second
+
+
+def load_pages(paths):
+    """read pages content. return dict name -> bytes"""
+    pages = {}
+    for path in paths:
+        with open(path, "rb") as page:
+            pages[os.path.basename(path)] = page.read()
+    return pages
+
+
+def stub_get_page(content, page_url, engine=None):
+    """replacement for clparser.get_page serving preloaded content"""
+    return clparser.load_page(content, page_url, engine=engine)
+
+
+def parse_once(name, content, engine):
+    """parse page once with get_page stubbed. return True if post is removed"""
+    with mock.patch("clparser.get_page", functools.partial(stub_get_page, content)):
+        try:
+            clparser.parse_page("https://localhost/" + name, engine=engine)
+        except clparser.PostRemovedException:
+            return True
+    return False
+
+
+@functools.lru_cache(maxsize=None)
+def lxml_selector(selector):
+    """compiled css selector for lxml engine"""
+    from lxml.cssselect import CSSSelector  # type: ignore # pylint: disable=import-outside-toplevel
+    return CSSSelector(selector, translator="html")
+
+
+def extract_field(post_body, chain, engine):
+    """walk selector chain from post_body and extract text of the last element found"""
+    element = post_body
+    if engine == clparser.LXML:
+        import lxmlparser  # pylint: disable=import-outside-toplevel
+        for selector in chain:
+            element = lxmlparser.first(lxml_selector(selector), element)
+            if element is None:
+                return None
+        return lxmlparser.text(element)
+
+    for selector in chain:
+        element = element.find(selector, first=True)
+        if element is None:
+            return None
+    return element.text
+
+
+def bench_fields(pages, engine, repeat):
+    """mean extraction time of every field over all non removed pages"""
+    totals = dict.fromkeys(FIELDS, 0.0)
+    runs = 0
+    for name, content in pages.items():
+        post_body = clparser.load_page(content, "https://localhost/" + name, engine=engine)
+        if clparser.engine_functions(engine)[0](post_body):
+            continue
+        runs += repeat
+        for field, chain in FIELDS.items():
+            start = time.perf_counter()
+            for _ in range(repeat):
+                extract_field(post_body, chain, engine)
+            totals[field] += time.perf_counter() - start
+    return {field: total / runs if runs else 0.0 for field, total in totals.items()}
+
+
+def bench_engine(pages, engine, repeat) -> Report:
+    """run all pages `repeat` times through parse_page"""
+    # warm up: lazy imports, compiled selectors
+    for name, content in pages.items():
+        parse_once(name, content, engine)
+
+    stats = []
+    total = 0.0
+    tracemalloc.start()
+    for name, content in pages.items():
+        timings = []
+        removed = False
+        for _ in range(repeat):
+            start = time.perf_counter()
+            removed = parse_once(name, content, engine)
+            timings.append(time.perf_counter() - start)
+        total += sum(timings)
+        stats.append(PageStats(name, statistics.mean(timings), min(timings), removed))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    fields = bench_fields(pages, engine, repeat)
+    throughput = len(pages) * repeat / total if total else 0.0
+    return Report(engine, stats, fields, peak, throughput)
+
+
+def print_report(report, out=None):
+    """print human readable report"""
+    out = out or sys.stdout
+    print("engine: {}".format(report.engine), file=out)
+    print("  {:<30} {:>10} {:>10}".format("page", "mean ms", "best ms"), file=out)
+    for page in report.pages:
+        name = page.name + (" (removed)" if page.removed else "")
+        print("  {:<30} {:>10.3f} {:>10.3f}".format(name, page.mean * 1000, page.best * 1000), file=out)
+    print("  {:<30} {:>10}".format("field", "mean ms"), file=out)
+    for field, mean in report.fields.items():
+        print("  {:<30} {:>10.3f}".format(field, mean * 1000), file=out)
+    print("  peak memory: {:.1f} KiB".format(report.peak_memory / 1024), file=out)
+    print("  throughput: {:.1f} pages/s".format(report.throughput), file=out)
+
+
+def legacy_generate_id(item):
+    """generate_id before streaming digest: deepcopy without PostUrl and get_md5"""
+    from handler import get_md5  # pylint: disable=import-outside-toplevel
+    new = copy.deepcopy(item)
+    del new["PostUrl"]
+    return get_md5(new).hexdigest()
+
+
+def intid_items(pages):
+    """items like put_item builds from the pages, plus a large posting: long body and many thumbs"""
+    items = {}
+    for name, content in pages.items():
+        post_body = clparser.load_page(content, "https://localhost/" + name, engine=clparser.LXML)
+        if clparser.engine_functions(clparser.LXML)[0](post_body):
+            continue
+        item = {"PostUrl": "https://localhost/" + name}
+        item.update(clparser.parse_post(post_body, engine=clparser.LXML).to_item())
+        items[name] = item
+    if items:
+        large = copy.deepcopy(next(iter(items.values())))
+        large["parsed_postingbody"] *= 50
+        large["parsed_thumbs"] = ["{}?{}".format(thumb, i) for i in range(50) for thumb in large["parsed_thumbs"]]
+        items["large"] = large
+    return items
+
+
+def bench_intid(items, repeat):
+    """mean time of legacy and current id generation per item. return dict name -> (legacy, current), seconds"""
+    from handler import generate_id  # pylint: disable=import-outside-toplevel
+    results = {}
+    for name, item in items.items():
+        timings = []
+        for func in (legacy_generate_id, generate_id):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                func(item)
+            timings.append((time.perf_counter() - start) / repeat)
+        results[name] = tuple(timings)
+    return results
+
+
+def print_intid_report(results, out=None):
+    """print id generation timings"""
+    out = out or sys.stdout
+    print("intid:", file=out)
+    print("  {:<30} {:>10} {:>10} {:>8}".format("item", "legacy ms", "ms", "speedup"), file=out)
+    for name, (legacy, current) in results.items():
+        print("  {:<30} {:>10.3f} {:>10.3f} {:>7.1f}x".format(
+            name, legacy * 1000, current * 1000, legacy / current if current else 0.0), file=out)
+
+
+def parse_args(argv=None):
+    """parse command line arguments"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("pages", nargs="*", help="pages to parse. Default all testpages/*.html")
+    parser.add_argument("--engine", choices=clparser.ENGINES, action="append",
+                        help="engine to benchmark. May be repeated. Default all engines")
+    parser.add_argument("--repeat", type=int, default=20, help="parse every page this many times")
+    parser.add_argument("--max-page-ms", type=float,
+                        help="exit with error if mean parse time of any page exceeds this value")
+    parser.add_argument("--intid", action="store_true", help="benchmark item id generation instead of parsing")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """run benchmark. return exit code"""
+    global_sdk_config.set_sdk_enabled(False)
+    args = parse_args(argv)
+    pages = load_pages(args.pages or sorted(glob.glob(os.path.join(TESTPAGES, "*.html"))))
+
+    if args.intid:
+        print_intid_report(bench_intid(intid_items(pages), args.repeat))
+        return 0
+
+    code = 0
+    for engine in args.engine or clparser.ENGINES:
+        report = bench_engine(pages, engine, args.repeat)
+        print_report(report)
+        if args.max_page_ms is not None:
+            for page in report.pages:
+                if page.mean * 1000 > args.max_page_ms:
+                    print("{} {}: {:.3f} ms exceeds {} ms".format(
+                        engine, page.name, page.mean * 1000, args.max_page_ms), file=sys.stderr)
+                    code = 1
+    return code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
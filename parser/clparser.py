@@ -1,15 +1,28 @@
 """parser module for parsing data from provided urls"""
+import base64
+import gzip
 import json
-import locale
+import os
 import re
 import sys
-from typing import Dict, Union
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
 
 from aws_xray_sdk import global_sdk_config  # type: ignore
-from aws_xray_sdk.core import xray_recorder  # type: ignore
-from requests_html import HTMLSession, HTMLResponse  # type: ignore
 
-locale.setlocale(locale.LC_ALL, 'en_US.UTF-8')
+import archive
+import fetch
+from metrics import timed
+from posting import ParsedPosting
+from tracing import capture
+
+# parsing engines. `requests_html` is the reference one, `lxml` parses page once with precompiled selectors
+REQUESTS_HTML = "requests_html"
+LXML = "lxml"
+ENGINES = (REQUESTS_HTML, LXML)
+PARSER_ENGINE = os.getenv("PARSER_ENGINE", REQUESTS_HTML)
+
+GZIP_MAGIC = b"\x1f\x8b"
 
 
 class PostRemovedException(Exception):
@@ -20,7 +33,7 @@ class CL404Exception(Exception):
     """Exception to handle 404 status codes"""
 
 
-@xray_recorder.capture('parse_request_body')
+@capture('parse_request_body')
 def parse_request_body(raw_body):
     """parse data represented as string to json"""
     body = raw_body.replace("\n", "\\n")  # repace newlines to be able to parse json'
@@ -28,6 +41,36 @@ def parse_request_body(raw_body):
     return body
 
 
+@capture('parse_request_items')
+def parse_request_items(raw_body, base64_encoded=False) -> Tuple[List[Dict], bool]:
+    """parse request body with one item or batch of items.
+
+    Batch is JSON array or newline delimited JSON objects (NDJSON). Body may be gzip compressed, API gateway
+    passes binary bodies base64 encoded. return `(items, batch)`, `batch` is False for single object body"""
+    if base64_encoded:
+        raw_body = base64.b64decode(raw_body)
+    if isinstance(raw_body, bytes):
+        if raw_body.startswith(GZIP_MAGIC):
+            raw_body = gzip.decompress(raw_body)
+        raw_body = raw_body.decode("utf-8")
+
+    text = raw_body.strip()
+    if text.startswith("["):
+        items = json.loads(text)
+    else:
+        try:
+            return [parse_request_body(text)], False
+        except json.JSONDecodeError:
+            lines = [line for line in text.splitlines() if line.strip()]
+            if len(lines) < 2:
+                raise
+            items = [json.loads(line) for line in lines]
+
+    if not all(isinstance(item, dict) for item in items):
+        raise ValueError("batch items have to be objects")
+    return items, True
+
+
 def parse_attr_groups(attrgroups):
     """parse attribute groups
 
@@ -39,16 +82,20 @@ def parse_attr_groups(attrgroups):
     return attrs
 
 
+def price_from_text(price_text) -> int:
+    """convert price text like '$2,895' to int. Locale independent"""
+    no_sign = price_text.strip().strip("$")
+    return int(no_sign.replace(",", ""))
+
+
 def parse_price(posting_title_text) -> Dict[str, Union[str, int]]:
     """parse price"""
-    price_data = {}
+    price_data: Dict[str, Union[str, int]] = {}
     price_element = posting_title_text.find(".price", first=True)
     if price_element:
         price_text = price_element.text
-        no_sign = price_text.strip().strip("$")
-        price = locale.atoi(no_sign)
         price_data["price_text"] = price_text
-        price_data["price"] = price
+        price_data["price"] = price_from_text(price_text)
 
     return price_data
 
@@ -90,53 +137,53 @@ def get_area(item):
     return area
 
 
-def get_type(item):
-    """parse type of the item from 'attrs' field"""
-    attrs = item["attrs"]
-    if not isinstance(attrs, list):
-        return None
-    types = {"apartment", "townhouse", "loft", "land", "house", "duplex", "flat", "condo", "cottage/cabin"}
-    return ",".join(sorted(types & set(attrs)))
-
-
-@xray_recorder.capture('parse_page')
-def parse_page(page_url):
-    """retrieve and parse html page"""
-    # result format is here to have consistent results with default None
-    result = {
-        "postingtitletext": None,
-        "price_text": None,
-        "price": None,
-        "housing": None,
-        "titletextonly": None,
-        "thumbs": None,
-        "data_latitude": None,
-        "data_longitude": None,
-        "map_address": None,
-        "map_link": None,
-        "attrs": None,
-        "postingbody": None,
-        "notices": None,
-        "bedrooms": None,
-        "area": None,
-        "type": None,
-        "catsok": None,
-        "dogsok": None,
-        "garagea": None,
-        "garaged": None,
-        "furnished": None,
-        "laundryb": None,
-        "laundrys": None,
-        "wd": None,
-        "nthumbs": None,
-    }
-
-    post_body = get_page(page_url)
+def engine_functions(engine):
+    """return `(post_removed, parse_post_body)` functions of the parsing engine"""
+    if engine == REQUESTS_HTML:
+        return post_removed, parse_post_body
+    if engine == LXML:
+        import lxmlparser  # pylint: disable=import-outside-toplevel
+        return lxmlparser.post_removed, lxmlparser.parse_post_body
+    raise ValueError("unknown parsing engine '{}'".format(engine))
+
+
+@capture('parse_page')
+def parse_page(page_url, engine=None):
+    """retrieve and parse html page. return ParsedPosting
+
+    `engine` is one of REQUESTS_HTML or LXML. Defaults to PARSER_ENGINE"""
+    engine = engine or PARSER_ENGINE
+    if engine not in ENGINES:
+        raise ValueError("unknown parsing engine '{}'".format(engine))
+    post_body = get_page(page_url, engine=engine)
+    return parse_post(post_body, engine=engine)
+
+
+@timed('parse')
+def parse_post(post_body, engine=None):
+    """parse post body loaded by `get_page` or `load_page`"""
+    engine = engine or PARSER_ENGINE
+    is_removed, parse_body = engine_functions(engine)
 
     # check for removed
-    if post_removed(post_body):
+    if is_removed(post_body):
         raise PostRemovedException(post_body)
 
+    posting = ParsedPosting(**parse_body(post_body))
+
+    # additional fields
+    # pylint: disable=no-member
+    posting.bedrooms = get_bedrooms(posting.housing)
+    posting.area = get_area(posting)
+    posting.apply_attrs()
+    posting.nthumbs = len(posting.thumbs) if posting.thumbs is not None else 0
+    return posting
+
+
+def parse_post_body(post_body):
+    """extract raw fields from the posting `.body` element"""
+    result = {}
+
     # posting title
     posting_title = post_body.find(".postingtitle", first=True)
     posting_title_text = posting_title.find(".postingtitletext", first=True)
@@ -181,21 +228,8 @@ def parse_page(page_url):
     # notices
     notices = userbody.find("ul.notices", first=True)
     if notices is not None:
-        result["notices"] = [n.text for n in userbody.find("ul.notices", first=True).find("li")]
+        result["notices"] = [n.text for n in notices.find("li")]
 
-    # additional fields
-    result["bedrooms"] = get_bedrooms(result["housing"])
-    result["area"] = get_area(result)
-    result["type"] = get_type(result)
-    result["catsok"] = "cats are OK - purrr" in result.get("attrs", [])
-    result["dogsok"] = "dogs are OK - wooof" in result.get("attrs", [])
-    result["garagea"] = "attached garage" in result.get("attrs", [])
-    result["garaged"] = "detached garage" in result.get("attrs", [])
-    result["furnished"] = "furnished" in result.get("attrs", [])
-    result["laundryb"] = "laundry in bldg" in result.get("attrs", [])
-    result["laundrys"] = "laundry on site" in result.get("attrs", [])
-    result["wd"] = "w/d in unit" in result.get("attrs", [])
-    result["nthumbs"] = len(result["thumbs"]) if result["thumbs"] is not None else 0
     return result
 
 
@@ -221,23 +255,97 @@ def parse_map(map_and_attrs):
     return map_data
 
 
-@xray_recorder.capture('get_page')
-def get_page(page_url):
-    """get web page. return html representation"""
-    session = HTMLSession()
-    resp: HTMLResponse = session.get(page_url)
+@capture('get_page')
+@timed('get_page')
+def get_page(page_url, engine=None):
+    """get web page. return html representation of the post body for the parsing engine"""
+    content, encoding = fetch_content(page_url)
+    return load_page(content, page_url, engine=engine, encoding=encoding)
+
+
+def fetch_content(page_url):
+    """get raw web page. return `(content, encoding)`. Successful page is archived if PAGE_ARCHIVE is set"""
+    resp = fetch.get(page_url)
     if resp.status_code == 404:
-        raise CL404Exception
-    # get post body
-    post_body = resp.html.find(".body", first=True)
+        raise CL404Exception(page_url)
+    page_archive = archive.get_archive()
+    if page_archive is not None and resp.ok:
+        page_archive.safe_store(page_url, resp.content)
+    return resp.content, resp.encoding
+
+
+def load_page(content, page_url, engine=None, encoding=None):
+    """load raw page content. return html representation of the post body for the parsing engine.
+
+    Raise ValueError if the page has no post body"""
+    engine = engine or PARSER_ENGINE
+    if engine == LXML:
+        import lxmlparser  # pylint: disable=import-outside-toplevel
+        post_body = lxmlparser.load_body(content, encoding)
+    else:
+        # requests_html pulls pyppeteer and friends, import it only when the engine is used
+        from requests_html import HTML, DEFAULT_ENCODING  # type: ignore # pylint: disable=import-outside-toplevel
+        html = HTML(url=page_url, html=content, default_encoding=encoding or DEFAULT_ENCODING)
+        # get post body
+        post_body = html.find(".body", first=True)
+    if post_body is None:
+        raise ValueError("{} is not a posting page: no .body element".format(page_url))
     return post_body
 
 
+def parse_content(content, page_url, engine=None, encoding=None):
+    """parse raw page content. Exceptions carry page_url only to be safe to pass between processes"""
+    post_body = load_page(content, page_url, engine=engine, encoding=encoding)
+    try:
+        return parse_post(post_body, engine=engine)
+    except PostRemovedException:
+        raise PostRemovedException(page_url) from None
+
+
+class PageResult(NamedTuple):
+    """result of parsing one page by `parse_pages`. Either `result` or `error` is set"""
+    url: str
+    result: Any = None  # ParsedPosting
+    error: Optional[Exception] = None
+
+
+def parse_pages(urls, max_concurrency=8, engine=None, parse_workers=0) -> Iterator[PageResult]:
+    """retrieve and parse html pages concurrently. Yields PageResult as pages complete.
+
+    Up to `max_concurrency` pages are fetched at the same time. Html is parsed in the fetching threads
+    or, if `parse_workers` is set, in the pool of `parse_workers` processes.
+    Errors (PostRemovedException, CL404Exception, ...) are reported per url in `PageResult.error`."""
+    engine = engine or PARSER_ENGINE
+    parse_pool = ProcessPoolExecutor(max_workers=parse_workers) if parse_workers else None
+
+    def fetch_and_parse(page_url):
+        content, encoding = fetch_content(page_url)
+        if parse_pool is None:
+            return parse_content(content, page_url, engine=engine, encoding=encoding)
+        return parse_pool.submit(parse_content, content, page_url, engine=engine, encoding=encoding).result()
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_concurrency) as fetch_pool:
+            futures = {fetch_pool.submit(fetch_and_parse, url): url for url in urls}
+            for future in as_completed(futures):
+                url = futures[future]
+                try:
+                    yield PageResult(url, result=future.result())
+                except Exception as ex:  # pylint: disable=broad-except
+                    yield PageResult(url, error=ex)
+    finally:
+        if parse_pool is not None:
+            parse_pool.shutdown()
+
+
 if __name__ == "__main__":
     global_sdk_config.set_sdk_enabled(False)
 
-    PAGE = sys.argv[1]
-    try:
-        print(json.dumps(parse_page(PAGE), indent=4))
-    except (PostRemovedException, CL404Exception):
-        print({"message": "post removed", "item": PAGE})
+    PAGES = sys.argv[1:]
+    for page in parse_pages(PAGES):
+        if isinstance(page.error, (PostRemovedException, CL404Exception)):
+            print({"message": "post removed", "item": page.url})
+        elif page.error is not None:
+            print({"message": "error", "item": page.url, "error": str(page.error)})
+        else:
+            print(json.dumps(page.result.to_dict(), indent=4))
@@ -0,0 +1,71 @@
+"""shared http fetch layer.
+
+One pooled keep-alive session per process, so warm lambda invocations reuse connections to the same hosts
+instead of paying for a new connection and TLS handshake on every page."""
+import os
+import threading
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry  # type: ignore
+
+TIMEOUT = float(os.getenv("FETCH_TIMEOUT", "10"))  # seconds, for connect and for read
+RETRIES = int(os.getenv("FETCH_RETRIES", "3"))
+BACKOFF_FACTOR = float(os.getenv("FETCH_BACKOFF_FACTOR", "0.3"))  # sleep factor * 2 ** (retry - 1) between retries
+POOL_CONNECTIONS = int(os.getenv("FETCH_POOL_CONNECTIONS", "4"))  # amount of hosts to keep pools for
+POOL_MAXSIZE = int(os.getenv("FETCH_POOL_MAXSIZE", "10"))  # connections kept per host
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# same user agent requests_html.HTMLSession uses
+USER_AGENT = ("Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/603.3.8 (KHTML, like Gecko) "
+              "Version/10.1.2 Safari/603.3.8")
+
+_SESSION: Optional[requests.Session] = None
+_SESSION_LOCK = threading.Lock()
+
+
+def new_session(retries=RETRIES, backoff_factor=BACKOFF_FACTOR,
+                pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE) -> requests.Session:
+    """create session with pooled connections and retries with backoff"""
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        raise_on_status=False,  # return last response, let caller decide on status
+    )
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({
+        "User-Agent": USER_AGENT,
+        "Accept-Encoding": "gzip, deflate",  # decoded transparently by requests
+    })
+    return session
+
+
+def get_session() -> requests.Session:
+    """return shared session. Created on first use and kept for the process lifetime"""
+    global _SESSION  # pylint: disable=global-statement
+    if _SESSION is None:
+        with _SESSION_LOCK:
+            if _SESSION is None:
+                _SESSION = new_session()
+    return _SESSION
+
+
+def close():
+    """close shared session and its pools. Next `get` creates new one"""
+    global _SESSION  # pylint: disable=global-statement
+    with _SESSION_LOCK:
+        if _SESSION is not None:
+            _SESSION.close()
+            _SESSION = None
+
+
+def get(url, timeout=TIMEOUT, **kwargs) -> requests.Response:
+    """GET url using shared session"""
+    return get_session().get(url, timeout=timeout, **kwargs)
@@ -1,21 +1,19 @@
 """lambda created to get some urls as input, retrieve URL content, parse it and save."""
-import copy
+import functools
 import hashlib
 import json
 import logging
 import os
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
 from decimal import Decimal
-from json.decoder import JSONDecodeError
 
-import boto3
-from aws_xray_sdk.core import patch  # type: ignore
-from aws_xray_sdk.core import xray_recorder  # type: ignore
-
-from clparser import parse_request_body, parse_page, PostRemovedException, CL404Exception
-
-# x-ray tracing
-patch(['boto3', 'botocore'])
+from clparser import parse_request_body, parse_request_items, parse_page, PostRemovedException, CL404Exception
+import metrics
+from outbox import Outbox
+from tracing import capture, dynamodb, dynamodb_client, patched_boto3
+from urlindex import get_index
 
 LOGGER = logging.getLogger()
 if os.environ.get("LOG_LEVEL", "INFO") == "DEBUG":
@@ -23,21 +21,56 @@ if os.environ.get("LOG_LEVEL", "INFO") == "DEBUG":
 else:
     LOGGER.setLevel(logging.INFO)
 
-# Quick sanity checks and predefined local dev
-if os.getenv("AWS_SAM_LOCAL", ""):
-    DYNAMO = boto3.resource('dynamodb', endpoint_url="http://dynamodb:8000")
-else:
-    DYNAMO = boto3.resource('dynamodb')
-TABLE = DYNAMO.Table(os.getenv("TABLE_NAME", "apthunt"))
-
-# Create SQS client
-SQS = boto3.client('sqs')
+TABLE_NAME = os.getenv("TABLE_NAME", "apthunt")
 SQS_QUEUE_URL = os.getenv("SQS_QUEUE_URL", "")
-
-# client to processor
-SQS_PR = boto3.client('sqs')
 SQS_PR_QUEUE_URL = os.getenv("PROCESSOR_SQS_QUEUE_URL", "")
 
+# SQS batch mode
+SQS_CONCURRENCY = int(os.getenv("SQS_CONCURRENCY", "10"))  # records processed at the same time
+BATCH_WRITE_SIZE = 25  # DynamoDB BatchWriteItem limit
+BATCH_WRITE_RETRIES = 5
+BATCH_WRITE_BACKOFF = 0.05  # seconds, doubled on every retry
+BATCH_GET_SIZE = 100  # DynamoDB BatchGetItem limit
+
+NEW_ITEM_CONDITION = "attribute_not_exists(intid)"
+
+# request item flag: posting changed since the url was seen, fetch it even if url index has it. Not saved
+RECHECK = "Recheck"
+
+# batch requests: JSON array or NDJSON body with many items
+MAX_BATCH_ITEMS = int(os.getenv("MAX_BATCH_ITEMS", "100"))
+
+# statuses of items in batches
+SAVED, DUPLICATE, REMOVED, SEEN, FAILED = "saved", "duplicate", "removed", "seen recently", "error"
+SKIPPED = {"post removed": REMOVED, "seen recently": SEEN}  # `prepare_item` response message -> status
+
+
+# AWS clients are created on first use and kept for warm invocations
+@functools.lru_cache(maxsize=None)
+def get_table():
+    """DynamoDB table"""
+    return dynamodb().Table(TABLE_NAME)
+
+
+@functools.lru_cache(maxsize=None)
+def get_sqs():
+    """SQS client. Shared by thumbs and processor queues"""
+    return patched_boto3().client('sqs')
+
+
+@functools.lru_cache(maxsize=None)
+def get_outbox():
+    """outbound SQS message buffer. Flushed at the end of every invocation, see `flush_outbox`"""
+    return Outbox(get_sqs())
+
+
+def flush_outbox():
+    """send buffered SQS messages"""
+    failed = get_outbox().flush()
+    if failed:
+        LOGGER.error("failed to send %d SQS messages: %s", len(failed), failed)
+        metrics.count("sqs_failed", len(failed))
+
 
 def respond(err, res=None, code=400):
     """helper function to create valid proxy object for AWS lambda + proxy gateway"""
@@ -50,7 +83,8 @@ def respond(err, res=None, code=400):
     }
 
 
-@xray_recorder.capture('handler')
+@capture('handler')
+@metrics.collect
 def handler(event, context):
     """request handler"""
     LOGGER.debug("context: %s", context)
@@ -60,12 +94,16 @@ def handler(event, context):
 
     LOGGER.debug("raw_body: '%s'", raw_body)
     try:
-        body = parse_request_body(raw_body)
-    except JSONDecodeError as ex:
+        items, batch = parse_request_items(raw_body, event.get("isBase64Encoded", False))
+    except (ValueError, OSError) as ex:
         msg = "Could not parse body. Ex: '{}'".format(ex)
         LOGGER.warning(msg)
         return respond(ValueError(msg))
 
+    if batch:
+        return batch_handler(items)
+
+    body = items[0]
     LOGGER.debug("body: '%s'", body)
 
     try:
@@ -75,12 +113,28 @@ def handler(event, context):
         LOGGER.error(msg, exc_info=True)
         # return respond(ValueError(msg), code=500)
         raise ValueError(msg) from ex
+    finally:
+        flush_outbox()
 
     LOGGER.info("response: '%s'", resp)
     return respond(None, resp)
 
 
-@xray_recorder.capture('prepare4dynamo')
+def batch_handler(items):
+    """save batch of items. Respond with status of every item in request order"""
+    if len(items) > MAX_BATCH_ITEMS:
+        msg = "Too many items: {}, max {}".format(len(items), MAX_BATCH_ITEMS)
+        LOGGER.warning(msg)
+        return respond(ValueError(msg))
+
+    urls = [item.get("PostUrl") for item in items]
+    statuses = save_items(list(enumerate(items)))
+    results = [{"PostUrl": url, "status": statuses[number]} for number, url in enumerate(urls)]
+    LOGGER.info("response: '%s'", results)
+    return respond(None, {"results": results})
+
+
+@capture('prepare4dynamo')
 def prepare4dynamo(item):
     """Need some preparation before sending item to the dynamodb"""
     processed = {}
@@ -96,9 +150,9 @@ def prepare4dynamo(item):
     return processed
 
 
-@xray_recorder.capture('que_thumbs')
+@capture('que_thumbs')
 def que_thumbs(sqs, sqs_queue, item):
-    """send item thumbs to the SQS queue"""
+    """send item thumbs to the SQS queue. `sqs` is SQS client or `Outbox`"""
     # Send message to SQS queue
     thumbs = item.get("thumbs")
     if thumbs is None:
@@ -113,30 +167,10 @@ def que_thumbs(sqs, sqs_queue, item):
     LOGGER.info("thumb SQS response message id: %s", response['MessageId'])
 
 
-@xray_recorder.capture('send_2_processor')
-def send_2_processor(sqs, sqs_queue, item):
-    """send item to the processor SQS"""
-    msg = {
-        "latitude": item["parsed_data_latitude"],
-        "longitude": item["parsed_data_longitude"],
-        "district": item["parsed_district"],
-        "housing": item["parsed_housing"],
-        "bedrooms": item["parsed_bedrooms"],
-        "area": item["parsed_area"],
-        "type": item["parsed_type"],
-        "catsok": item["parsed_catsok"],
-        "dogsok": item["parsed_dogsok"],
-        "garagea": item["parsed_garagea"],
-        "garaged": item["parsed_garaged"],
-        "furnished": item["parsed_furnished"],
-        "laundryb": item["parsed_laundryb"],
-        "laundrys": item["parsed_laundrys"],
-        "wd": item["parsed_wd"],
-        "nthumbs": item["parsed_nthumbs"],
-        'price': item["parsed_price"],
-        'url': item["PostUrl"],
-    }
-    msg = json.dumps(msg)
+@capture('send_2_processor')
+def send_2_processor(sqs, sqs_queue, parsed, url):
+    """send parsed item to the processor SQS. `sqs` is SQS client or `Outbox`"""
+    msg = json.dumps(parsed.to_message(url))
     response = sqs.send_message(
         QueueUrl=sqs_queue,
         MessageBody=msg
@@ -166,36 +200,89 @@ def get_md5(data):
     return data_hash
 
 
-def generate_id(item):
-    """generate id for the item"""
-    # let's create copy of item to exclude URL from getting md5
-    new = copy.deepcopy(item)
-    del new["PostUrl"]
+# digests of common scalars, `None` and flags are in every item
+_MD5 = hashlib.md5
+_CONST_DIGESTS = ((None, _MD5(b"None").digest()), (True, _MD5(b"True").digest()), (False, _MD5(b"False").digest()))
 
-    gen_id = get_md5(new)
-    LOGGER.debug("generated id '%s' for the item: %s", gen_id, item)
-    return gen_id.hexdigest()
 
+def digest(data):
+    """same as `get_md5(data).digest()`, without md5 objects for every key and a few allocations less.
 
-@xray_recorder.capture('item_exist')
-def item_exist(table, item):
-    """check if item exist in dynamo table"""
+    Digest of every str and scalar is part of the format: one md5 per leaf remains."""
+    if isinstance(data, str):
+        return _MD5(data.encode('utf-8')).digest()
+    if isinstance(data, dict):
+        return _MD5(b"".join(key.encode('utf8') + digest(data[key]) for key in sorted(data))).digest()
+    if isinstance(data, list):
+        return _MD5(b"".join(map(digest, data))).digest()
+    for const, const_digest in _CONST_DIGESTS:
+        if data is const:
+            return const_digest
+    return _MD5(str(data).encode('utf8')).digest()
 
-    key = {'intid': item["intid"]}
-    item = table.get_item(Key=key, ProjectionExpression='intid')
 
-    return "Item" in item.keys()
+def item_digest(item, exclude=()):
+    """digest of dict `item` with `exclude` keys skipped in place. Same as `get_md5` of item without them"""
+    return _MD5(b"".join(
+        key.encode('utf8') + digest(item[key]) for key in sorted(item) if key not in exclude
+    )).digest()
 
 
-@xray_recorder.capture('put_item')
-def put_item(item):
-    """put item into dynamodb table.
+@metrics.timed('generate_id')
+def generate_id(item):
+    """generate id for the item. URL is not part of id"""
+    gen_id = item_digest(item, exclude=("PostUrl",)).hex()
+    LOGGER.debug("generated id '%s' for the item: %s", gen_id, item)
+    return gen_id
+
+
+def added_day(added):
+    """UTC date of `added` unixtime in ms. Partition key of the table index on `added`, see analysis/retrieve.py"""
+    return datetime.fromtimestamp(added / 1000, timezone.utc).strftime("%Y-%m-%d")
+
+
+@capture('existing_intids')
+@metrics.timed('item_exist')
+def existing_intids(table, intids):
+    """return set of intids already existing in dynamo table. Uses BatchGetItem"""
+    existing = set()
+    intids = list(intids)
+    for start in range(0, len(intids), BATCH_GET_SIZE):
+        request = {table.name: {
+            "Keys": [{"intid": intid} for intid in intids[start:start + BATCH_GET_SIZE]],
+            "ProjectionExpression": "intid",
+        }}
+        for attempt in range(BATCH_WRITE_RETRIES + 1):
+            if attempt:
+                time.sleep(BATCH_WRITE_BACKOFF * 2 ** (attempt - 1))
+            resp = table.meta.client.batch_get_item(RequestItems=request)
+            existing.update(item["intid"] for item in resp.get("Responses", {}).get(table.name, []))
+            request = resp.get("UnprocessedKeys")
+            if not request:
+                break
+        else:
+            raise RuntimeError("failed to check {} intids".format(len(request[table.name]["Keys"])))
+    return existing
+
+
+@capture('prepare_item')
+def prepare_item(item):
+    """parse posting of the item and extend item with parsed data.
 
-    will add fields `added` and `intid`.
-    `added` equals to current time (unixtime in ms).
-    `intid` - generated uuid4 working as primary key."""
+    will add fields `added`, `added_day` and `intid`.
+    `added` equals to current time (unixtime in ms), `added_day` is its UTC date.
+    `intid` - md5 of the item working as primary key.
+    return `(parsed, None)` if item has to be saved or `(None, response)` if not: post removed or url seen
+    recently (see urlindex.py), unless item has RECHECK flag set. Duplicates are found on write."""
     # extend a little bit
     post_url = item["PostUrl"]
+    recheck = item.pop(RECHECK, False)
+
+    index = get_index()
+    if index is not None and not recheck and index.safe_seen(post_url):
+        LOGGER.info("Post seen recently: %s", post_url)
+        metrics.count("seen_recently")
+        return None, {"message": "seen recently", "item": item}
 
     # parse_page can throw PostRemovedException
     # this means post removed. No need to proceed.
@@ -203,22 +290,210 @@ def put_item(item):
         parsed = parse_page(post_url)
     except (PostRemovedException, CL404Exception):
         LOGGER.info("Post removed: %s", post_url)
-        return {"message": "post removed", "item": item}
+        metrics.count("removed")
+        if index is not None:
+            index.safe_mark(post_url)
+        return None, {"message": "post removed", "item": item}
 
-    que_thumbs(SQS, SQS_QUEUE_URL, parsed)
+    que_thumbs(get_outbox(), SQS_QUEUE_URL, parsed)
 
     # extend item with parsed data
-    for key, value in parsed.items():
-        item["parsed_" + key] = value
+    item.update(parsed.to_item())
 
     item["intid"] = generate_id(item)
     item["added"] = int(datetime.utcnow().timestamp() * 1000)
+    item["added_day"] = added_day(item["added"])
+
+    return parsed, None
+
+
+@capture('put_item')
+def put_item(item):
+    """put item into dynamodb table if it does not exist yet. See `prepare_item`"""
+    parsed, response = prepare_item(item)
+    if response is not None:
+        return response
+
+    client = dynamodb_client()
+    attributes = parsed.item_attributes(item)
+    try:
+        with metrics.timer("dynamo_put"):
+            dynamo_res = client.put_item(TableName=TABLE_NAME, Item=attributes, ConditionExpression=NEW_ITEM_CONDITION)
+    except client.exceptions.ConditionalCheckFailedException:
+        dynamo_res = None
 
-    if item_exist(TABLE, item):
+    index = get_index()
+    if index is not None:
+        index.safe_mark(item["PostUrl"], item["intid"])
+
+    if dynamo_res is None:
         LOGGER.info("duplicate post: %s, %s", item["intid"], item["PostUrl"])
+        metrics.count("duplicate")
         return {"duplicate": item}
 
-    processed_item = prepare4dynamo(item)
-    dynamo_res = TABLE.put_item(Item=processed_item)
-    send_2_processor(SQS_PR, SQS_PR_QUEUE_URL, item)
+    metrics.count("saved")
+
+    send_2_processor(get_outbox(), SQS_PR_QUEUE_URL, parsed, item["PostUrl"])
     return dynamo_res
+
+
+@capture('write_items')
+def write_items(client, table_name, prepared, retries=BATCH_WRITE_RETRIES):
+    """write items with BatchWriteItem of low-level `client`. `prepared` is list of `(message_id, attributes)`,
+    attributes are low-level DynamoDB items with unique `intid`.
+
+    Unprocessed items are retried with backoff. return message ids of items failed to write."""
+    pending = {attrs["intid"]["S"]: (message_id, {"PutRequest": {"Item": attrs}}) for message_id, attrs in prepared}
+
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(BATCH_WRITE_BACKOFF * 2 ** (attempt - 1))
+        unprocessed = {}
+        puts = list(pending.items())
+        for start in range(0, len(puts), BATCH_WRITE_SIZE):
+            chunk = puts[start:start + BATCH_WRITE_SIZE]
+            try:
+                with metrics.timer("dynamo_batch_write"):
+                    resp = client.batch_write_item(RequestItems={table_name: [put for _, (_, put) in chunk]})
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.warning("batch write failed", exc_info=True)
+                unprocessed.update(chunk)
+                continue
+            for put in resp.get("UnprocessedItems", {}).get(table_name, []):
+                intid = put["PutRequest"]["Item"]["intid"]["S"]
+                unprocessed[intid] = pending[intid]
+        pending = unprocessed
+        if not pending:
+            break
+
+    failed = [message_id for message_id, _ in pending.values()]
+    if failed:
+        LOGGER.error("failed to write %d items", len(failed))
+    return failed
+
+
+def drop_existing(table, prepared):
+    """drop items existing in the table from `prepared` list of `(key, item, parsed)`.
+
+    return `(new, seen)`: prepared entries of new items and `(url, intid)` of existing ones."""
+    existing = existing_intids(table, (item["intid"] for _, item, _ in prepared))
+    new, seen = [], []
+    for key, item, parsed in prepared:
+        if item["intid"] in existing:
+            LOGGER.info("duplicate post: %s, %s", item["intid"], item["PostUrl"])
+            metrics.count("duplicate")
+            seen.append((item["PostUrl"], item["intid"]))
+        else:
+            new.append((key, item, parsed))
+    return new, seen
+
+
+def prepare_items(entries, statuses):
+    """prepare `(key, item)` entries concurrently. return `(key, item, parsed)` of items to be saved.
+
+    statuses of other entries are set in `statuses`"""
+    prepared = []
+    intids = set()
+    with ThreadPoolExecutor(max_workers=SQS_CONCURRENCY) as pool:
+        futures = {pool.submit(prepare_item, item): (key, item) for key, item in entries}
+        for future in as_completed(futures):
+            key, item = futures[future]
+            try:
+                parsed, response = future.result()
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.error("failed to process item %s", key, exc_info=True)
+                statuses[key] = FAILED
+                continue
+            if parsed is None:
+                statuses[key] = SKIPPED[response["message"]]
+                continue
+            if item["intid"] in intids:
+                LOGGER.info("duplicate post in batch: %s, %s", item["intid"], item["PostUrl"])
+                metrics.count("duplicate")
+                statuses[key] = DUPLICATE
+                continue
+            intids.add(item["intid"])
+            prepared.append((key, item, parsed))
+    return prepared
+
+
+def save_new(new, seen):
+    """write `new` prepared entries, mark them and `seen` `(url, intid)` in url index, send saved ones to processor.
+
+    return keys of entries failed to write"""
+    failed_writes = set(write_items(dynamodb_client(), TABLE_NAME, [
+        (key, parsed.item_attributes(item)) for key, item, parsed in new
+    ]))
+    seen = seen + [(item["PostUrl"], item["intid"]) for key, item, _ in new if key not in failed_writes]
+
+    index = get_index()
+    if index is not None and seen:
+        try:
+            index.mark_many(seen)
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.warning("failed to mark %d urls", len(seen), exc_info=True)
+
+    outbox = get_outbox()
+    for key, item, parsed in new:
+        if key not in failed_writes:
+            send_2_processor(outbox, SQS_PR_QUEUE_URL, parsed, item["PostUrl"])
+    # items are saved already, retry would find them as duplicates. Failed messages are only logged
+    flush_outbox()
+    return failed_writes
+
+
+@capture('save_items')
+def save_items(entries):
+    """save `(key, item)` entries. return status of every key: SAVED, DUPLICATE, REMOVED, SEEN or FAILED.
+
+    Items are prepared concurrently, see `prepare_items`. BatchWriteItem has no conditions: items existing in
+    the table are found with BatchGetItem first, new items are written with BatchWriteItem."""
+    statuses = {}
+    prepared = prepare_items(entries, statuses)
+
+    table = get_table()
+    try:
+        new, seen = drop_existing(table, prepared)
+    except Exception:  # pylint: disable=broad-except
+        LOGGER.error("failed to check existing items", exc_info=True)
+        new, seen = [], []
+        statuses.update((key, FAILED) for key, _, _ in prepared)
+    else:
+        statuses.update((key, DUPLICATE) for key, _, _ in prepared)  # new ones are updated below
+
+    failed_writes = save_new(new, seen)
+    for key, _, _ in new:
+        statuses[key] = FAILED if key in failed_writes else SAVED
+
+    saved = len(new) - len(failed_writes)
+    failed = sum(1 for status in statuses.values() if status == FAILED)
+    metrics.count("saved", saved)
+    metrics.count("failed", failed)
+    LOGGER.info("processed %d items, saved %d, failed %d", len(statuses), saved, failed)
+    return statuses
+
+
+@capture('sqs_handler')
+@metrics.collect
+def sqs_handler(event, context):
+    """SQS batch event handler. Records are saved with `save_items`.
+
+    Failed messages are returned in `batchItemFailures`, so only they are retried.
+    Requires `ReportBatchItemFailures` in the event source mapping."""
+    LOGGER.debug("context: %s", context)
+    records = event.get("Records", [])
+    LOGGER.info("got %d records", len(records))
+
+    failures = []
+    entries = []  # (message id, item)
+    for record in records:
+        try:
+            entries.append((record["messageId"], parse_request_body(record["body"])))
+        except ValueError:
+            LOGGER.error("failed to parse message %s", record["messageId"], exc_info=True)
+            failures.append(record["messageId"])
+    metrics.count("failed", len(failures))
+
+    statuses = save_items(entries)
+    failures.extend(message_id for message_id, status in statuses.items() if status == FAILED)
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in failures]}
@@ -0,0 +1,247 @@
+"""local end-to-end throughput harness for the handler.
+
+Starts local HTTP server with saved pages (see testpages/), mocks DynamoDB and SQS with moto and drives
+`handler.handler` with API gateway events at the given request rate and concurrency. No network is used.
+Reports throughput, latency percentiles and duplicate/removed ratios.
+
+    pipenv run python loadtest.py [--requests 200] [--rate 50] [--concurrency 8] [--engine lxml]
+                                  [--duplicate-ratio 0.1] [--removed-ratio 0.1] [--min-rps 10]
+"""
+import argparse
+import contextlib
+import html
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, NamedTuple, Tuple
+from unittest import mock
+
+from aws_xray_sdk import global_sdk_config  # type: ignore
+
+import clparser
+import handler
+import tracing
+from metrics import percentile
+
+TESTPAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "testpages")
+POSTINGS = ("posting.html", "nomap.html", "nothumbs.html")
+TITLE_MARK = b'<span id="titletextonly">'
+
+NEW, DUPLICATE, REMOVED = "new", "duplicate", "removed"
+OUTCOMES = ("saved", "duplicate", "removed", "seen recently", "error")
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    """serves `/post/<n>.html` postings, unique for every n, and `/removed/<n>.html` removed postings"""
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """serve page"""
+        kind, _, name = self.path.strip("/").partition("/")
+        number = name[:-len(".html")]
+        pages = self.server.pages  # type: ignore
+        if kind == "post" and number.isdigit():
+            # number in the title makes posting content, so its intid, unique
+            template = pages[POSTINGS[int(number) % len(POSTINGS)]]
+            body = template.replace(TITLE_MARK, TITLE_MARK + html.escape("#" + number + " ").encode("utf-8"), 1)
+            status = 200
+        elif kind == "removed":
+            body, status = pages["removed.html"], 200
+        else:
+            body, status = b"not found", 404
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@contextlib.contextmanager
+def page_server():
+    """run page server in a thread. yield base url"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PageHandler)
+    pages = {}
+    for name in POSTINGS + ("removed.html",):
+        with open(os.path.join(TESTPAGES, name), "rb") as page:
+            pages[name] = page.read()
+    server.pages = pages  # type: ignore
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield "http://127.0.0.1:{}".format(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def clear_clients():
+    """forget cached AWS clients, so they are created inside or outside of moto mocks"""
+    for cached in (handler.get_table, handler.get_sqs, handler.get_outbox, tracing.dynamodb, tracing.dynamodb_client):
+        cached.cache_clear()
+
+
+@contextlib.contextmanager
+def mocked_aws():
+    """moto DynamoDB table and SQS queues wired into the handler"""
+    from moto import mock_dynamodb, mock_sqs  # type: ignore # pylint: disable=import-outside-toplevel
+    import boto3  # pylint: disable=import-outside-toplevel
+
+    with mock.patch.dict(os.environ, {"AWS_DEFAULT_REGION": os.getenv("AWS_DEFAULT_REGION", "us-east-1")}), \
+            mock_dynamodb(), mock_sqs():
+        boto3.client("dynamodb").create_table(
+            TableName=handler.TABLE_NAME,
+            KeySchema=[{"AttributeName": "intid", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "intid", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        sqs = boto3.client("sqs")
+        thumbs_url = sqs.create_queue(QueueName="thumbs")["QueueUrl"]
+        processor_url = sqs.create_queue(QueueName="processor")["QueueUrl"]
+        clear_clients()
+        try:
+            with mock.patch.object(handler, "SQS_QUEUE_URL", thumbs_url), \
+                    mock.patch.object(handler, "SQS_PR_QUEUE_URL", processor_url):
+                yield
+        finally:
+            clear_clients()
+
+
+def plan_requests(base_url, requests, duplicate_ratio, removed_ratio, seed=0) -> List[Tuple[str, str]]:
+    """list of `(kind, url)` to submit. Duplicates repeat urls of earlier new postings"""
+    rnd = random.Random(seed)
+    planned: List[Tuple[str, str]] = []
+    posted: List[str] = []
+    for number in range(requests):
+        roll = rnd.random()
+        if roll < removed_ratio:
+            planned.append((REMOVED, "{}/removed/{}.html".format(base_url, number)))
+        elif roll < removed_ratio + duplicate_ratio and posted:
+            planned.append((DUPLICATE, rnd.choice(posted)))
+        else:
+            url = "{}/post/{}.html".format(base_url, number)
+            posted.append(url)
+            planned.append((NEW, url))
+    return planned
+
+
+def outcome(response) -> str:
+    """outcome of handler response"""
+    body = json.loads(response["body"])
+    if "duplicate" in body:
+        return "duplicate"
+    if body.get("message") in ("post removed", "seen recently"):
+        return body["message"].replace("post ", "")
+    return "saved"
+
+
+def submit(url) -> Tuple[float, str]:
+    """run handler for url. return latency in seconds and outcome"""
+    event = {"body": json.dumps({"PostUrl": url, "PostTitle": "loadtest"})}
+    start = time.perf_counter()
+    try:
+        result = outcome(handler.handler(event, None))
+    except Exception:  # pylint: disable=broad-except
+        result = "error"
+    return time.perf_counter() - start, result
+
+
+class Report(NamedTuple):
+    """load test results"""
+    requests: int
+    elapsed: float  # seconds
+    latencies: List[float]  # seconds
+    outcomes: Dict[str, int]
+
+    @property
+    def rps(self) -> float:
+        """handled requests per second"""
+        return self.requests / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def items_per_second(self) -> float:
+        """saved items per second"""
+        return self.outcomes.get("saved", 0) / self.elapsed if self.elapsed else 0.0
+
+    def ratio(self, name) -> float:
+        """share of requests with the outcome"""
+        return self.outcomes.get(name, 0) / self.requests if self.requests else 0.0
+
+
+def run(urls, rate=0.0, concurrency=8) -> Report:
+    """submit urls with up to `concurrency` requests in flight, starting `rate` requests per second (0 - no limit)"""
+    outcomes = dict.fromkeys(OUTCOMES, 0)
+    latencies = []
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        start = time.perf_counter()
+        futures = []
+        for number, url in enumerate(urls):
+            if rate > 0:
+                delay = start + number / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            futures.append(pool.submit(submit, url))
+        for future in futures:
+            latency, result = future.result()
+            latencies.append(latency)
+            outcomes[result] += 1
+        elapsed = time.perf_counter() - start
+    return Report(len(urls), elapsed, latencies, outcomes)
+
+
+def print_report(report, out=None):
+    """print human readable report"""
+    out = out or sys.stdout
+    print("requests: {} in {:.2f} s".format(report.requests, report.elapsed), file=out)
+    print("  throughput: {:.1f} requests/s, {:.1f} items/s".format(report.rps, report.items_per_second), file=out)
+    print("  latency ms: p50 {:.1f}, p90 {:.1f}, p99 {:.1f}, max {:.1f}".format(
+        *(percentile(report.latencies, q) * 1000 for q in (50, 90, 99, 100))), file=out)
+    for name in OUTCOMES:
+        print("  {:<14} {:>6} {:>7.1%}".format(name, report.outcomes.get(name, 0), report.ratio(name)), file=out)
+
+
+def parse_args(argv=None):
+    """parse command line arguments"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="amount of requests")
+    parser.add_argument("--rate", type=float, default=0, help="requests started per second. Default no limit")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight")
+    parser.add_argument("--engine", choices=clparser.ENGINES, help="parsing engine. Default PARSER_ENGINE")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.1, help="share of resubmitted postings")
+    parser.add_argument("--removed-ratio", type=float, default=0.1, help="share of removed postings")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the request plan")
+    parser.add_argument("--min-rps", type=float, help="exit with error if throughput is lower, requests/s")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """run load test. return exit code"""
+    args = parse_args(argv)
+    global_sdk_config.set_sdk_enabled(False)
+
+    with page_server() as base_url, mocked_aws(), \
+            mock.patch.object(clparser, "PARSER_ENGINE", args.engine or clparser.PARSER_ENGINE):
+        planned = plan_requests(base_url, args.requests, args.duplicate_ratio, args.removed_ratio, args.seed)
+        # handler metrics lines are not interesting here
+        with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+            report = run([url for _, url in planned], args.rate, args.concurrency)
+
+    print_report(report)
+    if report.outcomes["error"]:
+        print("{} requests failed".format(report.outcomes["error"]), file=sys.stderr)
+        return 1
+    if args.min_rps is not None and report.rps < args.min_rps:
+        print("throughput {:.1f} requests/s is lower than {}".format(report.rps, args.min_rps), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,202 @@
+"""lxml based parsing engine.
+
+Parses the page once and walks the posting tree once, dispatching elements by class, id and tag. Text is
+extracted the same way requests_html does it (pyquery `extract_text`), so both engines produce identical fields."""
+import functools
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import lxml.html  # type: ignore
+from lxml import etree  # type: ignore
+from lxml.cssselect import CSSSelector  # type: ignore
+from pyquery.text import extract_text  # type: ignore
+
+from clparser import price_from_text  # pylint: disable=cyclic-import
+
+BODY = CSSSelector(".body", translator="html")
+REMOVED = CSSSelector("#userbody > div.removed", translator="html")
+
+
+class Rule(NamedTuple):
+    """element `parse_post_body` looks for: `tag` (any if None) inside of the `scope` element (`.body` if None).
+    First element found is kept, all of them if `many`"""
+    key: str
+    scope: Optional[str] = None
+    tag: Optional[str] = None
+    many: bool = False
+
+
+# rules by class, id and tag of the element, so the walk does dict lookups only
+BY_CLASS: Dict[str, Tuple[Rule, ...]] = {
+    "postingtitle": (Rule("postingtitle"),),
+    "postingtitletext": (Rule("postingtitletext", scope="postingtitle"),),
+    "price": (Rule("price", scope="postingtitletext"),),
+    "housing": (Rule("housing", scope="postingtitletext"),),
+    "userbody": (Rule("userbody"),),
+    "mapAndAttrs": (Rule("mapAndAttrs", scope="userbody"),),
+    "mapaddress": (Rule("map_address", scope="mapAndAttrs"), Rule("map_link_p", scope="mapAndAttrs", tag="p")),
+    "attrgroup": (Rule("attrgroup", scope="mapAndAttrs", tag="p", many=True),),
+    "notices": (Rule("notices", scope="userbody", tag="ul"),),
+}
+BY_ID: Dict[str, Tuple[Rule, ...]] = {
+    "titletextonly": (Rule("titletextonly", scope="postingtitletext"),),
+    "thumbs": (Rule("thumbs", scope="userbody"),),
+    "map": (Rule("map", scope="mapAndAttrs"),),
+    "postingbody": (Rule("postingbody", scope="userbody", tag="section"),),
+}
+BY_TAG: Dict[str, Tuple[Rule, ...]] = {
+    "small": (Rule("district", scope="postingtitletext"),),
+    "a": (Rule("thumb_link", scope="thumbs", many=True), Rule("map_link", scope="map_link_p")),
+    "span": (Rule("attr", scope="attrgroup", many=True),),
+    "li": (Rule("notice", scope="notices", many=True),),
+}
+
+REMOVED_MESSAGES = ("This posting has been flagged for removal.", "This posting has been deleted by its author.")
+
+
+@functools.lru_cache(maxsize=None)
+def html_parser(encoding: Optional[str]) -> lxml.html.HTMLParser:
+    """return (cached) html parser for the encoding"""
+    return lxml.html.HTMLParser(encoding=encoding)
+
+
+def first(selector, element):
+    """return first element matching selector or None"""
+    found = selector(element)
+    return found[0] if found else None
+
+
+def text(element) -> str:
+    """text representation of the element. Same as requests_html `Element.text`"""
+    return extract_text(element)
+
+
+def load_body(content: bytes, encoding: Optional[str] = None):
+    """parse html page and return `.body` element"""
+    document = lxml.html.document_fromstring(content, parser=html_parser(encoding))
+    return first(BODY, document)
+
+
+def post_removed(post_body) -> bool:
+    """check for post removal. See `clparser.post_removed`"""
+    div_removed = first(REMOVED, post_body)
+    if div_removed is not None:
+        return text(div_removed).startswith(REMOVED_MESSAGES)
+    return False
+
+
+def inside(element, scopes) -> bool:
+    """check if element is a descendant of one of `scopes` elements"""
+    return any(ancestor is scope for ancestor in element.iterancestors() for scope in scopes)
+
+
+def walk_body(post_body) -> Dict[str, Any]:
+    """walk the posting `.body` tree once. return elements matching the rules by key, lists for `many` rules.
+
+    Most elements match no rule, so the scope of a rule is checked on the matching elements only"""
+    found: Dict[str, Any] = {}
+    for element in post_body.iter(etree.Element):  # pylint: disable=c-extension-no-member # no comments
+        tag = element.tag
+        rules = BY_TAG.get(tag, ())
+        element_id = element.get("id")
+        if element_id:
+            rules += BY_ID.get(element_id, ())
+        classes = element.get("class")
+        if classes:
+            for name in classes.split():
+                rules += BY_CLASS.get(name, ())
+        for rule in rules:
+            if rule.tag is not None and rule.tag != tag or not rule.many and rule.key in found:
+                continue
+            if rule.scope is not None:
+                scope = found.get(rule.scope)
+                if scope is None or not inside(element, scope if isinstance(scope, list) else (scope,)):
+                    continue
+            if rule.many:
+                found.setdefault(rule.key, []).append(element)
+            else:
+                found[rule.key] = element
+    return found
+
+
+def required(found, key):
+    """element of `walk_body` result. Raise ValueError if not found, as requests_html engine fails on it"""
+    element = found.get(key)
+    if element is None:
+        raise ValueError("posting has no {} element".format(key))
+    return element
+
+
+def parse_thumbs(links) -> List[str]:
+    """return unique thumb links in the document order. Filtered the same way as requests_html `links`"""
+    unique: Dict[str, None] = {}
+    for link in links:
+        href = link.get("href")
+        if href is None:
+            continue
+        href = href.strip()
+        if href and not href.startswith(("#", "javascript:", "mailto:")):
+            unique[href] = None
+    return list(unique)
+
+
+def parse_map(found) -> Dict[str, Any]:
+    """extract map data from elements found by `walk_body`. return as dict"""
+    posting_map = found.get("map")
+    if posting_map is None:  # no map found
+        return {}
+
+    map_data: Dict[str, Any] = {
+        "data_latitude": float(posting_map.attrib["data-latitude"]),
+        "data_longitude": float(posting_map.attrib["data-longitude"]),
+    }
+    map_address = found.get("map_address")
+    if map_address is not None:
+        map_data["map_address"] = text(map_address)
+    map_link = found.get("map_link")
+    if map_link is not None:
+        map_data["map_link"] = map_link.get("href")
+
+    return map_data
+
+
+def parse_post_body(post_body) -> Dict[str, Any]:
+    """extract raw fields from the posting `.body` element. The tree is walked once, see `walk_body`"""
+    found = walk_body(post_body)
+    result: Dict[str, Any] = {}
+
+    # posting title
+    result["postingtitletext"] = text(required(found, "postingtitletext"))
+
+    price_element = found.get("price")
+    if price_element is not None:
+        result["price_text"] = text(price_element)
+        result["price"] = price_from_text(result["price_text"])
+
+    housing_el = found.get("housing")
+    if housing_el is not None:
+        result["housing"] = text(housing_el).strip(" /-")
+
+    result["titletextonly"] = text(required(found, "titletextonly"))
+
+    district_el = found.get("district")
+    if district_el is not None:
+        result["district"] = text(district_el).strip(" ()")
+
+    # userbody
+    if "thumbs" in found:
+        result["thumbs"] = parse_thumbs(found.get("thumb_link", ()))
+
+    required(found, "mapAndAttrs")
+    result.update(parse_map(found))
+
+    attrs = [text(attr) for attr in found.get("attr", ())]
+    if attrs:
+        result["attrs"] = attrs
+
+    postingbody_raw = text(required(found, "postingbody"))
+    result["postingbody"] = postingbody_raw.replace("QR Code Link to This Post\n", "")
+
+    if "notices" in found:
+        result["notices"] = [text(n) for n in found.get("notice", ())]
+
+    return result
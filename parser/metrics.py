@@ -0,0 +1,144 @@
+"""in-process stage metrics.
+
+Latency of pipeline stages and counters of events are collected during an invocation (see `collect`) and emitted
+as one CloudWatch embedded metric format (EMF) JSON line to stdout at its end. CloudWatch builds p50/p99 of every
+stage from it without X-Ray. Outside of `collect` timers and counters do nothing, so batch tools are not affected.
+"""
+import functools
+import json
+import math
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+NAMESPACE = os.getenv("METRICS_NAMESPACE", "apthunt")
+SERVICE = os.getenv("METRICS_SERVICE", "parser")
+MAX_VALUES = 100  # EMF limit of values of one metric
+
+
+def percentile(values, q) -> float:
+    """q-th percentile (0..100) of values with linear interpolation"""
+    ordered = sorted(values)
+    if not ordered:
+        return math.nan
+    pos = (len(ordered) - 1) * q / 100
+    low = math.floor(pos)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (pos - low)
+
+
+class Metrics:
+    """latency values (ms) per stage and counters of one invocation. Thread safe"""
+
+    def __init__(self):
+        self.timings: Dict[str, List[float]] = {}
+        self.counters: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, value_ms):
+        """record stage latency"""
+        with self._lock:
+            self.timings.setdefault(stage, []).append(value_ms)
+
+    def count(self, name, value=1):
+        """increase counter"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """count, p50, p99 and max latency of every stage"""
+        with self._lock:
+            timings = {stage: list(values) for stage, values in self.timings.items()}
+        return {
+            stage: {"count": len(values), "p50": percentile(values, 50), "p99": percentile(values, 99),
+                    "max": max(values)}
+            for stage, values in timings.items()
+        }
+
+    def to_emf(self, timestamp=None) -> Dict:
+        """embedded metric format record. Stages with more than MAX_VALUES values are reduced to quantiles"""
+        with self._lock:
+            timings = {stage: list(values) for stage, values in self.timings.items()}
+            counters = dict(self.counters)
+
+        record: Dict[str, Any] = {"Service": SERVICE}
+        definitions = []
+        for stage, values in sorted(timings.items()):
+            if len(values) > MAX_VALUES:
+                values = [percentile(values, 100 * i / (MAX_VALUES - 1)) for i in range(MAX_VALUES)]
+            record[stage] = [round(v, 3) for v in values]
+            definitions.append({"Name": stage, "Unit": "Milliseconds"})
+        for name, value in sorted(counters.items()):
+            record[name] = value
+            definitions.append({"Name": name, "Unit": "Count"})
+
+        record["_aws"] = {
+            "Timestamp": int(timestamp if timestamp is not None else time.time() * 1000),
+            "CloudWatchMetrics": [{"Namespace": NAMESPACE, "Dimensions": [["Service"]], "Metrics": definitions}],
+        }
+        return record
+
+
+# metrics of the running invocation, None outside of `collect`
+_CURRENT: Optional[Metrics] = None
+
+
+def current() -> Optional[Metrics]:
+    """metrics of the running invocation"""
+    return _CURRENT
+
+
+@contextmanager
+def timer(stage):
+    """record latency of the block as stage"""
+    metrics = _CURRENT
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.record(stage, (time.perf_counter() - start) * 1000)
+
+
+def timed(stage):
+    """decorator recording latency of every call as stage"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    """increase counter of the running invocation"""
+    metrics = _CURRENT
+    if metrics is not None:
+        metrics.count(name, value)
+
+
+def emit(metrics, out=None):
+    """write metrics as one compact EMF JSON line"""
+    out = out or sys.stdout
+    out.write(json.dumps(metrics.to_emf(), separators=(",", ":")) + "\n")
+    out.flush()
+
+
+def collect(func):
+    """decorator collecting metrics during the call and emitting them at its end"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        global _CURRENT  # pylint: disable=global-statement
+        metrics = _CURRENT = Metrics()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _CURRENT = None
+            emit(metrics)
+    return wrapper
@@ -0,0 +1,115 @@
+"""outbound SQS message buffer.
+
+Messages are collected per queue and sent with SendMessageBatch, packed within SQS batch limits:
+10 messages and 256 KiB of bodies per request. Entries failed in a batch are retried one by one with
+SendMessage. Buffer is flushed when a full batch is collected and at the end of the invocation.
+"""
+import logging
+import threading
+from typing import Dict, List, NamedTuple
+
+from metrics import timer
+from tracing import capture
+
+LOGGER = logging.getLogger(__name__)
+
+MAX_BATCH_MESSAGES = 10
+MAX_BATCH_BYTES = 256 * 1024
+
+
+class Message(NamedTuple):
+    """buffered message"""
+    entry_id: str
+    body: str
+    size: int  # body size in bytes
+
+
+class Outbox:
+    """buffer of outbound SQS messages. Thread safe.
+
+    `send_message` has the same arguments as SQS client one, so Outbox may be used in place of the client."""
+
+    def __init__(self, sqs, max_messages=MAX_BATCH_MESSAGES, max_bytes=MAX_BATCH_BYTES):
+        self.sqs = sqs
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self._queues: Dict[str, List[Message]] = {}
+        self._failed: List[str] = []  # bodies failed to send by `send_message`, reported by next `flush`
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def send_message(self, QueueUrl, MessageBody):  # pylint: disable=invalid-name
+        """buffer message. return response with entry id as `MessageId`: message is sent later"""
+        size = len(MessageBody.encode("utf-8"))
+        with self._lock:
+            self._counter += 1
+            message = Message(str(self._counter), MessageBody, size)
+            pending = self._queues.setdefault(QueueUrl, [])
+            if pending and sum(m.size for m in pending) + size > self.max_bytes:
+                batch = self._queues.pop(QueueUrl)
+                self._queues[QueueUrl] = [message]
+            else:
+                pending.append(message)
+                batch = self._queues.pop(QueueUrl) if len(pending) >= self.max_messages else []
+        if batch:
+            failed = self.send_batch(QueueUrl, batch)
+            if failed:
+                with self._lock:
+                    self._failed.extend(failed)
+        return {"MessageId": "buffered-" + message.entry_id}
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(pending) for pending in self._queues.values())
+
+    @capture('outbox_flush')
+    def flush(self) -> List[str]:
+        """send all buffered messages. return bodies of messages failed to send since the last flush"""
+        with self._lock:
+            queues, self._queues = self._queues, {}
+            failed, self._failed = self._failed, []
+        for queue_url, messages in queues.items():
+            for batch in self.pack(messages):
+                failed.extend(self.send_batch(queue_url, batch))
+        return failed
+
+    def pack(self, messages: List[Message]) -> List[List[Message]]:
+        """split messages into batches within limits"""
+        batches: List[List[Message]] = []
+        batch: List[Message] = []
+        size = 0
+        for message in messages:
+            if batch and (len(batch) >= self.max_messages or size + message.size > self.max_bytes):
+                batches.append(batch)
+                batch, size = [], 0
+            batch.append(message)
+            size += message.size
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def send_batch(self, queue_url, batch: List[Message]) -> List[str]:
+        """send one batch. Failed entries are retried one by one. return bodies of messages failed to send"""
+        try:
+            with timer("sqs_send"):
+                resp = self.sqs.send_message_batch(
+                    QueueUrl=queue_url,
+                    Entries=[{"Id": m.entry_id, "MessageBody": m.body} for m in batch],
+                )
+            failed_ids = {entry["Id"] for entry in resp.get("Failed", [])}
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.warning("failed to send batch of %d messages to %s", len(batch), queue_url, exc_info=True)
+            failed_ids = {m.entry_id for m in batch}
+        LOGGER.info("sent %d messages to %s", len(batch) - len(failed_ids), queue_url)
+
+        failed = []
+        for message in batch:
+            if message.entry_id not in failed_ids:
+                continue
+            try:
+                with timer("sqs_send"):
+                    self.sqs.send_message(QueueUrl=queue_url, MessageBody=message.body)
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.error("failed to send message to %s", queue_url, exc_info=True)
+                failed.append(message.body)
+        return failed
@@ -0,0 +1,212 @@
+"""parsed posting record.
+
+SCHEMA is the single source of truth for posting fields. `ParsedPosting` is a `__slots__` class of SCHEMA fields
+with converters to the DynamoDB item, to low-level DynamoDB `AttributeValue` map and to the processor message,
+driven by field tables precomputed from SCHEMA."""
+import math
+from decimal import Decimal
+from typing import TYPE_CHECKING, Any, Dict, NamedTuple, Optional, Tuple
+
+
+class Field(NamedTuple):
+    """posting field description"""
+    name: str
+    type: type
+    message: Optional[str] = None  # key in the processor message, None if not sent to processor
+    omit_none: bool = False  # do not put field into DynamoDB item if value is None
+
+
+SCHEMA: Tuple[Field, ...] = (
+    Field("postingtitletext", str),
+    Field("price_text", str),
+    Field("price", int, message="price"),
+    Field("housing", str, message="housing"),
+    Field("titletextonly", str),
+    Field("district", str, message="district", omit_none=True),
+    Field("thumbs", list),
+    Field("data_latitude", float, message="latitude"),
+    Field("data_longitude", float, message="longitude"),
+    Field("map_address", str),
+    Field("map_link", str),
+    Field("attrs", list),
+    Field("postingbody", str),
+    Field("notices", list),
+    Field("bedrooms", float, message="bedrooms"),
+    Field("area", float, message="area"),
+    Field("type", str, message="type"),
+    Field("catsok", bool, message="catsok"),
+    Field("dogsok", bool, message="dogsok"),
+    Field("garagea", bool, message="garagea"),
+    Field("garaged", bool, message="garaged"),
+    Field("furnished", bool, message="furnished"),
+    Field("laundryb", bool, message="laundryb"),
+    Field("laundrys", bool, message="laundrys"),
+    Field("wd", bool, message="wd"),
+    Field("nthumbs", int, message="nthumbs"),
+)
+
+ITEM_PREFIX = "parsed_"
+
+# amenity flags, set if attribute text found in attrs
+AMENITIES = {
+    "cats are OK - purrr": "catsok",
+    "dogs are OK - wooof": "dogsok",
+    "attached garage": "garagea",
+    "detached garage": "garaged",
+    "furnished": "furnished",
+    "laundry in bldg": "laundryb",
+    "laundry on site": "laundrys",
+    "w/d in unit": "wd",
+}
+TYPES = frozenset({"apartment", "townhouse", "loft", "land", "house", "duplex", "flat", "condo", "cottage/cabin"})
+
+# attribute text -> (field, value). One lookup per attribute derives all flags and type
+ATTR_TABLE: Dict[str, Tuple[str, Any]] = {
+    **{attr: (name, True) for attr, name in AMENITIES.items()},
+    **{attr: ("type", attr) for attr in TYPES},
+}
+
+
+def number(value) -> str:
+    """DynamoDB number of int, float or Decimal"""
+    if isinstance(value, float) and not math.isfinite(value):
+        raise TypeError("{!r} is not supported by DynamoDB".format(value))
+    return str(value)
+
+
+def attribute_value(value) -> Dict[str, Any]:
+    """low-level DynamoDB AttributeValue of python value. Same types boto3 TypeSerializer produces"""
+    if isinstance(value, str):
+        return {"S": value}
+    if isinstance(value, bool):
+        return {"BOOL": value}
+    if isinstance(value, (int, float, Decimal)):
+        return {"N": number(value)}
+    if value is None:
+        return {"NULL": True}
+    if isinstance(value, (list, tuple)):
+        return {"L": [attribute_value(v) for v in value]}
+    if isinstance(value, dict):
+        return {"M": {k: attribute_value(v) for k, v in value.items()}}
+    raise TypeError("unsupported type {} of {!r}".format(type(value), value))
+
+
+def attributes(item) -> Dict[str, Dict[str, Any]]:
+    """low-level DynamoDB item of the dict. None values are not stored"""
+    return {key: attribute_value(value) for key, value in item.items() if value is not None}
+
+
+# converters of not None value of schema type to AttributeValue
+_ATTRIBUTE_VALUES = {
+    str: lambda value: {"S": value},
+    bool: lambda value: {"BOOL": value},
+    int: lambda value: {"N": str(value)},
+    float: lambda value: {"N": number(value)},
+    list: lambda value: {"L": [{"S": v} for v in value]},  # all list fields are lists of str
+}
+
+FIELDS: Tuple[str, ...] = tuple(field.name for field in SCHEMA)
+FIELD_NAMES = frozenset(FIELDS)
+ITEM_KEYS = frozenset(ITEM_PREFIX + name for name in FIELDS)
+_ITEM_FIELDS = tuple((f.name, ITEM_PREFIX + f.name) for f in SCHEMA if not f.omit_none)
+_ITEM_OPTIONAL = tuple((f.name, ITEM_PREFIX + f.name) for f in SCHEMA if f.omit_none)
+_ATTRIBUTE_FIELDS = tuple((f.name, ITEM_PREFIX + f.name, _ATTRIBUTE_VALUES[f.type]) for f in SCHEMA)
+_MESSAGE_FIELDS = tuple((f.name, f.message) for f in SCHEMA if f.message)
+
+
+class ParsedPosting:
+    """parsed posting. Slots are SCHEMA fields, fields not passed to `__init__` are None"""
+    __slots__ = FIELDS
+
+    def __init__(self, **fields) -> None:
+        unknown = fields.keys() - FIELD_NAMES
+        if unknown:
+            raise TypeError("unknown posting fields: {}".format(", ".join(sorted(unknown))))
+        for name in FIELDS:
+            setattr(self, name, fields.get(name))
+
+    if TYPE_CHECKING:  # fields are set from SCHEMA, let type checkers accept any of them
+        def __getattr__(self, name: str) -> Any: ...
+
+        def __setattr__(self, name: str, value: Any) -> None: ...
+
+    def __eq__(self, other):
+        if type(self) is not type(other):  # pylint: disable=unidiomatic-typecheck
+            return NotImplemented
+        return all(getattr(self, n) == getattr(other, n) for n in FIELDS)
+
+    def __repr__(self):
+        fields = ", ".join("{}={!r}".format(n, getattr(self, n)) for n in FIELDS)
+        return "{}({})".format(type(self).__name__, fields)
+
+    def __getitem__(self, name):
+        """dict-like access for the code written for result dicts"""
+        if name not in FIELD_NAMES:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def get(self, name, default=None):
+        """dict-like access for the code written for result dicts"""
+        return getattr(self, name) if name in FIELD_NAMES else default
+
+    def to_dict(self) -> Dict[str, Any]:
+        """return fields as dict"""
+        return {n: getattr(self, n) for n in FIELDS}
+
+    def to_item(self) -> Dict[str, Any]:
+        """DynamoDB item fields, field names prefixed with ITEM_PREFIX"""
+        item = {key: getattr(self, name) for name, key in _ITEM_FIELDS}
+        for name, key in _ITEM_OPTIONAL:
+            value = getattr(self, name)
+            if value is not None:
+                item[key] = value
+        return item
+
+    @classmethod
+    def from_item(cls, item) -> "ParsedPosting":
+        """posting of DynamoDB item fields, see `to_item`. Other item fields are ignored"""
+        return cls(**{name: item.get(ITEM_PREFIX + name) for name in FIELDS})
+
+    def to_attributes(self) -> Dict[str, Dict[str, Any]]:
+        """low-level DynamoDB item fields of not None values, converted by schema types"""
+        item = {}
+        for name, key, convert in _ATTRIBUTE_FIELDS:
+            value = getattr(self, name)
+            if value is not None:
+                item[key] = convert(value)
+        return item
+
+    def to_message(self, url) -> Dict[str, Any]:
+        """processor message"""
+        message = {key: getattr(self, name) for name, key in _MESSAGE_FIELDS}
+        message["url"] = url
+        return message
+
+    def item_attributes(self, item) -> Dict[str, Dict[str, Any]]:
+        """low-level DynamoDB item of `item` extended with this posting (see `to_item`), in one pass.
+
+        Posting fields are converted by schema types, other `item` fields by value types. None values are not
+        stored."""
+        converted = {k: attribute_value(v) for k, v in item.items() if v is not None and k not in ITEM_KEYS}
+        converted.update(self.to_attributes())
+        return converted
+
+    def apply_attrs(self):
+        """derive amenity flags and type from attrs"""
+        derived: Dict[str, Any] = dict.fromkeys(AMENITIES.values(), False)
+        if self.attrs is None:
+            derived["type"] = None
+        else:
+            types = set()
+            for attr in self.attrs:
+                found = ATTR_TABLE.get(attr)
+                if found is None:
+                    continue
+                name, value = found
+                if name == "type":
+                    types.add(value)
+                else:
+                    derived[name] = value  # amenity flag of the table
+            derived["type"] = ",".join(sorted(types))
+        for name, value in derived.items():
+            setattr(self, name, value)
@@ -0,0 +1,141 @@
+"""re-parse archived pages.
+
+Runs `parse_page` extraction over every page in the archive (see archive.py) with a process pool. No pages are
+fetched. Records are written in bulk as JSON lines and, optionally, into DynamoDB table with batch writes.
+
+    pipenv run python reparse.py s3://bucket/prefix --output records.jsonl [--table apthunt-reparsed]
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Optional, Tuple
+
+from aws_xray_sdk import global_sdk_config  # type: ignore
+
+from archive import ArchiveEntry, PageArchive, open_archive
+from clparser import parse_content, PostRemovedException
+from posting import ParsedPosting
+
+LOGGER = logging.getLogger(__name__)
+
+# reparse_entry statuses
+PARSED = "parsed"
+REMOVED = "removed"
+FAILED = "failed"
+
+# per process state, set by init_worker
+_WORKER_ARCHIVE: Optional[PageArchive] = None
+_WORKER_ENGINE: Optional[str] = None
+
+
+def init_worker(location, engine):
+    """open archive once per worker process"""
+    global _WORKER_ARCHIVE, _WORKER_ENGINE  # pylint: disable=global-statement
+    global_sdk_config.set_sdk_enabled(False)
+    _WORKER_ARCHIVE = open_archive(location)
+    _WORKER_ENGINE = engine
+
+
+def reparse_entry(entry: ArchiveEntry) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """load and parse archived page. return `(status, item)`, item like put_item builds is set if PARSED.
+
+    Page the parser fails on is logged and reported as FAILED, so one bad page does not stop the run"""
+    assert _WORKER_ARCHIVE is not None, "init_worker was not called"
+    content = _WORKER_ARCHIVE.load(entry)
+    try:
+        parsed = parse_content(content, entry.url, engine=_WORKER_ENGINE)
+    except PostRemovedException:
+        return REMOVED, None
+    except (ValueError, AttributeError, IndexError, KeyError) as err:
+        LOGGER.error("can't parse %s fetched at %s: %r", entry.url, entry.fetched, err)
+        return FAILED, None
+    item: Dict[str, Any] = {"PostUrl": entry.url}
+    item.update(parsed.to_item())
+    item["content_hash"] = entry.content_hash
+    item["fetched"] = entry.fetched
+    return PARSED, item
+
+
+def write_table(table_name, items, client=None, chunksize=1000):
+    """write items into DynamoDB table with batch writes. return urls of items failed to write.
+
+    Items are converted the same way handler writes them: `ParsedPosting.item_attributes` of the posting fields,
+    None values are not stored. `intid` is generated the same way put_item does it: it is a hash of the item
+    content, so a page parsed into the same fields as its original record overwrites it, while a page parsed
+    differently (changed posting or parser) is written as a new record next to the original one. Fetch time
+    becomes `added` and `added_day`."""
+    import boto3  # pylint: disable=import-outside-toplevel
+    from handler import added_day, generate_id, write_items  # pylint: disable=import-outside-toplevel
+
+    client = client or boto3.client("dynamodb")
+    failed = []
+    prepared = []
+    for item in items:
+        del item["content_hash"]
+        fetched = item.pop("fetched")
+        item["intid"] = generate_id(item)
+        item["added"] = fetched
+        item["added_day"] = added_day(fetched)
+        prepared.append((item["PostUrl"], ParsedPosting.from_item(item).item_attributes(item)))
+        if len(prepared) >= chunksize:
+            failed.extend(write_items(client, table_name, prepared))
+            prepared.clear()
+    failed.extend(write_items(client, table_name, prepared))
+    return failed
+
+
+def reparse(location, out, engine=None, workers=None, chunksize=16):
+    """re-parse all pages of the archive. Write JSON lines to `out`. return (parsed, removed, failed) counters"""
+    entries = list(open_archive(location).entries())
+    counts = {PARSED: 0, REMOVED: 0, FAILED: 0}
+    items = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(location, engine)) as pool:
+        for status, item in pool.map(reparse_entry, entries, chunksize=chunksize):
+            counts[status] += 1
+            if item is None:
+                continue
+            items.append(item)
+            if len(items) >= 1000:
+                out.write("".join(json.dumps(i) + "\n" for i in items))
+                items.clear()
+    out.write("".join(json.dumps(i) + "\n" for i in items))
+    return counts[PARSED], counts[REMOVED], counts[FAILED]
+
+
+def parse_args(argv=None):
+    """parse command line arguments"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("archive", help="archive location: directory, file:// or s3:// url")
+    parser.add_argument("--output", default="-", help="JSON lines output file. Default stdout")
+    parser.add_argument("--table", help="also write records into this DynamoDB table")
+    parser.add_argument("--engine", help="parsing engine. Default PARSER_ENGINE")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="amount of worker processes")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """run re-parse"""
+    args = parse_args(argv)
+    global_sdk_config.set_sdk_enabled(False)  # runs outside of lambda, nothing to trace into
+    if args.table and args.output == "-":
+        raise SystemExit("--table requires --output file")
+
+    if args.output == "-":
+        parsed, removed, failed = reparse(args.archive, sys.stdout, engine=args.engine, workers=args.workers)
+    else:
+        with open(args.output, "w", encoding="utf-8") as out:
+            parsed, removed, failed = reparse(args.archive, out, engine=args.engine, workers=args.workers)
+    print("parsed {}, removed {}, failed {}".format(parsed, removed, failed), file=sys.stderr)
+
+    if args.table:
+        with open(args.output, encoding="utf-8") as records:
+            failed = write_table(args.table, (json.loads(line) for line in records))
+        if failed:
+            print("failed to write {} records".format(len(failed)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import boto3
+from aws_xray_sdk import global_sdk_config
+from moto import mock_dynamodb, mock_s3
+
+import archive
+import clparser
+from archive import LocalBackend, PageArchive, S3Backend
+from clparser import fetch_content
+from handler import generate_id
+from reparse import reparse, write_table
+from testutil import BAD_PAGES, parse_testpage, read_testpage, saved_page_url
+
+global_sdk_config.set_sdk_enabled(False)
+
+
+class ArchiveTests:
+    """tests common for all backends. Subclasses set self.archive"""
+    archive: PageArchive
+
+    def test_store_load(self):
+        content = read_testpage("posting.html")
+        chash = self.archive.store("https://sfbay.craigslist.org/posting.html", content, fetched=100)
+
+        entries = list(self.archive.entries())
+        self.assertEqual(entries, [archive.ArchiveEntry("https://sfbay.craigslist.org/posting.html", chash, 100)])
+        self.assertEqual(self.archive.load(entries[0]), content)
+
+    def test_same_content_stored_once(self):
+        content = read_testpage("posting.html")
+        self.archive.store("https://sfbay.craigslist.org/posting.html", content, fetched=100)
+        self.archive.store("https://sfbay.craigslist.org/posting.html", content, fetched=200)
+        self.archive.store("https://sfbay.craigslist.org/posting.html", content + b"\n", fetched=300)
+        self.archive.store("https://sfbay.craigslist.org/other.html", content, fetched=400)
+
+        fetched = sorted(entry.fetched for entry in self.archive.entries())
+        self.assertEqual(fetched, [100, 300, 400])
+
+
+class TestLocalArchive(ArchiveTests, unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = tmp.name
+        self.archive = PageArchive(LocalBackend(self.root))
+
+    def test_get_archive(self):
+        with mock.patch.dict(os.environ, {"PAGE_ARCHIVE": "file://" + self.root}):
+            self.assertIsInstance(archive.get_archive().backend, LocalBackend)
+        with mock.patch.dict(os.environ, {"PAGE_ARCHIVE": ""}):
+            self.assertIsNone(archive.get_archive())
+
+    def test_fetch_content_archives(self):
+        resp = mock.Mock(status_code=200, ok=True, content=b"<html></html>", encoding="utf-8")
+        with mock.patch.dict(os.environ, {"PAGE_ARCHIVE": self.root}), mock.patch("fetch.get", return_value=resp):
+            fetch_content("https://sfbay.craigslist.org/page.html")
+
+        entries = list(self.archive.entries())
+        self.assertEqual([entry.url for entry in entries], ["https://sfbay.craigslist.org/page.html"])
+
+    def test_fetch_content_error_not_archived(self):
+        resp = mock.Mock(status_code=503, ok=False, content=b"unavailable", encoding="utf-8")
+        with mock.patch.dict(os.environ, {"PAGE_ARCHIVE": self.root}), mock.patch("fetch.get", return_value=resp):
+            fetch_content("https://sfbay.craigslist.org/page.html")
+
+        self.assertEqual(list(self.archive.entries()), [])
+
+    def test_reparse(self):
+        for name in ("posting.html", "nomap.html", "removed.html"):
+            self.archive.store("https://sfbay.craigslist.org/" + name, read_testpage(name), fetched=100)
+
+        out = io.StringIO()
+        self.assertEqual(reparse(self.root, out, engine="lxml", workers=2), (2, 1, 0))
+
+        records = {r["PostUrl"]: r for r in map(json.loads, out.getvalue().splitlines())}
+        self.assertEqual(records["https://sfbay.craigslist.org/posting.html"]["parsed_price"], 3450)
+        self.assertEqual(records["https://sfbay.craigslist.org/nomap.html"]["parsed_price"], 2150)
+        self.assertEqual(records["https://sfbay.craigslist.org/nomap.html"]["fetched"], 100)
+
+    def test_reparse_bad_pages(self):
+        self.archive.store("https://sfbay.craigslist.org/posting.html", read_testpage("posting.html"), fetched=100)
+        for name, content in BAD_PAGES.items():
+            self.archive.store("https://sfbay.craigslist.org/" + name, content, fetched=100)
+
+        for engine in (clparser.REQUESTS_HTML, clparser.LXML):
+            with self.subTest(engine=engine):
+                out = io.StringIO()
+                self.assertEqual(reparse(self.root, out, engine=engine, workers=2), (1, 0, len(BAD_PAGES)))
+                records = [json.loads(line)["PostUrl"] for line in out.getvalue().splitlines()]
+                self.assertEqual(records, ["https://sfbay.craigslist.org/posting.html"])
+
+    def test_reparse_parse_error(self):
+        for name in ("posting.html", "nomap.html"):
+            self.archive.store("https://sfbay.craigslist.org/" + name, read_testpage(name), fetched=100)
+
+        def parse_content(content, page_url, engine=None):
+            if page_url.endswith("nomap.html"):
+                raise IndexError("list index out of range")
+            return clparser.parse_content(content, page_url, engine=engine)
+
+        out = io.StringIO()
+        with mock.patch("reparse.parse_content", parse_content):
+            self.assertEqual(reparse(self.root, out, engine="lxml", workers=2), (1, 0, 1))
+        records = [json.loads(line)["PostUrl"] for line in out.getvalue().splitlines()]
+        self.assertEqual(records, ["https://sfbay.craigslist.org/posting.html"])
+
+
+@mock_dynamodb
+class TestWriteTable(unittest.TestCase):
+    def test_same_item_as_handler(self):
+        client = boto3.client("dynamodb", region_name="us-east-1")
+        client.create_table(
+            TableName="apthunt",
+            KeySchema=[{"AttributeName": "intid", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "intid", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        url = saved_page_url("nothumbs.html")
+        parsed = parse_testpage(url)
+
+        # item put_item writes for the page fetched at 100
+        item = {"PostUrl": url}
+        item.update(parsed.to_item())
+        item["intid"] = generate_id(item)
+        item["added"] = 100
+        item["added_day"] = "1970-01-01"
+        expected = parsed.item_attributes(item)
+
+        # reparse record of the same page, after JSON lines round trip
+        record = {"PostUrl": url, "content_hash": "abc", "fetched": 100}
+        record.update(parsed.to_item())
+        self.assertEqual(write_table("apthunt", [json.loads(json.dumps(record))], client=client), [])
+
+        stored = client.get_item(TableName="apthunt", Key={"intid": expected["intid"]})["Item"]
+        self.assertEqual(stored, expected)
+        self.assertNotIn({"NULL": True}, stored.values())
+
+
+class TestS3Archive(ArchiveTests, unittest.TestCase):
+    def setUp(self):
+        s3_mock = mock_s3()
+        s3_mock.start()
+        self.addCleanup(s3_mock.stop)
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="archive")
+        self.archive = PageArchive(S3Backend("archive", "/raw/", client=client))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import io
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+
+from benchmark import main
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_benchmark(self):
+        out = io.StringIO()
+        with redirect_stdout(out):
+            code = main(["--repeat", "1"])
+        self.assertEqual(code, 0)
+        report = out.getvalue()
+        for expected in ("engine: requests_html", "engine: lxml", "posting.html", "removed.html (removed)",
+                         "postingbody", "peak memory", "pages/s"):
+            self.assertIn(expected, report)
+
+    def test_benchmark_regression(self):
+        err = io.StringIO()
+        with redirect_stdout(io.StringIO()), redirect_stderr(err):
+            code = main(["--repeat", "1", "--engine", "lxml", "--max-page-ms", "0"])
+        self.assertEqual(code, 1)
+        self.assertIn("exceeds", err.getvalue())
+
+    def test_benchmark_intid(self):
+        out = io.StringIO()
+        with redirect_stdout(out):
+            code = main(["--repeat", "1", "--intid"])
+        self.assertEqual(code, 0)
+        report = out.getvalue()
+        for expected in ("intid:", "posting.html", "large", "speedup"):
+            self.assertIn(expected, report)
+        self.assertNotIn("removed.html", report)
+
+
+if __name__ == '__main__':
+    unittest.main()
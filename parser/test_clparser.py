@@ -1,12 +1,18 @@
+import base64
+import gzip
 import json
 import random
 import unittest
 from json.decoder import JSONDecodeError
+from unittest import mock
 
 from aws_xray_sdk import global_sdk_config
 from requests_html import HTML
 
-from clparser import parse_request_body, get_bedrooms, parse_price
+from clparser import parse_request_body, parse_request_items, get_bedrooms, parse_price, parse_page, \
+    parse_content, parse_pages, LXML, REQUESTS_HTML, CL404Exception, PostRemovedException
+
+from testutil import BAD_PAGES, fetch_testpage, parse_testpage, saved_page_url
 
 global_sdk_config.set_sdk_enabled(False)
 
@@ -44,6 +50,108 @@ class TestParser(unittest.TestCase):
         data = json.dumps(td)
         self.assertEqual(parse_request_body(data), td)
 
+    def test_parse_items_single(self):
+        self.assertEqual(parse_request_items('{"PostUrl": "a", "text": "x\ny"}'),
+                         ([{"PostUrl": "a", "text": "x\ny"}], False))
+
+    def test_parse_items_batch(self):
+        items = [{"PostUrl": "a"}, {"PostUrl": "b"}]
+        ndjson = "\n".join(json.dumps(item) for item in items) + "\n"
+        for body in (json.dumps(items), ndjson, gzip.compress(ndjson.encode("utf-8"))):
+            with self.subTest(body=body):
+                self.assertEqual(parse_request_items(body), (items, True))
+        encoded = base64.b64encode(gzip.compress(json.dumps(items).encode("utf-8"))).decode("ascii")
+        self.assertEqual(parse_request_items(encoded, base64_encoded=True), (items, True))
+
+    def test_parse_items_bad(self):
+        for body in ("", "{", '{"a": 1}\n{', '["a"]', b"\x1f\x8bnot gzip"):
+            with self.subTest(body=body), self.assertRaises((ValueError, OSError)):
+                parse_request_items(body)
+
+
+class TestEngines(unittest.TestCase):
+    def test_lxml_same_as_requests_html(self):
+        for name in ("posting.html", "nomap.html", "nothumbs.html"):
+            with self.subTest(page=name):
+                expected = parse_testpage(saved_page_url(name), REQUESTS_HTML).to_dict()
+                result = parse_testpage(saved_page_url(name), LXML).to_dict()
+
+                # requests_html returns thumbs in set order
+                if expected["thumbs"] is not None:
+                    self.assertEqual(set(result.pop("thumbs")), set(expected.pop("thumbs")))
+                self.assertEqual(result, expected)
+
+    def test_removed(self):
+        for engine in (REQUESTS_HTML, LXML):
+            with self.subTest(engine=engine):
+                with self.assertRaises(PostRemovedException):
+                    parse_testpage(saved_page_url("removed.html"), engine)
+
+    def test_bad_pages(self):
+        # both engines fail with the errors reparse handles, lxml does not raise TypeError on missing elements
+        for engine in (REQUESTS_HTML, LXML):
+            for name, content in BAD_PAGES.items():
+                with self.subTest(engine=engine, page=name):
+                    with self.assertRaises((ValueError, AttributeError, KeyError)):
+                        parse_content(content, saved_page_url(name), engine=engine)
+
+    def test_nomap(self):
+        result = parse_testpage(saved_page_url("nomap.html"), LXML).to_dict()
+        self.assertIsNone(result["data_latitude"])
+        self.assertIsNone(result["map_address"])
+        self.assertIsNone(result["area"])
+        self.assertEqual(result["bedrooms"], 1.0)
+        self.assertTrue(result["furnished"])
+        self.assertTrue(result["laundryb"])
+
+    def test_nothumbs(self):
+        result = parse_testpage(saved_page_url("nothumbs.html"), LXML).to_dict()
+        self.assertIsNone(result["thumbs"])
+        self.assertIsNone(result["notices"])
+        self.assertEqual(result["nthumbs"], 0)
+        self.assertEqual(result["type"], "house")
+        self.assertIsNone(result["district"])
+
+    def test_lxml_posting(self):
+        result = parse_testpage(saved_page_url("posting.html"), LXML).to_dict()
+        self.assertEqual(result["price"], 3450)
+        self.assertEqual(result["housing"], "2br - 1050ft2")
+        self.assertEqual(result["district"], "mission district")
+        self.assertEqual(result["nthumbs"], 3)
+        self.assertTrue(result["catsok"])
+        self.assertFalse(result["furnished"])
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            parse_page("https://sfbay.craigslist.org/", engine="unknown")
+
+
+class TestParsePages(unittest.TestCase):
+    URLS = [
+        "https://sfbay.craigslist.org/posting.html",
+        "https://sfbay.craigslist.org/removed.html",
+        "https://sfbay.craigslist.org/missing.html",
+    ]
+
+    def check_results(self, results):
+        results = {r.url: r for r in results}
+        self.assertEqual(set(results), set(self.URLS))
+
+        posting = results[self.URLS[0]]
+        self.assertIsNone(posting.error)
+        self.assertEqual(posting.result["price"], 3450)
+
+        self.assertIsInstance(results[self.URLS[1]].error, PostRemovedException)
+        self.assertIsInstance(results[self.URLS[2]].error, CL404Exception)
+
+    @mock.patch("clparser.fetch_content", fetch_testpage)
+    def test_parse_pages(self):
+        self.check_results(list(parse_pages(self.URLS * 3, max_concurrency=4, engine=LXML)))
+
+    @mock.patch("clparser.fetch_content", fetch_testpage)
+    def test_parse_pages_process_pool(self):
+        self.check_results(list(parse_pages(self.URLS, max_concurrency=2, engine=LXML, parse_workers=2)))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,44 @@
+import os
+import re
+import subprocess
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# packages that must not be imported on lambda cold start. They are loaded on first use
+LAZY_PACKAGES = {"boto3", "botocore", "requests_html", "pyppeteer", "lxml", "pyquery"}
+
+# cumulative import time budget of the handler module, microseconds
+BUDGET_US = int(os.getenv("COLDSTART_BUDGET_MS", "350")) * 1000
+
+IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def import_handler():
+    """import handler in a fresh interpreter. return {module: cumulative import time in us}"""
+    env = dict(os.environ, AWS_DEFAULT_REGION="us-west-1")
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import handler"],
+                          cwd=HERE, env=env, stderr=subprocess.PIPE, check=True, universal_newlines=True)
+    modules = {}
+    for line in proc.stderr.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if match:
+            modules[match.group(4)] = int(match.group(2))
+    return modules
+
+
+class TestColdStart(unittest.TestCase):
+    def test_lazy_modules(self):
+        imported = import_handler()
+        lazy = {m for m in imported if m.split(".")[0] in LAZY_PACKAGES or m.startswith("aws_xray_sdk.core")}
+        self.assertEqual(lazy, set())
+
+    def test_import_time(self):
+        # best of several runs to cut noise
+        best = min(import_handler()["handler"] for _ in range(3))
+        self.assertLess(best, BUDGET_US, "handler import takes {} ms".format(best / 1000))
+
+
+if __name__ == '__main__':
+    unittest.main()
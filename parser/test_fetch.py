@@ -0,0 +1,109 @@
+import gzip
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from aws_xray_sdk import global_sdk_config
+
+import fetch
+from clparser import get_page, CL404Exception, LXML
+from testutil import read_testpage
+
+global_sdk_config.set_sdk_enabled(False)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def send_body(self, status, body, encoding=None):
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        server.clients.add(self.client_address)
+        if self.path == "/posting.html":
+            self.send_body(200, gzip.compress(read_testpage("posting.html")), encoding="gzip")
+        elif self.path == "/flaky":
+            server.flaky += 1
+            if server.flaky < 3:
+                self.send_body(503, b"unavailable")
+            else:
+                self.send_body(200, b"ok")
+        elif self.path == "/down":
+            self.send_body(503, b"unavailable")
+        else:
+            self.send_body(404, b"not found")
+
+
+class TestFetch(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.base_url = "http://127.0.0.1:{}".format(cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.requests = 0
+        self.server.flaky = 0
+        self.server.clients = set()
+        fetch.close()
+        self.addCleanup(fetch.close)
+
+    def test_shared_session(self):
+        self.assertIs(fetch.get_session(), fetch.get_session())
+
+    def test_gzip(self):
+        resp = fetch.get(self.base_url + "/posting.html")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"postingtitletext", resp.content)
+
+    def test_keep_alive(self):
+        for _ in range(5):
+            fetch.get(self.base_url + "/posting.html")
+        self.assertEqual(self.server.requests, 5)
+        self.assertEqual(len(self.server.clients), 1)
+
+    def test_retry(self):
+        fetch._SESSION = fetch.new_session(backoff_factor=0)  # pylint: disable=protected-access
+        resp = fetch.get(self.base_url + "/flaky")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.server.flaky, 3)
+
+    def test_retries_exhausted(self):
+        fetch._SESSION = fetch.new_session(retries=2, backoff_factor=0)  # pylint: disable=protected-access
+        resp = fetch.get(self.base_url + "/down")
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(self.server.requests, 3)
+
+    def test_no_retry_404(self):
+        resp = fetch.get(self.base_url + "/missing")
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(self.server.requests, 1)
+
+    def test_get_page(self):
+        post_body = get_page(self.base_url + "/posting.html", engine=LXML)
+        self.assertIsNotNone(post_body)
+
+    def test_get_page_404(self):
+        with self.assertRaises(CL404Exception):
+            get_page(self.base_url + "/missing")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,31 @@
+import base64
+import gzip
+import io
 import json
 import random
 import time
 import unittest
 from decimal import Decimal
+from contextlib import redirect_stdout
+from unittest import mock
 
 import boto3
-from moto import mock_sqs
+from aws_xray_sdk import global_sdk_config
+from moto import mock_dynamodb, mock_sqs
 
-from handler import get_md5, prepare4dynamo, que_thumbs
+import handler
+from clparser import parse_page as handler_parse_page, PostRemovedException
+from handler import generate_id, get_md5, prepare4dynamo, que_thumbs
+from outbox import Outbox
+from testutil import fetch_testpage, parse_testpage
+from urlindex import UrlIndex
+
+global_sdk_config.set_sdk_enabled(False)
+
+
+def sqs_record(message_id, body):
+    return {"messageId": message_id, "receiptHandle": "handle-" + message_id, "body": body,
+            "eventSource": "aws:sqs"}
 
 
 class TestHandler(unittest.TestCase):
@@ -131,5 +149,265 @@ class TestHandler(unittest.TestCase):
         self.assertEqual(get_md5(data).hexdigest(), "e0614921e306095859c904e487c29f17")
 
 
+class TestAddedDay(unittest.TestCase):
+    def test_utc_date(self):
+        self.assertEqual(handler.added_day(0), "1970-01-01")
+        self.assertEqual(handler.added_day(1620950399999), "2021-05-13")
+        self.assertEqual(handler.added_day(1620950400000), "2021-05-14")
+
+
+class TestGenerateId(unittest.TestCase):
+    """digests are ids of the legacy deepcopy + get_md5 generate_id, so ids of stored postings do not change"""
+
+    def test_testpages(self):
+        expected = {
+            "posting.html": "912aa00cc61974862727009d9d753a11",
+            "nomap.html": "645af5bdd00ad36b691a418ac8b095f1",
+            "nothumbs.html": "520b1330b4c2d5b09d0f327bd792cc7c",
+        }
+        for name, digest in expected.items():
+            with self.subTest(name=name):
+                url = "https://sfbay.craigslist.org/" + name
+                item = {"PostUrl": url, "SubmittedBy": "test"}
+                item.update(parse_testpage(url).to_item())
+                self.assertEqual(generate_id(item), digest)
+
+    def test_values(self):
+        items = [
+            ({"PostUrl": "u"}, "d41d8cd98f00b204e9800998ecf8427e"),
+            ({"PostUrl": "u", "a": None, "b": True, "c": False, "d": 0, "e": 1, "f": 1.0, "g": Decimal("1.5")},
+             "eb64a24f28ce99de1f1414d8fc8554ab"),
+            ({"PostUrl": "u", "nested": {"z": [[], {}, [None, "ы"]], "a": {"b": {"c": ["d"]}}}},
+             "17ceb98e7371e0ac7104c110dd688980"),
+            ({"PostUrl": "u", "thumbs": ["https://images.craigslist.org/{}_50x50c.jpg".format(i) for i in range(100)],
+              "parsed_postingbody": "long body " * 10000},
+             "a59df6fa30668ae84c69ddd3fa7dad8d"),
+        ]
+        for item, digest in items:
+            with self.subTest(item=item):
+                self.assertEqual(generate_id(item), digest)
+
+    def test_known_id(self):
+        data = {"PostUrl": "https://sfbay.craigslist.org/1.html", "a": 100500, "b": 1056, "c": ["ba", "bu", "nm"]}
+        self.assertEqual(generate_id(data), "e17234cd2697951f7e0116945d11d824")
+        self.assertIn("PostUrl", data)
+
+
+@mock_dynamodb
+@mock_sqs
+class TestSQSHandler(unittest.TestCase):
+    def setUp(self):
+        dynamo = boto3.resource("dynamodb", region_name="us-east-1")
+        self.table = dynamo.create_table(
+            TableName="apthunt",
+            KeySchema=[{"AttributeName": "intid", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "intid", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        self.url_table = dynamo.create_table(
+            TableName="apthunt-urls",
+            KeySchema=[{"AttributeName": "PostUrl", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "PostUrl", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        self.index = UrlIndex(self.url_table, ttl=3600)
+        self.client = boto3.client("dynamodb", region_name="us-east-1")
+        self.sqs = boto3.client("sqs", region_name="us-east-1")
+        thumbs_url = self.sqs.create_queue(QueueName="thumbs")["QueueUrl"]
+        self.processor_url = self.sqs.create_queue(QueueName="processor")["QueueUrl"]
+        self.thumbs_url = thumbs_url
+        self.outbox = Outbox(self.sqs)
+
+        for target, value in (("get_table", lambda: self.table), ("get_sqs", lambda: self.sqs),
+                              ("get_outbox", lambda: self.outbox),
+                              ("dynamodb_client", lambda: self.client),
+                              ("get_index", lambda: self.index),
+                              ("parse_page", parse_testpage), ("SQS_QUEUE_URL", thumbs_url),
+                              ("SQS_PR_QUEUE_URL", self.processor_url), ("BATCH_WRITE_BACKOFF", 0)):
+            patcher = mock.patch.object(handler, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_sqs_handler(self):
+        event = {"Records": [
+            sqs_record("1", json.dumps({"PostUrl": "https://sfbay.craigslist.org/posting.html"})),
+            sqs_record("2", json.dumps({"PostUrl": "https://sfbay.craigslist.org/nomap.html"})),
+            sqs_record("3", "{not json"),
+            sqs_record("4", json.dumps({"PostUrl": "https://sfbay.craigslist.org/removed.html"})),
+            sqs_record("5", json.dumps({"PostUrl": "https://sfbay.craigslist.org/missing.html"})),
+        ]}
+
+        def parse_page(page_url, engine=None):
+            if page_url.endswith("removed.html"):
+                raise PostRemovedException(page_url)
+            return parse_testpage(page_url, engine)
+
+        with mock.patch.object(handler, "parse_page", parse_page), self.assertLogs(level="ERROR"):
+            resp = handler.sqs_handler(event, None)
+
+        # bad json and missing page fail, removed is done
+        self.assertEqual(sorted(f["itemIdentifier"] for f in resp["batchItemFailures"]), ["3", "5"])
+        items = self.table.scan()["Items"]
+        self.assertEqual(sorted(i["PostUrl"] for i in items),
+                         ["https://sfbay.craigslist.org/nomap.html", "https://sfbay.craigslist.org/posting.html"])
+        messages = self.sqs.receive_message(QueueUrl=self.processor_url, MaxNumberOfMessages=10)["Messages"]
+        self.assertEqual(len(messages), 2)
+
+    def test_sqs_handler_duplicates(self):
+        body = json.dumps({"PostUrl": "https://sfbay.craigslist.org/posting.html"})
+        event = {"Records": [sqs_record("1", body), sqs_record("2", body)]}
+
+        resp = handler.sqs_handler(event, None)
+        self.assertEqual(resp, {"batchItemFailures": []})
+        self.assertEqual(self.table.scan()["Count"], 1)
+
+        # same posting again, url index record expired: found in the table
+        self.url_table.delete_item(Key={"PostUrl": "https://sfbay.craigslist.org/posting.html"})
+        resp = handler.sqs_handler(event, None)
+        self.assertEqual(resp, {"batchItemFailures": []})
+        self.assertEqual(self.table.scan()["Count"], 1)
+        messages = self.sqs.receive_message(QueueUrl=self.processor_url, MaxNumberOfMessages=10)["Messages"]
+        self.assertEqual(len(messages), 1)
+
+    def test_put_item(self):
+        url = "https://sfbay.craigslist.org/posting.html"
+        parse_page = mock.Mock(side_effect=parse_testpage)
+        with mock.patch.object(handler, "parse_page", parse_page):
+            handler.put_item({"PostUrl": url})
+            # seen recently: page is not fetched
+            self.assertEqual(handler.put_item({"PostUrl": url})["message"], "seen recently")
+            self.assertEqual(parse_page.call_count, 1)
+
+            # recheck after ttl: page is fetched, existing item is not overwritten
+            self.index.ttl = 0
+            self.url_table.put_item(Item=self.index.record(url, now=time.time() - 1))
+            resp = handler.put_item({"PostUrl": url})
+            self.assertIn("duplicate", resp)
+            self.assertEqual(parse_page.call_count, 2)
+        handler.flush_outbox()
+
+        self.assertEqual(self.table.scan()["Count"], 1)
+        stored = self.client.get_item(TableName="apthunt", Key={"intid": {"S": resp["duplicate"]["intid"]}})["Item"]
+        self.assertEqual(stored["parsed_price"], {"N": "3450"})
+        self.assertNotIn({"NULL": True}, stored.values())
+        self.assertEqual(stored["added_day"], {"S": handler.added_day(int(stored["added"]["N"]))})
+        index_item = self.url_table.get_item(Key={"PostUrl": url})["Item"]
+        self.assertEqual(index_item["intid"], resp["duplicate"]["intid"])
+        messages = self.sqs.receive_message(QueueUrl=self.processor_url, MaxNumberOfMessages=10)["Messages"]
+        self.assertEqual(len(messages), 1)
+
+    def test_put_item_recheck(self):
+        url = "https://sfbay.craigslist.org/posting.html"
+        parse_page = mock.Mock(side_effect=parse_testpage)
+        with mock.patch.object(handler, "parse_page", parse_page):
+            handler.put_item({"PostUrl": url})
+            # seen recently, but posting row changed: page is fetched again
+            resp = handler.put_item({"PostUrl": url, "Recheck": True})
+            self.assertEqual(parse_page.call_count, 2)
+        handler.flush_outbox()
+
+        self.assertIn("duplicate", resp)  # same page content
+        self.assertNotIn("Recheck", resp["duplicate"])
+        stored = self.client.get_item(TableName="apthunt", Key={"intid": {"S": resp["duplicate"]["intid"]}})["Item"]
+        self.assertNotIn("Recheck", stored)
+
+    def test_metrics(self):
+        event = {"Records": [
+            sqs_record("1", json.dumps({"PostUrl": "https://sfbay.craigslist.org/posting.html"})),
+            sqs_record("2", json.dumps({"PostUrl": "https://sfbay.craigslist.org/posting.html"})),
+            sqs_record("3", json.dumps({"PostUrl": "https://sfbay.craigslist.org/removed.html"})),
+        ]}
+
+        out = io.StringIO()
+        with mock.patch.object(handler, "parse_page", handler_parse_page), \
+                mock.patch("clparser.fetch_content", fetch_testpage), redirect_stdout(out):
+            handler.sqs_handler(event, None)
+
+        record = json.loads(out.getvalue().splitlines()[-1])
+        names = {m["Name"] for m in record["_aws"]["CloudWatchMetrics"][0]["Metrics"]}
+        for stage in ("get_page", "parse", "generate_id", "item_exist", "dynamo_batch_write", "sqs_send",
+                      "url_seen"):
+            self.assertIn(stage, names)
+        self.assertEqual(len(record["get_page"]), 3)
+        self.assertEqual(record["removed"], 1)
+        self.assertEqual(record["duplicate"], 1)
+        self.assertEqual(record["saved"], 1)
+        self.assertEqual(record["failed"], 0)
+
+    def test_handler_flush(self):
+        event = {"body": json.dumps({"PostUrl": "https://sfbay.craigslist.org/posting.html"})}
+        with mock.patch.object(self.sqs, "send_message_batch", wraps=self.sqs.send_message_batch) as send, \
+                redirect_stdout(io.StringIO()):
+            resp = handler.handler(event, None)
+        self.assertEqual(resp["statusCode"], "200")
+        self.assertEqual(len(self.outbox), 0)
+        self.assertEqual(send.call_count, 2)  # thumbs and processor queues
+        for queue_url in (self.thumbs_url, self.processor_url):
+            messages = self.sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)["Messages"]
+            self.assertEqual(len(messages), 1)
+
+    def test_handler_batch(self):
+        urls = ["https://sfbay.craigslist.org/{}".format(name)
+                for name in ("posting.html", "nomap.html", "posting.html", "removed.html", "missing.html")]
+        ndjson = "".join(json.dumps({"PostUrl": url}) + "\n" for url in urls)
+        event = {"body": base64.b64encode(gzip.compress(ndjson.encode("utf-8"))).decode("ascii"),
+                 "isBase64Encoded": True}
+
+        def parse_page(page_url, engine=None):
+            if page_url.endswith("removed.html"):
+                raise PostRemovedException(page_url)
+            return parse_testpage(page_url, engine)
+
+        with mock.patch.object(handler, "parse_page", parse_page), self.assertLogs(level="ERROR"), \
+                redirect_stdout(io.StringIO()):
+            resp = handler.handler(event, None)
+
+        self.assertEqual(resp["statusCode"], "200")
+        results = json.loads(resp["body"])["results"]
+        self.assertEqual([r["PostUrl"] for r in results], urls)
+        statuses = [r["status"] for r in results]
+        self.assertEqual(statuses[1], "saved")
+        self.assertEqual(sorted(statuses[0:3:2]), ["duplicate", "saved"])
+        self.assertEqual(statuses[3:], ["removed", "error"])
+        self.assertEqual(self.table.scan()["Count"], 2)
+        messages = self.sqs.receive_message(QueueUrl=self.processor_url, MaxNumberOfMessages=10)["Messages"]
+        self.assertEqual(len(messages), 2)
+
+    def test_handler_batch_limit(self):
+        event = {"body": json.dumps([{"PostUrl": str(i)} for i in range(handler.MAX_BATCH_ITEMS + 1)])}
+        with redirect_stdout(io.StringIO()):
+            resp = handler.handler(event, None)
+        self.assertEqual(resp["statusCode"], "400")
+
+    def test_sqs_handler_batches(self):
+        urls = ["https://sfbay.craigslist.org/{}".format(name) for name in ("posting.html", "nomap.html")]
+        event = {"Records": [sqs_record(str(i), json.dumps({"PostUrl": url})) for i, url in enumerate(urls)]}
+        with mock.patch.object(self.sqs, "send_message_batch", wraps=self.sqs.send_message_batch) as send, \
+                mock.patch.object(self.sqs, "send_message", wraps=self.sqs.send_message) as send_one:
+            handler.sqs_handler(event, None)
+        self.assertEqual(send.call_count, 2)
+        self.assertEqual(send_one.call_count, 0)
+        messages = self.sqs.receive_message(QueueUrl=self.thumbs_url, MaxNumberOfMessages=10)["Messages"]
+        self.assertEqual(len(messages), 2)
+
+    def test_removed_marked(self):
+        url = "https://sfbay.craigslist.org/removed.html"
+        handler.put_item({"PostUrl": url})
+        self.assertTrue(self.index.seen(url))
+        self.assertNotIn("intid", self.url_table.get_item(Key={"PostUrl": url})["Item"])
+
+    def test_write_items_unprocessed(self):
+        def batch_write_item(RequestItems):  # pylint: disable=invalid-name
+            return {"UnprocessedItems": RequestItems}
+
+        event = {"Records": [sqs_record("1", json.dumps({"PostUrl": "https://sfbay.craigslist.org/posting.html"}))]}
+        with mock.patch.object(self.client, "batch_write_item", side_effect=batch_write_item) as write, \
+                self.assertLogs(level="ERROR"):
+            resp = handler.sqs_handler(event, None)
+
+        self.assertEqual(resp, {"batchItemFailures": [{"itemIdentifier": "1"}]})
+        self.assertEqual(write.call_count, handler.BATCH_WRITE_RETRIES + 1)
+
+
 if __name__ == '__main__':
     unittest.main()
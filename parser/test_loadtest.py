@@ -0,0 +1,43 @@
+import io
+import unittest
+from collections import Counter
+from contextlib import redirect_stderr, redirect_stdout
+
+from loadtest import main, plan_requests, DUPLICATE, NEW, REMOVED
+
+
+class TestLoadTest(unittest.TestCase):
+    def test_plan(self):
+        planned = plan_requests("http://local", 200, 0.2, 0.1, seed=1)
+        kinds = Counter(kind for kind, _ in planned)
+        self.assertEqual(sum(kinds.values()), 200)
+        self.assertTrue(0 < kinds[DUPLICATE] < kinds[NEW])
+        self.assertTrue(0 < kinds[REMOVED] < kinds[NEW])
+        new_urls = [url for kind, url in planned if kind == NEW]
+        self.assertEqual(len(new_urls), len(set(new_urls)))
+        self.assertTrue(all(url in new_urls for kind, url in planned if kind == DUPLICATE))
+        self.assertEqual(planned, plan_requests("http://local", 200, 0.2, 0.1, seed=1))
+
+    def test_loadtest(self):
+        planned = Counter(kind for kind, _ in plan_requests("http://local", 30, 0.2, 0.1, seed=3))
+        out = io.StringIO()
+        with redirect_stdout(out):
+            code = main(["--requests", "30", "--concurrency", "4", "--engine", "lxml", "--seed", "3",
+                         "--duplicate-ratio", "0.2", "--removed-ratio", "0.1"])
+        self.assertEqual(code, 0)
+        report = out.getvalue()
+        for expected in ("requests/s", "items/s", "p99"):
+            self.assertIn(expected, report)
+        for name, kind in (("saved", NEW), ("duplicate", DUPLICATE), ("removed", REMOVED)):
+            self.assertRegex(report, r"{}\s+{}\s".format(name, planned[kind]))
+
+    def test_min_rps(self):
+        err = io.StringIO()
+        with redirect_stdout(io.StringIO()), redirect_stderr(err):
+            code = main(["--requests", "3", "--engine", "lxml", "--min-rps", "1000000"])
+        self.assertEqual(code, 1)
+        self.assertIn("lower than", err.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
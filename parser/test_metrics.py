@@ -0,0 +1,88 @@
+import io
+import json
+import math
+import unittest
+from contextlib import redirect_stdout
+
+import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def test_percentile(self):
+        self.assertEqual(metrics.percentile([3, 1, 2], 50), 2)
+        self.assertAlmostEqual(metrics.percentile(range(1, 101), 99), 99.01)
+        self.assertTrue(math.isnan(metrics.percentile([], 50)))
+
+    def test_summary(self):
+        collected = metrics.Metrics()
+        for value in range(1, 101):
+            collected.record("stage", float(value))
+        summary = collected.summary()["stage"]
+        self.assertEqual(summary["count"], 100)
+        self.assertAlmostEqual(summary["p50"], 50.5)
+        self.assertEqual(summary["max"], 100.0)
+
+    def test_to_emf(self):
+        collected = metrics.Metrics()
+        for value in range(250):
+            collected.record("fetch", value / 7)
+        collected.record("parse", 1.23456)
+        collected.count("removed")
+        collected.count("removed")
+        record = collected.to_emf(timestamp=1600000000000)
+
+        self.assertEqual(record["_aws"]["Timestamp"], 1600000000000)
+        definition = record["_aws"]["CloudWatchMetrics"][0]
+        self.assertEqual(definition["Dimensions"], [["Service"]])
+        self.assertEqual(definition["Metrics"], [
+            {"Name": "fetch", "Unit": "Milliseconds"},
+            {"Name": "parse", "Unit": "Milliseconds"},
+            {"Name": "removed", "Unit": "Count"},
+        ])
+        self.assertEqual(len(record["fetch"]), metrics.MAX_VALUES)
+        self.assertEqual(record["fetch"][0], 0)
+        self.assertEqual(record["fetch"][-1], round(249 / 7, 3))
+        self.assertEqual(record["parse"], [1.235])
+        self.assertEqual(record["removed"], 2)
+
+    def test_not_collecting(self):
+        self.assertIsNone(metrics.current())
+        with metrics.timer("stage"):
+            metrics.count("counter")
+        self.assertIsNone(metrics.current())
+
+    def test_collect(self):
+        @metrics.timed("inner")
+        def inner():
+            metrics.count("calls")
+            return 1
+
+        @metrics.collect
+        def invocation():
+            inner()
+            return inner()
+
+        out = io.StringIO()
+        with redirect_stdout(out):
+            self.assertEqual(invocation(), 1)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        record = json.loads(lines[0])
+        self.assertEqual(len(record["inner"]), 2)
+        self.assertEqual(record["calls"], 2)
+        self.assertIsNone(metrics.current())
+
+    def test_collect_error(self):
+        @metrics.collect
+        def invocation():
+            metrics.count("calls")
+            raise ValueError("boom")
+
+        out = io.StringIO()
+        with redirect_stdout(out), self.assertRaises(ValueError):
+            invocation()
+        self.assertEqual(json.loads(out.getvalue())["calls"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
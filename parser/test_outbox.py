@@ -0,0 +1,103 @@
+import json
+import unittest
+from unittest import mock
+
+import boto3
+from moto import mock_sqs
+
+from outbox import Message, Outbox, MAX_BATCH_BYTES
+
+
+class TestOutbox(unittest.TestCase):
+    def setUp(self):
+        m = mock_sqs()
+        m.start()
+        self.addCleanup(m.stop)
+        self.sqs = boto3.client("sqs", region_name="us-east-1")
+        self.queue_url = self.sqs.create_queue(QueueName="test")["QueueUrl"]
+        self.other_url = self.sqs.create_queue(QueueName="other")["QueueUrl"]
+
+    def receive(self, queue_url):
+        received = []
+        while True:
+            messages = self.sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10).get("Messages", [])
+            if not messages:
+                return received
+            received.extend(m["Body"] for m in messages)
+
+    def test_flush(self):
+        outbox = Outbox(self.sqs)
+        with mock.patch.object(self.sqs, "send_message_batch", wraps=self.sqs.send_message_batch) as send:
+            for i in range(25):
+                outbox.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(i))
+            outbox.send_message(QueueUrl=self.other_url, MessageBody="other")
+            # full batches are sent right away
+            self.assertEqual(send.call_count, 2)
+            self.assertEqual(len(outbox), 6)
+            self.assertEqual(outbox.flush(), [])
+            self.assertEqual(send.call_count, 4)
+        self.assertEqual(len(outbox), 0)
+        self.assertEqual(sorted(self.receive(self.queue_url), key=int), [json.dumps(i) for i in range(25)])
+        self.assertEqual(self.receive(self.other_url), ["other"])
+
+    def test_size_limit(self):
+        outbox = Outbox(self.sqs)
+        body = "x" * (100 * 1024)
+        with mock.patch.object(self.sqs, "send_message_batch", wraps=self.sqs.send_message_batch) as send:
+            for _ in range(5):
+                outbox.send_message(QueueUrl=self.queue_url, MessageBody=body)
+            outbox.flush()
+        self.assertEqual(send.call_count, 3)  # 2 + 2 + 1 messages
+        for call in send.call_args_list:
+            self.assertLessEqual(sum(len(e["MessageBody"]) for e in call[1]["Entries"]), MAX_BATCH_BYTES)
+        self.assertEqual(len(self.receive(self.queue_url)), 5)
+
+    def test_pack(self):
+        outbox = Outbox(self.sqs, max_messages=3, max_bytes=10)
+        messages = [Message(str(i), body, len(body))
+                    for i, body in enumerate(("aaaa", "bbbb", "cc", "d", "e", "f", "gggggggggg", "ы"))]
+        messages[-1] = Message("7", "ы", 2)
+        batches = outbox.pack(messages)
+        self.assertEqual([[m.body for m in batch] for batch in batches],
+                         [["aaaa", "bbbb", "cc"], ["d", "e", "f"], ["gggggggggg"], ["ы"]])
+
+    def test_failed_entries_retried(self):
+        outbox = Outbox(self.sqs)
+
+        def send_message_batch(QueueUrl, Entries):  # pylint: disable=invalid-name
+            failed = [{"Id": e["Id"], "SenderFault": False, "Code": "InternalError"} for e in Entries[1:]]
+            return {"Successful": [], "Failed": failed}
+
+        with mock.patch.object(self.sqs, "send_message_batch", side_effect=send_message_batch), \
+                mock.patch.object(self.sqs, "send_message", wraps=self.sqs.send_message) as send_one:
+            for body in ("1", "2", "3"):
+                outbox.send_message(QueueUrl=self.queue_url, MessageBody=body)
+            self.assertEqual(outbox.flush(), [])
+        self.assertEqual([c[1]["MessageBody"] for c in send_one.call_args_list], ["2", "3"])
+        self.assertEqual(sorted(self.receive(self.queue_url)), ["2", "3"])
+
+    def test_full_batch_failed(self):
+        outbox = Outbox(self.sqs, max_messages=3)
+
+        def send_message_batch(QueueUrl, Entries):  # pylint: disable=invalid-name
+            failed = [{"Id": e["Id"], "SenderFault": False, "Code": "InternalError"} for e in Entries[1:2]]
+            return {"Successful": [], "Failed": failed}
+
+        with mock.patch.object(self.sqs, "send_message_batch", side_effect=send_message_batch), \
+                mock.patch.object(self.sqs, "send_message", side_effect=RuntimeError("unavailable")), \
+                self.assertLogs(level="ERROR"):
+            for body in ("1", "2", "3"):
+                outbox.send_message(QueueUrl=self.queue_url, MessageBody=body)
+            self.assertEqual(len(outbox), 0)  # full batch was sent right away
+            self.assertEqual(outbox.flush(), ["2"])
+        self.assertEqual(outbox.flush(), [])
+
+    def test_failed(self):
+        outbox = Outbox(self.sqs)
+        outbox.send_message(QueueUrl=self.queue_url + "-missing", MessageBody="lost")
+        with self.assertLogs(level="ERROR"):
+            self.assertEqual(outbox.flush(), ["lost"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import pickle
+import unittest
+from decimal import Decimal
+
+from boto3.dynamodb.types import TypeSerializer
+
+from handler import prepare4dynamo
+from posting import attribute_value, ParsedPosting, SCHEMA
+
+
+def sample_posting():
+    posting = ParsedPosting(
+        postingtitletext="$3,450/ 2br - 1050ft2 - Sunny 2BR (mission district)",
+        price_text="$3,450",
+        price=3450,
+        housing="2br - 1050ft2",
+        titletextonly="Sunny 2BR",
+        district="mission district",
+        thumbs=["t1", "t2"],
+        data_latitude=37.7593,
+        data_longitude=-122.4256,
+        attrs=["2BR / 1Ba", "cats are OK - purrr", "apartment", "w/d in unit", "condo", "apartment"],
+        postingbody="body",
+        bedrooms=2.0,
+        area=1050.0,
+        nthumbs=2,
+    )
+    posting.apply_attrs()
+    return posting
+
+
+class TestParsedPosting(unittest.TestCase):
+    def test_defaults(self):
+        posting = ParsedPosting()
+        self.assertEqual(posting.to_dict(), {field.name: None for field in SCHEMA})
+
+    def test_slots(self):
+        with self.assertRaises(AttributeError):
+            ParsedPosting().unknown = 1
+
+    def test_unknown_field(self):
+        with self.assertRaises(TypeError):
+            ParsedPosting(unknown=1)
+
+    def test_apply_attrs(self):
+        posting = sample_posting()
+        self.assertEqual(posting.type, "apartment,condo")
+        self.assertTrue(posting.catsok)
+        self.assertTrue(posting.wd)
+        for name in ("dogsok", "garagea", "garaged", "furnished", "laundryb", "laundrys"):
+            self.assertIs(posting[name], False)
+
+    def test_apply_attrs_no_attrs(self):
+        posting = ParsedPosting()
+        posting.apply_attrs()
+        self.assertIsNone(posting.type)
+        self.assertIs(posting.catsok, False)
+
+    def test_to_item(self):
+        posting = sample_posting()
+        # same as extending item with "parsed_" + key for every result field
+        expected = {"parsed_" + key: value for key, value in posting.to_dict().items()}
+        self.assertEqual(posting.to_item(), expected)
+
+    def test_to_item_no_district(self):
+        posting = sample_posting()
+        posting.district = None
+        self.assertNotIn("parsed_district", posting.to_item())
+
+    def test_to_message(self):
+        msg = sample_posting().to_message("http://url")
+        self.assertEqual(msg, {
+            "latitude": 37.7593,
+            "longitude": -122.4256,
+            "district": "mission district",
+            "housing": "2br - 1050ft2",
+            "bedrooms": 2.0,
+            "area": 1050.0,
+            "type": "apartment,condo",
+            "catsok": True,
+            "dogsok": False,
+            "garagea": False,
+            "garaged": False,
+            "furnished": False,
+            "laundryb": False,
+            "laundrys": False,
+            "wd": True,
+            "nthumbs": 2,
+            "price": 3450,
+            "url": "http://url",
+        })
+
+    def test_to_attributes(self):
+        serializer = TypeSerializer()
+        for posting in (sample_posting(), ParsedPosting()):
+            # same as boto3 resource serialization of prepare4dynamo item, without None values
+            item = prepare4dynamo(posting.to_item())
+            expected = {key: serializer.serialize(value) for key, value in item.items() if value is not None}
+            self.assertEqual(posting.to_attributes(), expected)
+
+    def test_item_attributes(self):
+        posting = sample_posting()
+        item = {"PostUrl": "http://url", "intid": "id", "added": 1600000000000, "note": None,
+                "extra": {"a": [1.5, None, True]}, "parsed_price": 1}
+        attrs = posting.item_attributes(item)
+        self.assertEqual(attrs["PostUrl"], {"S": "http://url"})
+        self.assertEqual(attrs["added"], {"N": "1600000000000"})
+        self.assertEqual(attrs["extra"], {"M": {"a": {"L": [{"N": "1.5"}, {"NULL": True}, {"BOOL": True}]}}})
+        self.assertEqual(attrs["parsed_price"], {"N": "3450"})
+        self.assertNotIn("note", attrs)
+
+    def test_attribute_value(self):
+        self.assertEqual(attribute_value(Decimal("1.25")), {"N": "1.25"})
+        self.assertEqual(attribute_value(False), {"BOOL": False})
+        with self.assertRaises(TypeError):
+            attribute_value(float("nan"))
+        with self.assertRaises(TypeError):
+            attribute_value(object())
+
+    def test_dict_access(self):
+        posting = sample_posting()
+        self.assertEqual(posting["price"], 3450)
+        self.assertEqual(posting.get("thumbs"), ["t1", "t2"])
+        self.assertIsNone(posting.get("unknown"))
+        with self.assertRaises(KeyError):
+            _ = posting["unknown"]
+
+    def test_pickle(self):
+        posting = sample_posting()
+        self.assertEqual(pickle.loads(pickle.dumps(posting)), posting)
+
+
+if __name__ == '__main__':
+    unittest.main()
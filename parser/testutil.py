@@ -0,0 +1,39 @@
+"""saved craigslist pages for tests"""
+import os
+
+from clparser import parse_content, CL404Exception, LXML
+
+TESTPAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "testpages")
+
+
+def saved_page_url(name):
+    return "https://sfbay.craigslist.org/" + name
+
+
+def read_testpage(name):
+    """content of saved page `name`"""
+    with open(os.path.join(TESTPAGES, name), "rb") as page:
+        return page.read()
+
+
+# pages the parser has to fail on: no posting body, posting without title, map without coordinates
+BAD_PAGES = {
+    "notposting.html": b"<html><body><p>Nothing here</p></body></html>",
+    "notitle.html": b'<html><body><section class="body"><section class="userbody"><div class="mapAndAttrs"></div>'
+                    b'<section id="postingbody">text</section></section></section></body></html>',
+    "nocoords.html": read_testpage("posting.html").replace(b"data-latitude", b"data-lat"),
+}
+
+
+def fetch_testpage(page_url):
+    """stub for fetch_content serving pages from TESTPAGES by the last part of url"""
+    name = page_url.rsplit("/", 1)[-1]
+    if not os.path.exists(os.path.join(TESTPAGES, name)):
+        raise CL404Exception(page_url)
+    return read_testpage(name), "utf-8"
+
+
+def parse_testpage(page_url, engine=None):
+    """stub for parse_page parsing pages from TESTPAGES with LXML by default. return ParsedPosting"""
+    content = read_testpage(page_url.rsplit("/", 1)[-1])
+    return parse_content(content, page_url, engine=engine or LXML)
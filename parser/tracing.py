@@ -0,0 +1,56 @@
+"""lazy X-Ray tracing.
+
+aws_xray_sdk.core (and botocore with it) is imported on the first traced call instead of at import time,
+to keep it off the lambda cold start path of modules that are imported but not used."""
+import functools
+import os
+
+
+@functools.lru_cache(maxsize=None)
+def recorder():
+    """return xray_recorder. Imported on first use"""
+    from aws_xray_sdk.core import xray_recorder  # type: ignore # pylint: disable=import-outside-toplevel
+    return xray_recorder
+
+
+def capture(name):
+    """lazy version of `xray_recorder.capture(name)` decorator"""
+    def decorator(func):
+        traced = None
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            nonlocal traced
+            if traced is None:
+                traced = recorder().capture(name)(func)
+            return traced(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@functools.lru_cache(maxsize=None)
+def patched_boto3():
+    """return boto3 with X-Ray patching applied. Imported and patched on first use"""
+    from aws_xray_sdk.core import patch  # type: ignore # pylint: disable=import-outside-toplevel
+    patch(['boto3', 'botocore'])
+    import boto3  # pylint: disable=import-outside-toplevel
+    return boto3
+
+
+def dynamodb_endpoint():
+    """DynamoDB endpoint url. Local DynamoDB in SAM local, None otherwise"""
+    return "http://dynamodb:8000" if os.getenv("AWS_SAM_LOCAL", "") else None
+
+
+@functools.lru_cache(maxsize=None)
+def dynamodb():
+    """shared DynamoDB resource"""
+    return patched_boto3().resource('dynamodb', endpoint_url=dynamodb_endpoint())
+
+
+@functools.lru_cache(maxsize=None)
+def dynamodb_client():
+    """shared low-level DynamoDB client: takes and returns `AttributeValue` maps as is.
+
+    Note: `resource.meta.client` is not low-level, it converts python values."""
+    return patched_boto3().client('dynamodb', endpoint_url=dynamodb_endpoint())
@@ -0,0 +1,81 @@
+"""url -> last seen index.
+
+Checked before fetching the page: url seen less than `URL_RECHECK_TTL` seconds ago is not fetched again.
+Index is a DynamoDB table with `PostUrl` hash key, set by URL_INDEX_TABLE environment variable. Empty name
+disables the index. Records carry `expires` (unixtime in seconds), so DynamoDB TTL on `expires` attribute
+removes stale records.
+"""
+import functools
+import logging
+import os
+import time
+from typing import Iterable, Optional
+
+from metrics import timed
+from tracing import capture, dynamodb
+
+LOGGER = logging.getLogger(__name__)
+
+URL_INDEX_TABLE = os.getenv("URL_INDEX_TABLE", "")
+URL_RECHECK_TTL = int(os.getenv("URL_RECHECK_TTL", str(24 * 60 * 60)))  # seconds
+
+
+class UrlIndex:
+    """url -> last seen index in DynamoDB table"""
+
+    def __init__(self, table, ttl=URL_RECHECK_TTL):
+        self.table = table
+        self.ttl = ttl
+
+    @capture('url_seen')
+    @timed('url_seen')
+    def seen(self, url, now=None) -> bool:
+        """check if url was seen less than ttl seconds ago"""
+        now = now if now is not None else time.time()
+        resp = self.table.get_item(Key={"PostUrl": url}, ProjectionExpression="expires")
+        expires = resp.get("Item", {}).get("expires")
+        # DynamoDB deletes expired records eventually, not immediately
+        return expires is not None and expires > now
+
+    def record(self, url, intid=None, now=None):
+        """index record for the url"""
+        now = int(now if now is not None else time.time())
+        record = {"PostUrl": url, "seen": now, "expires": now + self.ttl}
+        if intid is not None:
+            record["intid"] = intid
+        return record
+
+    @capture('url_mark')
+    def mark(self, url, intid=None, now=None):
+        """mark url as seen. `intid` is id of the item saved for the url, None if post removed"""
+        self.table.put_item(Item=self.record(url, intid, now))
+
+    @capture('url_mark_many')
+    def mark_many(self, urls: Iterable, now=None):
+        """mark many urls as seen with batch writes. `urls` is iterable of `(url, intid)`"""
+        with self.table.batch_writer(overwrite_by_pkeys=["PostUrl"]) as batch:
+            for url, intid in urls:
+                batch.put_item(Item=self.record(url, intid, now))
+
+    def safe_mark(self, url, intid=None):
+        """mark url as seen. Log and ignore errors: index is an optimization only"""
+        try:
+            self.mark(url, intid)
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.warning("failed to mark url %s", url, exc_info=True)
+
+    def safe_seen(self, url) -> bool:
+        """check if url was seen. Log errors and treat url as not seen"""
+        try:
+            return self.seen(url)
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.warning("failed to check url %s", url, exc_info=True)
+            return False
+
+
+@functools.lru_cache(maxsize=None)
+def get_index() -> Optional[UrlIndex]:
+    """return index configured by URL_INDEX_TABLE or None if disabled"""
+    if not URL_INDEX_TABLE or URL_RECHECK_TTL <= 0:
+        return None
+    return UrlIndex(dynamodb().Table(URL_INDEX_TABLE))
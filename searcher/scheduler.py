@@ -0,0 +1,90 @@
+"""search queries scheduler.
+
+Every query is polled on its own schedule. Poll interval adapts to the amount of new links the query produced
+recently: busy queries are polled more often, quiet ones less, within `min_interval` and `max_interval`.
+"""
+import heapq
+import time
+
+SPEEDUP = 2.0  # interval divider for busy queries
+SLOWDOWN = 1.5  # interval multiplier for quiet queries
+DECAY = 0.5  # weight of older polls in the recent new links average
+
+
+class Query:
+    """search query with its schedule"""
+
+    def __init__(self, url, interval=60 * 60, min_interval=5 * 60, max_interval=6 * 60 * 60, target=5):
+        self.url = url
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target = target  # new links per poll considered busy
+        self.recent = float(target) / 2  # average new links per poll, starts in the middle
+        self.next_run = 0.0
+        self.watermark = None  # newest posting time of the last completed poll
+        self.candidate = None  # newest posting time of the running poll
+        self.validators = {}  # page url -> (etag, last modified) for conditional GET
+        self.candidate_validators = {}  # validators of pages fetched by the running poll
+
+    def commit(self):
+        """poll sent all found links: pages up to the candidate are done"""
+        self.watermark = self.candidate
+        for url, validators in self.candidate_validators.items():
+            if any(validators):
+                self.validators[url] = validators
+            else:
+                self.validators.pop(url, None)
+
+    def rollback(self):
+        """poll failed to send some links: keep the watermark and fetch pages of the poll again"""
+        for url in self.candidate_validators:
+            self.validators.pop(url, None)
+
+    def update(self, new_links, now):
+        """adapt interval to the amount of new links found by the last poll and schedule next one"""
+        self.recent = DECAY * self.recent + (1 - DECAY) * new_links
+        if self.recent >= self.target:
+            self.interval = max(self.min_interval, self.interval / SPEEDUP)
+        elif self.recent < self.target / 4:
+            self.interval = min(self.max_interval, self.interval * SLOWDOWN)
+        self.next_run = now + self.interval
+
+    def __repr__(self):
+        return "Query({!r}, interval={:.0f}, recent={:.1f})".format(self.url, self.interval, self.recent)
+
+
+class Scheduler:
+    """polls queries when they are due"""
+
+    def __init__(self, queries, clock=time.monotonic, sleep=time.sleep):
+        self.queries = list(queries)
+        self.clock = clock
+        self.sleep = sleep
+
+    def run_once(self, poll):
+        """poll every query once. `poll(query)` returns amount of new links"""
+        for query in self.queries:
+            query.update(poll(query), self.clock())
+
+    def run(self, poll, polls=None):
+        """poll queries when due, forever or `polls` times in total"""
+        heap = [(query.next_run, number) for number, query in enumerate(self.queries)]
+        heapq.heapify(heap)
+        done = 0
+        while heap and (polls is None or done < polls):
+            next_run, number = heapq.heappop(heap)
+            delay = next_run - self.clock()
+            if delay > 0:
+                print("sleeping for {:.0f}".format(delay))
+                self.sleep(delay)
+            query = self.queries[number]
+            try:
+                new_links = poll(query)
+            except Exception as ex:
+                print("failed to poll {}: '{}'".format(query.url, ex))
+                new_links = 0
+            query.update(new_links, self.clock())
+            print("{} next poll in {:.0f} seconds".format(query, query.interval))
+            heapq.heappush(heap, (query.next_run, number))
+            done += 1
@@ -1,72 +1,338 @@
 import argparse
+import hashlib
+import json
+import random
+import threading
 import time
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import NamedTuple, Optional
+from urllib.parse import urljoin
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests_html import HTMLSession
 
-PROCESSED = defaultdict(int)
+from scheduler import Query, Scheduler
+from seenstore import open_store
+from util import chunks
 
-def search(url):
-    """search for classifieds in url. Returns list of URLs"""
-    print("searching in {}".format(url))
-    session = HTMLSession()
-    r = session.get(url)
-    rows = r.html.find('.rows', first=True)
-    return rows.absolute_links
 
+class Row(NamedTuple):
+    """search result row: posting metadata shown in results"""
+    url: str
+    pid: Optional[str] = None
+    title: Optional[str] = None
+    price: Optional[str] = None
+    housing: Optional[str] = None
+    posted: Optional[datetime] = None
+
+    @property
+    def fingerprint(self):
+        """hash of the metadata which may change in posting. None if row has no metadata"""
+        if self.title is None and self.price is None and self.housing is None:
+            return None
+        data = "\x00".join(value or "" for value in (self.title, self.price, self.housing))
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+def text_of(element, selector):
+    """text of the first element found by selector or None"""
+    found = element.find(selector, first=True)
+    return " ".join(found.text.split()) if found is not None else None
+
+
+def row_posted(row):
+    """posting time of the result row or None"""
+    posted = row.find('time', first=True)
+    try:
+        return datetime.strptime(posted.attrs["datetime"], "%Y-%m-%d %H:%M")
+    except (AttributeError, KeyError, ValueError):
+        return None
+
+
+def parse_row(row):
+    """parse result row. Returns Row or None if row has no posting link"""
+    title = row.find('a.result-title', first=True)
+    links = [title.absolute_links] if title is not None else []
+    links.append(row.absolute_links)
+    url = next((min(found) for found in links if found), None)
+    if url is None:
+        return None
+    return Row(
+        url=url,
+        pid=row.attrs.get("data-pid"),
+        title=text_of(row, 'a.result-title'),
+        price=text_of(row, '.result-price'),
+        housing=text_of(row, '.housing'),
+        posted=row_posted(row),
+    )
+
+
+def conditional_headers(validators):
+    """conditional GET headers from `(etag, last_modified)` of the previous response"""
+    etag, last_modified = validators
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return headers
+
+
+def search_pages(query, session=None, max_pages=1):
+    """search for classifieds of the query. Yields list of `Row` of every result page.
+
+    Unchanged pages (conditional GET with validators of the previous poll) are skipped. Results are expected
+    newest first: no more pages are fetched after the page with a posting older than query watermark, the
+    newest posting time seen by the last completed poll. All rows of fetched pages are yielded, so changes of
+    older postings on them are still found by fingerprint. Newest posting time and validators of fetched pages
+    are saved to `query.candidate` and `query.candidate_validators`, `Query.commit` applies them once links are
+    sent."""
+    session = session or HTMLSession()
+    url = query.url
+    query.candidate = query.watermark
+    query.candidate_validators = {}
+    for _ in range(max_pages):
+        print("searching in {}".format(url))
+        r = session.get(url, headers=conditional_headers(query.validators.get(url, (None, None))))
+        if r.status_code == 304:
+            print("not modified: {}".format(url))
+            return
+        r.raise_for_status()
+        query.candidate_validators[url] = (r.headers.get("ETag"), r.headers.get("Last-Modified"))
 
-def send_to_parser(parser_url, link):
+        rows = r.html.find('.rows', first=True)
+        if rows is None:
+            return
+        result_rows = rows.find('.result-row')
+        if not result_rows:
+            # unknown layout: links only
+            yield [Row(link) for link in sorted(rows.absolute_links)]
+            return
+        found = {}
+        reached = False
+        for element in result_rows:
+            row = parse_row(element)
+            if row is None:
+                continue
+            if row.posted is not None:
+                if query.watermark is not None and row.posted < query.watermark:
+                    reached = True  # older postings: rows are compared, next pages are not fetched
+                else:
+                    query.candidate = max(query.candidate or row.posted, row.posted)
+            found.setdefault(row.url, row)
+        yield list(found.values())
+        if reached:
+            print("reached watermark {}".format(query.watermark))
+            return
+
+        next_page = r.html.find('a.next', first=True)
+        href = next_page.attrs.get("href") if next_page is not None else None
+        if not href:
+            return
+        url = urljoin(url, href)
+
+
+def parser_item(link, recheck=False):
+    """parser request item of the link. `recheck` makes parser fetch the link even if it was seen recently"""
+    item = {"PostUrl": link}
+    if recheck:
+        item["Recheck"] = True
+    return item
+
+
+def send_to_parser(parser_url, link, session=None, timeout=30, recheck=False):
     """send link to parser url in specific format"""
 
-    data = {
-        "PostUrl": link,
-    }
+    data = parser_item(link, recheck)
 
     print("sending to parser {}: {}. Data: '{}'".format(parser_url, link, data))
 
-    resp = requests.post(parser_url, json=data)
+    resp = (session or requests).post(parser_url, json=data, timeout=timeout)
     resp.raise_for_status()
     requestID = resp.json().get("ResponseMetadata", {"RequestId": "NORESP"}).get("RequestId", "NOREQID")
     print(f"RequestId: {requestID}")
 
 
-def safe_send_to_parser(parser_url, link, retries=5):
-    """tries to send_to_parser safely.
+def send_batch_to_parser(parser_url, links, session=None, timeout=30, recheck=()):
+    """send links to parser in one request as JSON array. Links of `recheck` are sent with recheck flag.
 
-    try to send request `retries` times. If failing, pass"""
+    return list of links processed by parser. Links with `error` status in response are not processed"""
+    body = json.dumps([parser_item(link, link in recheck) for link in links]).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+
+    print("sending {} links to parser {}, {} bytes".format(len(links), parser_url, len(body)))
+
+    resp = (session or requests).post(parser_url, data=body, headers=headers, timeout=timeout)
+    resp.raise_for_status()
+    failed = {result["PostUrl"] for result in resp.json()["results"] if result["status"] == "error"}
+    return [link for link in links if link not in failed]
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    """exponential backoff with full jitter: random delay up to `base * 2 ** attempt`, at most `cap` seconds"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
 
-    for _ in range(retries):
-        try:
-            send_to_parser(parser_url, link)
-        except Exception as ex:
-            print("got exception sending link '{}' to parser '{}': '{}'. Retrying.".format(link, parser_url, ex))
-        else:
-            break
-    else:
-        print("failed to send link '{}' to parser '{}' {} times.".format(link, parser_url, retries))
 
+class CircuitBreaker:
+    """stops calls to failing service.
 
-def repeat(fn, interval):
-    """repeat `fn` every `interval` seconds"""
-    brk = False
-    while not brk:
-        start = time.monotonic()
-        fn()
-        now = time.monotonic()
-        excution_duration = now - start
-        sleep_time = interval - excution_duration
-        if sleep_time > 0.0:
-            print("sleeping for {}".format(sleep_time))
-            time.sleep(interval - excution_duration)
+    After `threshold` failures in a row circuit opens: calls are not allowed for `reset_timeout` seconds.
+    Then one trial call is allowed (half-open): success closes circuit, failure opens it again."""
 
+    def __init__(self, threshold=5, reset_timeout=60.0, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
 
-def iteration(search_url, parser_url):
-    res = search(search_url)
-    for link in res:
-        if PROCESSED[link] < 1:  # send if not processed yet
-            safe_send_to_parser(parser_url, link)
-        PROCESSED[link] += 1
+    def allow(self):
+        """check if call is allowed"""
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if not self.trial and self.clock() - self.opened_at >= self.reset_timeout:
+                self.trial = True  # half-open: only one trial call
+                return True
+            return False
+
+    def success(self):
+        """record successful call"""
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self):
+        """record failed call"""
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                if self.opened_at is None or self.trial:
+                    print("parser is failing, circuit is open for {} seconds".format(self.reset_timeout))
+                self.opened_at = self.clock()
+                self.trial = False
+
+
+def new_session(pool_size):
+    """requests session with connection pool of `pool_size` connections"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class ParserClient:
+    """sends links to parser concurrently with shared pooled session, retries and circuit breaker.
+
+    Links are sent one per request or in batches of `batch_size` links, see `send_batch_to_parser`"""
+
+    def __init__(self, parser_url, concurrency=8, retries=5, timeout=30, breaker=None, batch_size=1):
+        self.parser_url = parser_url
+        self.concurrency = concurrency
+        self.retries = retries
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.session = new_session(concurrency)
+        self.breaker = breaker or CircuitBreaker()
+
+    def safe_send(self, link, recheck=False):
+        """tries to send link to parser safely.
+
+        try to send request `retries` times with backoff. return True if sent"""
+        for attempt in range(self.retries):
+            if not self.breaker.allow():
+                print("circuit is open, not sending link '{}' to parser".format(link))
+                return False
+            try:
+                send_to_parser(self.parser_url, link, session=self.session, timeout=self.timeout, recheck=recheck)
+            except Exception as ex:
+                self.breaker.failure()
+                print("got exception sending link '{}' to parser '{}': '{}'. Retrying.".format(
+                    link, self.parser_url, ex))
+                if attempt + 1 < self.retries:
+                    time.sleep(backoff_delay(attempt))
+            else:
+                self.breaker.success()
+                return True
+        print("failed to send link '{}' to parser '{}' {} times.".format(link, self.parser_url, self.retries))
+        return False
+
+    def safe_send_batch(self, links, recheck=()):
+        """tries to send batch of links to parser safely.
+
+        try to send request `retries` times with backoff, links failed by parser are sent again. return list of
+        sent links"""
+        pending = list(links)
+        sent = []
+        for attempt in range(self.retries):
+            if not self.breaker.allow():
+                print("circuit is open, not sending {} links to parser".format(len(pending)))
+                return sent
+            try:
+                processed = send_batch_to_parser(self.parser_url, pending, session=self.session, timeout=self.timeout,
+                                                 recheck=recheck)
+            except Exception as ex:
+                self.breaker.failure()
+                print("got exception sending {} links to parser '{}': '{}'. Retrying.".format(
+                    len(pending), self.parser_url, ex))
+            else:
+                self.breaker.success()
+                sent.extend(processed)
+                pending = [link for link in pending if link not in processed]
+                if not pending:
+                    return sent
+                print("parser failed to process {} links. Retrying.".format(len(pending)))
+            if attempt + 1 < self.retries:
+                time.sleep(backoff_delay(attempt))
+        print("failed to send {} links to parser '{}' {} times.".format(len(pending), self.parser_url, self.retries))
+        return sent
+
+    def send_all(self, links, recheck=()):
+        """send links with up to `concurrency` requests in flight. return list of sent links.
+
+        Links of `recheck` changed since they were sent: parser fetches them even if it has seen them recently"""
+        links = list(links)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            if self.batch_size <= 1:
+                results = pool.map(lambda link: self.safe_send(link, link in recheck), links)
+                return [link for link, sent in zip(links, results) if sent]
+            batches = pool.map(lambda batch: self.safe_send_batch(batch, recheck), chunks(links, self.batch_size))
+            return [link for sent in batches for link in sent]
+
+
+def iteration(query, client, store, session=None, max_pages=1):
+    """search for links and send new and changed ones to parser page by page. return amount of sent links"""
+    found = new = sent = 0
+    for rows in search_pages(query, session=session, max_pages=max_pages):
+        fingerprints = {row.url: row.fingerprint for row in rows}
+        new_links = store.filter_new(fingerprints)  # send if not processed yet or row changed
+        changed = store.known(new_links)  # stored with other fingerprint: parser has to fetch them again
+        sent_links = client.send_all(new_links, recheck=changed)
+        store.add({link: fingerprints[link] for link in sent_links})
+        found += len(rows)
+        new += len(new_links)
+        sent += len(sent_links)
+    print("found {} links, {} new or changed".format(found, new))
+    if sent == new:
+        query.commit()
+    else:
+        # not sent links are older than the new watermark and on pages which may not change. Keep the old
+        # watermark and drop validators of the pages to find them on the next iteration
+        print("failed to send {} links, watermark is kept".format(new - sent))
+        query.rollback()
+    return new
+
+
+def read_queries(path):
+    """read search urls from file, one per line. Empty lines and lines starting with # are skipped"""
+    with open(path) as queries:
+        return [line.strip() for line in queries if line.strip() and not line.lstrip().startswith("#")]
 
 
 def str2bool(v):
@@ -84,18 +350,56 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("search_url", help="url to search links for")
     parser.add_argument("parser_url", help="url to parser service")
+    parser.add_argument("--query", action="append", default=[], help="one more url to search links for")
+    parser.add_argument("--queries", help="file with more urls to search links for, one per line")
     parser.add_argument("--repeat", type=str2bool, nargs='?', const=True, default=True,
                         help="repeat search every 'interval' seconds")
-    parser.add_argument("--interval", help="interval to parse", type=int, default=60*60)  # search once an hour 
+    parser.add_argument("--interval", help="initial interval to parse", type=int, default=60*60)  # once an hour
+    parser.add_argument("--min-interval", type=int, default=5*60,
+                        help="min interval to parse queries finding many new links")
+    parser.add_argument("--max-interval", type=int, default=6*60*60,
+                        help="max interval to parse queries finding no new links")
+    parser.add_argument("--busy", type=int, default=5,
+                        help="average new links per search to poll query more often")
+    parser.add_argument("--max-pages", type=int, default=5, help="max search result pages to follow")
+    parser.add_argument("--concurrency", type=int, default=8, help="links sent to parser at the same time")
+    parser.add_argument("--retries", type=int, default=5, help="attempts to send link to parser")
+    parser.add_argument("--timeout", type=float, default=30, help="parser request timeout, seconds")
+    parser.add_argument("--breaker-threshold", type=int, default=5,
+                        help="failures in a row to stop sending links to parser for '--breaker-timeout' seconds")
+    parser.add_argument("--breaker-timeout", type=float, default=60)
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="links sent to parser in one request. Parser responds with status of every link")
+    parser.add_argument("--seen-db", default="seen.db",
+                        help="SQLite file to keep sent links in between restarts. Empty value keeps them in memory")
+    parser.add_argument("--seen-ttl", type=float, default=30,
+                        help="days to remember links not found in search results anymore")
+    parser.add_argument("--seen-max", type=int, default=100000, help="max amount of links to remember")
     return parser.parse_args()
 
 
 def main():
     args = parse_args()
-    if args.repeat:
-        repeat(lambda: iteration(args.search_url, args.parser_url), args.interval)
-    else:
-        iteration(args.search_url, args.parser_url)
+    client = ParserClient(args.parser_url, concurrency=args.concurrency, retries=args.retries, timeout=args.timeout,
+                          breaker=CircuitBreaker(args.breaker_threshold, args.breaker_timeout),
+                          batch_size=args.batch_size)
+    store = open_store(args.seen_db, args.seen_ttl * 24 * 60 * 60, args.seen_max)
+    urls = [args.search_url] + args.query + (read_queries(args.queries) if args.queries else [])
+    queries = [Query(url, args.interval, args.min_interval, args.max_interval, args.busy)
+               for url in dict.fromkeys(urls)]
+    session = HTMLSession()
+
+    def poll(query):
+        return iteration(query, client, store, session=session, max_pages=args.max_pages)
+
+    scheduler = Scheduler(queries)
+    try:
+        if args.repeat:
+            scheduler.run(poll)
+        else:
+            scheduler.run_once(poll)
+    finally:
+        store.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,165 @@
+"""seen links stores.
+
+Store keeps links sent to parser with last seen time and fingerprint of the result row. Links not seen for `ttl`
+seconds expire, store keeps at most `max_size` links evicting least recently seen ones. Lookups and inserts take all
+links of an iteration at once: iterable of links or mapping of link to fingerprint. Link with changed fingerprint
+is not seen.
+"""
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+from util import chunks
+
+SQLITE_MAX_VARIABLES = 999  # parameters per statement in old sqlite versions
+
+
+def as_fingerprints(links):
+    """mapping of link to fingerprint. Links without fingerprints map to None"""
+    if isinstance(links, dict):
+        return links
+    return dict.fromkeys(links)
+
+
+class SeenStore(ABC):
+    """seen links store interface"""
+
+    def __init__(self, ttl=30 * 24 * 60 * 60, max_size=100000):
+        self.ttl = ttl
+        self.max_size = max_size
+
+    @abstractmethod
+    def filter_new(self, links, now=None):
+        """return links not seen yet or with changed fingerprint. Seen links are touched"""
+
+    @abstractmethod
+    def known(self, links):
+        """return set of stored links, whatever their fingerprint. Links are not touched"""
+
+    @abstractmethod
+    def add(self, links, now=None):
+        """mark links as seen"""
+
+    @abstractmethod
+    def expire(self, now):
+        """drop links not seen for ttl seconds"""
+
+    @abstractmethod
+    def __len__(self):
+        """amount of stored links"""
+
+    def close(self):
+        """release resources"""
+
+
+class MemoryStore(SeenStore):
+    """in memory store. Lost on restart"""
+
+    def __init__(self, ttl=30 * 24 * 60 * 60, max_size=100000):
+        super().__init__(ttl, max_size)
+        self.links = OrderedDict()  # link -> (last seen, fingerprint), least recently seen first
+
+    def filter_new(self, links, now=None):
+        """return links not seen yet or with changed fingerprint. Seen links are touched"""
+        now = now if now is not None else time.time()
+        self.expire(now)
+        new = []
+        for link, fingerprint in as_fingerprints(links).items():
+            stored = self.links.get(link)
+            if stored is not None and (fingerprint is None or stored[1] in (None, fingerprint)):
+                self.links[link] = (now, stored[1] if fingerprint is None else fingerprint)
+                self.links.move_to_end(link)
+            else:
+                new.append(link)
+        return new
+
+    def known(self, links):
+        """return set of stored links, whatever their fingerprint. Links are not touched"""
+        return {link for link in links if link in self.links}
+
+    def add(self, links, now=None):
+        """mark links as seen"""
+        now = now if now is not None else time.time()
+        for link, fingerprint in as_fingerprints(links).items():
+            self.links[link] = (now, fingerprint)
+            self.links.move_to_end(link)
+        while len(self.links) > self.max_size:
+            self.links.popitem(last=False)
+
+    def expire(self, now):
+        """drop links not seen for ttl seconds"""
+        while self.links:
+            link, (seen, _) = next(iter(self.links.items()))
+            if now - seen < self.ttl:
+                break
+            del self.links[link]
+
+    def __len__(self):
+        return len(self.links)
+
+
+class SQLiteStore(SeenStore):
+    """store in SQLite database file. Survives restarts"""
+
+    def __init__(self, path, ttl=30 * 24 * 60 * 60, max_size=100000):
+        super().__init__(ttl, max_size)
+        self.db = sqlite3.connect(path)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS seen (link TEXT PRIMARY KEY, last_seen REAL NOT NULL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS seen_last_seen ON seen (last_seen)")
+            columns = [row[1] for row in self.db.execute("PRAGMA table_info(seen)")]
+            if "fingerprint" not in columns:
+                self.db.execute("ALTER TABLE seen ADD COLUMN fingerprint TEXT")
+
+    def filter_new(self, links, now=None):
+        """return links not seen yet or with changed fingerprint. Seen links are touched"""
+        now = now if now is not None else time.time()
+        fingerprints = as_fingerprints(links)
+        seen = set()
+        with self.db:
+            self.expire(now)
+            for chunk in chunks(list(fingerprints), SQLITE_MAX_VARIABLES):
+                query = "SELECT link, fingerprint FROM seen WHERE link IN ({})".format(",".join("?" * len(chunk)))
+                seen.update(link for link, stored in self.db.execute(query, chunk)
+                            if fingerprints[link] is None or stored in (None, fingerprints[link]))
+            self.db.executemany("UPDATE seen SET last_seen = ?, fingerprint = coalesce(?, fingerprint) WHERE link = ?",
+                                ((now, fingerprints[link], link) for link in seen))
+        return [link for link in fingerprints if link not in seen]
+
+    def known(self, links):
+        """return set of stored links, whatever their fingerprint. Links are not touched"""
+        found = set()
+        for chunk in chunks(list(links), SQLITE_MAX_VARIABLES):
+            query = "SELECT link FROM seen WHERE link IN ({})".format(",".join("?" * len(chunk)))
+            found.update(link for link, in self.db.execute(query, chunk))
+        return found
+
+    def add(self, links, now=None):
+        """mark links as seen"""
+        now = now if now is not None else time.time()
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO seen (link, last_seen, fingerprint) VALUES (?, ?, ?)",
+                                ((link, now, fingerprint) for link, fingerprint in as_fingerprints(links).items()))
+            excess = len(self) - self.max_size
+            if excess > 0:
+                self.db.execute("DELETE FROM seen WHERE link IN "
+                                "(SELECT link FROM seen ORDER BY last_seen LIMIT ?)", (excess,))
+
+    def expire(self, now):
+        """drop links not seen for ttl seconds"""
+        self.db.execute("DELETE FROM seen WHERE last_seen <= ?", (now - self.ttl,))
+
+    def __len__(self):
+        return self.db.execute("SELECT count(*) FROM seen").fetchone()[0]
+
+    def close(self):
+        """close database"""
+        self.db.close()
+
+
+def open_store(path, ttl, max_size):
+    """SQLite store in `path` or memory store if path is empty"""
+    if not path:
+        return MemoryStore(ttl, max_size)
+    return SQLiteStore(path, ttl, max_size)
@@ -0,0 +1,83 @@
+import unittest
+
+from scheduler import Query, Scheduler
+
+
+class FakeTime:
+    """clock and sleep of the scheduler: sleeping moves the clock"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.now += delay
+
+
+class TestQuery(unittest.TestCase):
+    def test_busy_speeds_up(self):
+        query = Query("q", interval=3600, min_interval=600, max_interval=7200, target=4)
+        intervals = []
+        for _ in range(5):
+            query.update(10, now=0)
+            intervals.append(query.interval)
+        self.assertEqual(intervals, [1800, 900, 600, 600, 600])
+        self.assertEqual(query.next_run, 600)
+
+    def test_quiet_slows_down(self):
+        query = Query("q", interval=3600, min_interval=600, max_interval=7200, target=4)
+        intervals = []
+        for _ in range(4):
+            query.update(0, now=100)
+            intervals.append(query.interval)
+        # average of new links decays from 2: 1 is not quiet yet
+        self.assertEqual(intervals, [3600, 5400, 7200, 7200])
+        self.assertEqual(query.next_run, 7300)
+
+    def test_average_keeps_interval(self):
+        query = Query("q", interval=3600, target=4)
+        query.update(2, now=0)
+        self.assertEqual(query.interval, 3600)
+
+
+class TestScheduler(unittest.TestCase):
+    def test_order(self):
+        fake = FakeTime()
+        busy = Query("busy", interval=100, min_interval=100, max_interval=100, target=1)
+        quiet = Query("quiet", interval=300, min_interval=300, max_interval=300, target=1)
+        polled = []
+
+        def poll(query):
+            polled.append((fake.now, query.url))
+            return 1
+
+        Scheduler([quiet, busy], clock=fake.clock, sleep=fake.sleep).run(poll, polls=6)
+        # both are due at start, in queries order, then by next poll time
+        self.assertEqual(polled, [(0, "quiet"), (0, "busy"), (100, "busy"), (200, "busy"), (300, "quiet"),
+                                  (300, "busy")])
+
+    def test_failed_poll(self):
+        fake = FakeTime()
+        query = Query("q", interval=100, min_interval=100, max_interval=100)
+        calls = []
+
+        def poll(query):
+            calls.append(fake.now)
+            raise RuntimeError("search is down")
+
+        Scheduler([query], clock=fake.clock, sleep=fake.sleep).run(poll, polls=3)
+        self.assertEqual(calls, [0, 100, 200])
+
+    def test_run_once(self):
+        fake = FakeTime()
+        queries = [Query("a"), Query("b")]
+        polled = []
+        Scheduler(queries, clock=fake.clock, sleep=fake.sleep).run_once(lambda query: polled.append(query.url) or 0)
+        self.assertEqual(polled, ["a", "b"])
+        self.assertTrue(all(query.next_run == query.interval for query in queries))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,307 @@
+import json
+import unittest
+from unittest import mock
+
+import requests
+from requests_html import HTML
+
+from scheduler import Query
+from searcher import CircuitBreaker, ParserClient, iteration, send_batch_to_parser
+from seenstore import MemoryStore
+
+SEARCH_URL = "https://sfbay.craigslist.org/search/apa?sort=date"
+PARSER_URL = "https://parser.example.com/"
+
+
+def result_row(pid, posted, price, title="Sunny 2BR", housing="2br - 1050ft2"):
+    return ('<li class="result-row" data-pid="{0}"><time class="result-date" datetime="{1}">{1}</time>'
+            '<a href="/apa/d/{0}.html" class="result-title">{2}</a><span class="result-price">{3}</span>'
+            '<span class="housing">{4}</span></li>').format(pid, posted, title, price, housing)
+
+
+def posting_url(pid):
+    return "https://sfbay.craigslist.org/apa/d/{}.html".format(pid)
+
+
+class Response:
+    """search response stub"""
+
+    def __init__(self, url, status_code=200, rows=(), headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.html = HTML(html='<ul class="rows">{}</ul>'.format("".join(rows)), url=url)
+
+    def raise_for_status(self):
+        pass
+
+
+class Session:
+    """search session stub serving one results page with ETag. Responds 304 to the matching If-None-Match"""
+
+    def __init__(self, rows, etag='"v1"'):
+        self.rows = rows
+        self.etag = etag
+        self.requests = []  # request headers
+
+    def get(self, url, headers=None):
+        self.requests.append(headers or {})
+        if (headers or {}).get("If-None-Match") == self.etag:
+            return Response(url, status_code=304)
+        return Response(url, rows=self.rows, headers={"ETag": self.etag})
+
+
+class Client:
+    """parser client stub. Sends nothing while `down`"""
+
+    def __init__(self):
+        self.down = False
+        self.sent = []
+        self.recheck = set()  # sent with recheck flag
+
+    def send_all(self, links, recheck=()):
+        if self.down:
+            return []
+        self.sent.extend(links)
+        self.recheck.update(recheck)
+        return list(links)
+
+
+def batch_results(payload, failed=()):
+    """parser batch response body: links of `failed` have error status, others are saved"""
+    return {"results": [{"PostUrl": item["PostUrl"], "status": "error" if item["PostUrl"] in failed else "saved"}
+                        for item in payload]}
+
+
+class ParserResponse:
+    """parser response stub"""
+
+    def __init__(self, status_code=200, body=None):
+        self.status_code = status_code
+        self.body = body or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError("{} error".format(self.status_code))
+
+    def json(self):
+        return self.body
+
+
+class ParserSession:
+    """parser session stub. Answers posts with `responses` in order: status code, ParserResponse or exception
+    to raise. Answers 200 when they run out, batches with all links saved"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.posts = []  # posted payloads
+
+    def post(self, url, **kwargs):
+        payload = kwargs["json"] if "json" in kwargs else json.loads(kwargs["data"])
+        self.posts.append(payload)
+        response = self.responses.pop(0) if self.responses else 200
+        if isinstance(response, Exception):
+            raise response
+        if isinstance(response, ParserResponse):
+            return response
+        return ParserResponse(response, batch_results(payload) if isinstance(payload, list) else None)
+
+
+class Clock:
+    """fake monotonic clock"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.breaker = CircuitBreaker(threshold=3, reset_timeout=60, clock=self.clock)
+
+    def test_opens_after_threshold(self):
+        for _ in range(2):
+            self.breaker.failure()
+            self.assertTrue(self.breaker.allow())
+        self.breaker.failure()
+        self.assertFalse(self.breaker.allow())
+
+    def test_success_resets_failures(self):
+        self.breaker.failure()
+        self.breaker.failure()
+        self.breaker.success()
+        self.breaker.failure()
+        self.assertTrue(self.breaker.allow())
+
+    def test_half_open_single_trial(self):
+        for _ in range(3):
+            self.breaker.failure()
+        self.clock.now = 59
+        self.assertFalse(self.breaker.allow())
+        self.clock.now = 60
+        self.assertTrue(self.breaker.allow())  # trial call
+        self.assertFalse(self.breaker.allow())  # no more calls until trial result
+
+    def test_trial_success_closes(self):
+        for _ in range(3):
+            self.breaker.failure()
+        self.clock.now = 60
+        self.assertTrue(self.breaker.allow())
+        self.breaker.success()
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.allow())
+
+    def test_trial_failure_opens_again(self):
+        for _ in range(3):
+            self.breaker.failure()
+        self.clock.now = 60
+        self.assertTrue(self.breaker.allow())
+        self.breaker.failure()
+        self.clock.now = 119
+        self.assertFalse(self.breaker.allow())
+        self.clock.now = 120
+        self.assertTrue(self.breaker.allow())
+
+
+class TestParserClient(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch("searcher.time.sleep")
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def client(self, session, retries=3, threshold=5, batch_size=1):
+        client = ParserClient(PARSER_URL, concurrency=1, retries=retries, batch_size=batch_size,
+                              breaker=CircuitBreaker(threshold=threshold, reset_timeout=60, clock=self.clock))
+        client.session = session
+        return client
+
+    def test_retry_server_and_connection_errors(self):
+        session = ParserSession(503, requests.ConnectionError("connection refused"), 200)
+        self.assertTrue(self.client(session).safe_send(posting_url(1)))
+        self.assertEqual(session.posts, [{"PostUrl": posting_url(1)}] * 3)
+        self.assertEqual(self.sleep.call_count, 2)
+
+    def test_recheck(self):
+        session = ParserSession()
+        client = self.client(session)
+        self.assertEqual(client.send_all([posting_url(1), posting_url(2)], recheck={posting_url(2)}),
+                         [posting_url(1), posting_url(2)])
+        self.assertEqual(session.posts, [{"PostUrl": posting_url(1)}, {"PostUrl": posting_url(2), "Recheck": True}])
+
+    def test_backoff_grows(self):
+        session = ParserSession(500, 500, 500, 500)
+        with mock.patch("searcher.random.uniform", side_effect=lambda low, high: high):
+            self.assertFalse(self.client(session, retries=4).safe_send(posting_url(1)))
+        self.assertEqual(len(session.posts), 4)
+        # no sleep after the last attempt
+        self.assertEqual([c.args[0] for c in self.sleep.call_args_list], [0.5, 1.0, 2.0])
+
+    def test_breaker_stops_sending(self):
+        session = ParserSession(*[requests.ConnectionError("connection refused")] * 10)
+        client = self.client(session, retries=3, threshold=2)
+        self.assertEqual(client.send_all([posting_url(1), posting_url(2), posting_url(3)]), [])
+        # circuit opens after the second failure of the first link, other links are not sent
+        self.assertEqual(session.posts, [{"PostUrl": posting_url(1)}] * 2)
+
+        # trial call after reset timeout closes circuit
+        session.responses.clear()
+        self.clock.now = 60
+        self.assertEqual(client.send_all([posting_url(2), posting_url(3)]), [posting_url(2), posting_url(3)])
+
+
+class TestBatches(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch("searcher.time.sleep")
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.links = [posting_url(pid) for pid in range(1, 6)]
+
+    def client(self, session, batch_size):
+        client = ParserClient(PARSER_URL, concurrency=1, retries=3, batch_size=batch_size)
+        client.session = session
+        return client
+
+    def test_send_batch_to_parser(self):
+        session = ParserSession(ParserResponse(body=batch_results([{"PostUrl": link} for link in self.links[:3]],
+                                                                  failed={self.links[1]})))
+        processed = send_batch_to_parser(PARSER_URL, self.links[:3], session=session)
+        self.assertEqual(processed, [self.links[0], self.links[2]])
+        self.assertEqual(session.posts, [[{"PostUrl": link} for link in self.links[:3]]])
+
+    def test_resend_failed_links(self):
+        first = [{"PostUrl": link} for link in self.links[:3]]
+        session = ParserSession(ParserResponse(body=batch_results(first, failed={self.links[1]})), 503)
+        sent = self.client(session, batch_size=3).safe_send_batch(self.links[:3])
+
+        # only the link failed by parser is sent again, after the failed request too
+        self.assertEqual(sent, [self.links[0], self.links[2], self.links[1]])
+        self.assertEqual(session.posts, [first, [{"PostUrl": self.links[1]}], [{"PostUrl": self.links[1]}]])
+        self.assertEqual(self.sleep.call_count, 2)
+
+    def test_send_all_batches(self):
+        session = ParserSession()
+        self.assertEqual(self.client(session, batch_size=2).send_all(self.links), self.links)
+        self.assertEqual([[item["PostUrl"] for item in batch] for batch in session.posts],
+                         [self.links[0:2], self.links[2:4], self.links[4:]])
+
+    def test_send_all_recheck(self):
+        session = ParserSession()
+        self.client(session, batch_size=3).send_all(self.links[:2], recheck={self.links[1]})
+        self.assertEqual(session.posts, [[{"PostUrl": self.links[0]}, {"PostUrl": self.links[1], "Recheck": True}]])
+
+    def test_send_all_failed_batch(self):
+        session = ParserSession(*[500] * 3)  # first batch fails all attempts
+        self.assertEqual(self.client(session, batch_size=2).send_all(self.links), self.links[2:])
+        self.assertEqual(len(session.posts), 5)
+
+
+class TestIteration(unittest.TestCase):
+    def setUp(self):
+        self.query = Query(SEARCH_URL)
+        self.client = Client()
+        self.store = MemoryStore()
+
+    def test_not_modified(self):
+        session = Session([result_row(1, "2021-05-01 10:00", "$3,000")])
+        self.assertEqual(iteration(self.query, self.client, self.store, session=session), 1)
+        self.assertEqual(iteration(self.query, self.client, self.store, session=session), 0)
+        self.assertEqual(session.requests[1], {"If-None-Match": '"v1"'})
+        self.assertEqual(self.client.sent, [posting_url(1)])
+
+    def test_failed_send_then_not_modified(self):
+        session = Session([result_row(1, "2021-05-01 10:00", "$3,000")])
+        self.client.down = True
+        self.assertEqual(iteration(self.query, self.client, self.store, session=session), 1)
+        self.assertIsNone(self.query.watermark)
+
+        # page did not change, but validators of the failed poll were dropped: page is fetched and link is sent
+        self.client.down = False
+        self.assertEqual(iteration(self.query, self.client, self.store, session=session), 1)
+        self.assertEqual(session.requests[1], {})
+        self.assertEqual(self.client.sent, [posting_url(1)])
+        self.assertIsNotNone(self.query.watermark)
+
+        # now the poll is done
+        self.assertEqual(iteration(self.query, self.client, self.store, session=session), 0)
+        self.assertEqual(session.requests[2], {"If-None-Match": '"v1"'})
+
+    def test_older_row_changed(self):
+        session = Session([result_row(2, "2021-05-02 10:00", "$3,000"), result_row(1, "2021-05-01 10:00", "$2,500")])
+        self.assertEqual(iteration(self.query, self.client, self.store, session=session), 2)
+
+        # new posting on top, price of the posting older than the watermark dropped
+        session.rows = [result_row(3, "2021-05-03 10:00", "$2,800"), result_row(2, "2021-05-02 10:00", "$3,000"),
+                        result_row(1, "2021-05-01 10:00", "$2,300")]
+        session.etag = '"v2"'
+        self.client.sent.clear()
+        self.assertEqual(iteration(self.query, self.client, self.store, session=session), 2)
+        self.assertEqual(self.client.sent, [posting_url(3), posting_url(1)])
+        # parser url index has seen the changed posting recently: it is sent with recheck flag
+        self.assertEqual(self.client.recheck, {posting_url(1)})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import tempfile
+import unittest
+
+from seenstore import MemoryStore, SQLiteStore, open_store
+from util import chunks
+
+DAY = 24 * 60 * 60
+
+
+class StoreTests:
+    """tests common for all stores. Subclasses implement `open(ttl=DAY, max_size=100)`"""
+
+    def test_filter_new(self):
+        store = self.open()
+        self.assertEqual(store.filter_new(["a", "b"], now=0), ["a", "b"])
+        store.add(["a"], now=0)
+        self.assertEqual(store.filter_new(["a", "b"], now=1), ["b"])
+        self.assertEqual(len(store), 1)
+
+    def test_fingerprint_changed(self):
+        store = self.open()
+        store.add({"a": "price 1", "b": "price 1"}, now=0)
+        self.assertEqual(store.filter_new({"a": "price 1", "b": "price 2"}, now=1), ["b"])
+        # links without fingerprint are seen
+        self.assertEqual(store.filter_new(["a", "b"], now=2), [])
+
+    def test_known(self):
+        store = self.open()
+        store.add({"a": "price 1"}, now=0)
+        self.assertEqual(store.filter_new({"a": "price 2", "b": "price 1"}, now=1), ["a", "b"])
+        self.assertEqual(store.known(["a", "b"]), {"a"})
+
+    def test_ttl(self):
+        store = self.open(ttl=DAY)
+        store.add(["a"], now=0)
+        store.add(["b"], now=DAY / 2)
+        self.assertEqual(store.filter_new(["a", "b"], now=DAY), ["a"])
+        self.assertEqual(len(store), 1)
+
+    def test_ttl_touched(self):
+        store = self.open(ttl=DAY)
+        store.add(["a"], now=0)
+        self.assertEqual(store.filter_new(["a"], now=DAY - 1), [])  # seen again, expires a day later
+        self.assertEqual(store.filter_new(["a"], now=2 * DAY - 2), [])
+
+    def test_lru_eviction(self):
+        store = self.open(max_size=3)
+        for now, link in enumerate(("a", "b", "c")):
+            store.add([link], now=now)
+        store.filter_new(["a"], now=3)  # a becomes recently seen
+        store.add(["d"], now=4)
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store.filter_new(["a", "b", "c", "d"], now=5), ["b"])
+
+
+class TestMemoryStore(StoreTests, unittest.TestCase):
+    def open(self, ttl=DAY, max_size=100):
+        return MemoryStore(ttl, max_size)
+
+
+class TestSQLiteStore(StoreTests, unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "seen.db")
+
+    def open(self, ttl=DAY, max_size=100):
+        store = SQLiteStore(self.path, ttl, max_size)
+        self.addCleanup(store.close)
+        return store
+
+    def test_reopen(self):
+        store = self.open()
+        store.add({"a": "price 1"}, now=0)
+        store.close()
+        store = self.open()
+        self.assertEqual(store.filter_new({"a": "price 1", "b": None}, now=1), ["b"])
+
+    def test_many_links(self):
+        store = self.open(max_size=5000)
+        links = ["link{}".format(i) for i in range(3000)]  # more than sqlite variables per statement
+        store.add(links, now=0)
+        self.assertEqual(store.filter_new(links + ["new"], now=1), ["new"])
+
+
+class TestOpenStore(unittest.TestCase):
+    def test_memory(self):
+        self.assertIsInstance(open_store("", DAY, 10), MemoryStore)
+
+
+class TestChunks(unittest.TestCase):
+    def test_chunks(self):
+        self.assertEqual(list(chunks([1, 2, 3, 4, 5], 2)), [[1, 2], [3, 4], [5]])
+
+
+if __name__ == '__main__':
+    unittest.main()
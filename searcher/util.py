@@ -0,0 +1,7 @@
+"""searcher helpers"""
+
+
+def chunks(items, size):
+    """split list into lists of `size` items"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
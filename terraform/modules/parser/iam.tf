@@ -28,7 +28,7 @@ data "aws_iam_policy_document" "lambda_logging" {
       "logs:CreateLogStream",
       "logs:PutLogEvents"
     ]
-    resources = [aws_cloudwatch_log_group.lambda_logs.arn]
+    resources = [aws_cloudwatch_log_group.lambda_logs.arn, aws_cloudwatch_log_group.sqs_lambda_logs.arn]
     effect    = "Allow"
   }
 }
@@ -71,6 +71,8 @@ resource "aws_iam_role_policy_attachment" "lambda_trace" {
 data "aws_iam_policy_document" "lambda_dynamo" {
   statement {
     actions = [
+      "dynamodb:BatchGetItem",
+      "dynamodb:BatchWriteItem",
       "dynamodb:DeleteItem",
       "dynamodb:GetItem",
       "dynamodb:PutItem",
@@ -112,6 +114,17 @@ data "aws_iam_policy_document" "lambda_sqs" {
     resources = [var.sqs_thumbs_arn, data.aws_sqs_queue.processor-input.arn]
     effect    = "Allow"
   }
+  // event source of parser-sqs
+  statement {
+    actions = [
+      "sqs:ReceiveMessage",
+      "sqs:DeleteMessage",
+      "sqs:GetQueueAttributes",
+      "sqs:ChangeMessageVisibility",
+    ]
+    resources = [aws_sqs_queue.input.arn]
+    effect    = "Allow"
+  }
 }
 
 resource "aws_iam_policy" "lambda_sqs" {
@@ -0,0 +1,3 @@
+output "sqs_parser_url" {
+  value = aws_sqs_queue.input.url
+}
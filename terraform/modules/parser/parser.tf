@@ -17,10 +17,7 @@ resource "aws_lambda_function" "parser" {
   source_code_hash = filebase64sha256(var.archive)
 
   environment {
-    variables = {
-      SQS_QUEUE_URL           = var.sqs_thumbs_url
-      PROCESSOR_SQS_QUEUE_URL = data.aws_sqs_queue.processor-input.url
-    }
+    variables = local.environment
   }
 
   tags = merge(var.tags,
@@ -36,6 +33,62 @@ resource "aws_cloudwatch_log_group" "lambda_logs" {
   tags = var.tags
 }
 
+locals {
+  environment = {
+    SQS_QUEUE_URL           = var.sqs_thumbs_url
+    PROCESSOR_SQS_QUEUE_URL = data.aws_sqs_queue.processor-input.url
+    PARSER_ENGINE           = "lxml"
+  }
+}
+
+// SQS batch mode: same package, handler.sqs_handler entry point
+resource "aws_lambda_function" "parser-sqs" {
+  function_name = "${var.lambda_name}-sqs"
+  description   = "parser of new entries from SQS"
+  handler       = "handler.sqs_handler"
+  memory_size   = 128
+  s3_bucket     = aws_s3_bucket.apthunt.bucket
+  s3_key        = aws_s3_bucket_object.parser.key
+  role          = aws_iam_role.parser-lambda.arn
+  runtime       = "python3.6"
+  publish       = false
+  tracing_config {
+    mode = "Active"
+  }
+  timeout          = var.sqs_timeout
+  source_code_hash = filebase64sha256(var.archive)
+
+  environment {
+    variables = local.environment
+  }
+
+  tags = merge(var.tags,
+    {
+      "source_code_hash" = filebase64sha256(var.archive),
+  })
+}
+
+resource "aws_cloudwatch_log_group" "sqs_lambda_logs" {
+  name              = "/aws/lambda/${var.lambda_name}-sqs"
+  retention_in_days = 14
+
+  tags = var.tags
+}
+
+resource "aws_lambda_event_source_mapping" "parser_trigger" {
+  event_source_arn        = aws_sqs_queue.input.arn
+  function_name           = aws_lambda_function.parser-sqs.arn
+  batch_size              = var.sqs_batch_size
+  function_response_types = ["ReportBatchItemFailures"] // sqs_handler returns batchItemFailures
+}
+
+// SQS for incoming postings. Visibility timeout of 6 function timeouts is recommended for event source
+resource "aws_sqs_queue" "input" {
+  name                       = "parser-in"
+  visibility_timeout_seconds = 6 * var.sqs_timeout
+  tags                       = var.tags
+}
+
 data "aws_sqs_queue" "processor-input" {
   name = var.sqs_processor_name
 }
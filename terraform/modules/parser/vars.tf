@@ -34,3 +34,13 @@ variable "sqs_processor_name" {
   default     = "NAMEGOESHERE"
   description = "name (important) of SQS input to processor"
 }
+
+variable "sqs_batch_size" {
+  default     = 10
+  description = "max amount of SQS messages handled by one parser-sqs invocation"
+}
+
+variable "sqs_timeout" {
+  default     = 60
+  description = "timeout of parser-sqs function, seconds"
+}